@@ -0,0 +1,168 @@
+"""
+Registry of running autospins.
+
+An autospin plays several spins of one bid as one job: the bids are debited together, the
+dice are sent one after another and all spins are settled with one script call. The debit
+writes a pending record to Redis (see UserSession.start_autospin), which allows one autospin
+per user across all processes and stores the dice played so far. This module defines:
+- AutospinRunner: runs every job in a task of its own, so the handler starting it returns
+  immediately, and cancels running jobs on shutdown and waits for them, so they settle what
+  they played before the shutdown flush
+- settle_stale_autospins: run by the sync leader, settles the records of autospins without a
+  spin for AUTOSPIN_STALE_TIMEOUT seconds, e.g. of a crashed process, crediting the payouts of
+  the recorded spins and returning the bids of the others. If the session has expired since,
+  they are credited in the database, where the session was saved
+
+Dice are sent through the bot session, where OutboundLimiter paces them to the chat's rate limit.
+"""
+
+import asyncio
+import os
+from typing import Coroutine
+from dotenv import load_dotenv
+from loguru import logger
+
+from app.cache.redis_logic import redis_client, UserSession, AUTOSPINS_KEY, LEDGER_STREAM_KEY
+from app.payouts import payout
+from app import metrics
+import app.database.requests as rq
+
+load_dotenv()
+
+# Number of spins an autospin can be started with
+AUTOSPIN_COUNTS = (5, 10, 25)
+# Seconds without a spin after which a pending autospin is settled by the sync leader
+AUTOSPIN_STALE_TIMEOUT = float(os.getenv("AUTOSPIN_STALE_TIMEOUT") or 120)
+
+# Takes over autospin ARGV[2] of user ARGV[1] if its session KEYS[3] has expired: deletes its
+# record KEYS[1] and its entry in KEYS[2]. An entry without a record is deleted as well.
+# Returns 1 if the autospin was taken over, 0 otherwise.
+CLAIM_ORPHANED_LUA = """
+local autospin_id = redis.call('HGET', KEYS[1], 'id')
+if not autospin_id then
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    return 0
+end
+if autospin_id ~= ARGV[2] or redis.call('EXISTS', KEYS[3]) == 1 then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+return 1
+"""
+
+claim_orphaned_script = redis_client.register_script(CLAIM_ORPHANED_LUA)
+
+
+class AutospinRunner():
+    '''Tasks of running autospins by user ID.'''
+
+    def __init__(self):
+        self.jobs: dict[int, asyncio.Task] = {}
+
+    def start(self, user_id: int, job: Coroutine) -> None:
+        '''Run an autospin of a user in the background.
+
+        args:
+            user_id (int): Telegram User ID
+            job (Coroutine): Coroutine playing and settling the spins, it must settle when cancelled
+        '''
+        task = self.jobs[user_id] = asyncio.create_task(job)
+        task.add_done_callback(lambda _: self._finished(user_id, task))
+
+    def _finished(self, user_id: int, task: asyncio.Task) -> None:
+        if self.jobs.get(user_id) is task:
+            del self.jobs[user_id]
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Autospin of user {user_id} failed: {task.exception()}")
+
+    async def stop(self) -> None:
+        '''Cancel running autospins and wait until they are settled.'''
+        if not self.jobs:
+            return
+        logger.info(f"Settling {len(self.jobs)} running autospins")
+        tasks = list(self.jobs.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def settle_stale_autospins(timeout: float = AUTOSPIN_STALE_TIMEOUT, batch_size: int = 500) -> int:
+    '''Settle up to `batch_size` pending autospins without a spin for `timeout` seconds from their records.
+
+    A job still playing one of them notices on its next spin and stops without settling.
+    Entries left without a record are dropped.
+
+    args:
+        timeout (float): Seconds since the last spin, keep it well above the outbound pacing of dice
+        batch_size (int): Maximum number of autospins settled at once
+
+    return:
+        int: Number of settled autospins
+    '''
+    # Entries are scored with Redis TIME, the clock of this host may be off
+    now, _ = await redis_client.time()
+    settled = 0
+    for user_id in await redis_client.zrangebyscore(AUTOSPINS_KEY, "-inf", now - timeout, start=0, num=batch_size):
+        session = UserSession(user_id)
+        record = await redis_client.hgetall(session.autospin_key)
+        if not record:
+            await claim_orphaned_script(keys=[session.autospin_key, AUTOSPINS_KEY, session.key], args=[user_id, ""])
+            continue
+        count, bid = int(record["n"]), int(record["b"])
+        spins = [(int(value), payout(bid, int(value))) for value in record["d"].split(",") if value]
+        refund = (count - len(spins)) * bid
+        balance = await session.settle_spins(record["id"], bid, spins, refund)
+        if balance is None:
+            balance = await settle_orphaned(session, record["id"], bid, spins, refund)
+        # The job settled it meanwhile, or the session was recreated and is settled on a later pass
+        if balance is None:
+            continue
+        for _, returned in spins:
+            metrics.spins.inc("win" if returned else "loss")
+        if refund:
+            metrics.spins.inc("failed", amount=count - len(spins))
+        logger.warning(f"Settled stale autospin of user {user_id}: {len(spins)} of {count} spins of {bid}, "
+                       f"refund {refund}, balance {balance}")
+        settled += 1
+    return settled
+
+
+async def settle_orphaned(session: UserSession, autospin_id: str, bid: int, spins: list[tuple[int, int]],
+                          refund: int) -> int | None:
+    '''Credit the payouts and the refund of an autospin whose session has expired in the database.
+
+    args:
+        session (UserSession): Session of the user, no longer cached
+        autospin_id (str): ID of the pending autospin
+        bid (int): Bid of every spin
+        spins (list[tuple[int, int]]): Dice value and payout of every recorded spin
+        refund (int): Debited amount to return for spins which did not happen
+
+    return:
+        int | None: New balance, or None if the session exists or the autospin was settled already
+    '''
+    keys = [session.autospin_key, AUTOSPINS_KEY, session.key]
+    if not await claim_orphaned_script(keys=keys, args=[session.user_id, autospin_id]):
+        return None
+    credit = sum(returned for _, returned in spins) + refund
+    balance = await rq.add_user_coins(session.user_id, credit)
+    if balance is None:
+        logger.error(f"Autospin of user {session.user_id} was not settled, the user is not in the database, "
+                     f"{credit} coins lost")
+        return None
+    # Ledger entries as written by the settle script
+    pipe = redis_client.pipeline(transaction=False)
+    running = balance - credit
+    for value, returned in spins:
+        running += returned
+        pipe.xadd(LEDGER_STREAM_KEY, {"user_id": session.user_id, "kind": "spin", "bid": bid, "payout": returned,
+                                      "dice": value, "balance": running})
+    if refund:
+        pipe.xadd(LEDGER_STREAM_KEY, {"user_id": session.user_id, "kind": "refund", "bid": 0, "payout": refund,
+                                      "dice": "", "balance": balance})
+    await pipe.execute()
+    return balance
+
+
+autospin_runner = AutospinRunner()
@@ -0,0 +1,111 @@
+"""
+In-process blacklist cache shared between bot processes.
+
+This module defines the BlacklistCache class, which:
+- Loads blacklisted user IDs from the database into memory on startup
+- Mirrors them in a Redis set
+- Propagates changes to all bot processes through Redis pub/sub
+
+Membership checks are served from memory, so the rate limiter does not query
+the database for every update.
+"""
+
+import asyncio
+from loguru import logger
+
+from app.cache.redis_logic import redis_client
+import app.database.requests as db
+
+BLACKLIST_KEY = "blacklist"
+BLACKLIST_CHANNEL = "blacklist:updates"
+
+
+class BlacklistCache():
+    '''Blacklist membership cache with cross-process invalidation.'''
+
+    def __init__(self):
+        '''Initialize an empty cache.'''
+        self.user_ids: set[int] = set()
+        self._listener: asyncio.Task | None = None
+
+    def __contains__(self, user_id: int) -> bool:
+        return int(user_id) in self.user_ids
+
+    async def load(self) -> None:
+        '''Fill the cache from database and Redis and start listening for changes.
+
+        return:
+            None
+        '''
+        user_ids = set(await db.get_blacklisted_user_ids())
+        if user_ids:
+            await redis_client.sadd(BLACKLIST_KEY, *user_ids)
+        await self.reload()
+        if self._listener is None:
+            self._listener = asyncio.create_task(self._listen())
+        logger.info(f"Loaded {len(self.user_ids)} blacklisted users")
+
+    async def reload(self) -> None:
+        '''Replace the cache content with the Redis set.'''
+        self.user_ids = {int(user_id) for user_id in await redis_client.smembers(BLACKLIST_KEY)}
+
+    async def add(self, user_id: int) -> None:
+        '''Add a user to the cache and notify other processes.
+
+        args:
+            user_id (int): Telegram User ID
+
+        return:
+            None
+        '''
+        self.user_ids.add(int(user_id))
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.sadd(BLACKLIST_KEY, user_id)
+        pipe.publish(BLACKLIST_CHANNEL, f"+{user_id}")
+        await pipe.execute()
+
+    async def remove(self, user_id: int) -> None:
+        '''Remove a user from the cache and notify other processes.
+
+        args:
+            user_id (int): Telegram User ID
+
+        return:
+            None
+        '''
+        self.user_ids.discard(int(user_id))
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.srem(BLACKLIST_KEY, user_id)
+        pipe.publish(BLACKLIST_CHANNEL, f"-{user_id}")
+        await pipe.execute()
+
+    def apply(self, message: str) -> None:
+        '''Apply a change published by another process.
+
+        args:
+            message (str): "+<user_id>" to add or "-<user_id>" to remove
+        '''
+        if message.startswith("+"):
+            self.user_ids.add(int(message[1:]))
+        elif message.startswith("-"):
+            self.user_ids.discard(int(message[1:]))
+
+    async def _listen(self) -> None:
+        '''Apply published changes, reloading the whole set after reconnects.'''
+        while True:
+            try:
+                async with redis_client.pubsub() as pubsub:
+                    await pubsub.subscribe(BLACKLIST_CHANNEL)
+                    # Changes published while unsubscribed are only visible in the Redis set
+                    await self.reload()
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            self.apply(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Blacklist listener failed: {e}")
+                await asyncio.sleep(1)
+
+
+blacklist = BlacklistCache()
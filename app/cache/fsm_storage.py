@@ -0,0 +1,89 @@
+"""
+Redis FSM storage colocated with user sessions.
+
+This module defines the SessionStorage class, an aiogram FSM storage which:
+- Keeps state and data as the `s` and `d` fields of the `user_session:{user_id}` hash
+- Uses the shared redis_client connection pool
+- Expires FSM fields together with the session key (SESSION_TTL)
+- Reads state and data from the in-process session cache when it is running, so the
+  state read of every update costs no round trip until the session changes
+
+FSM state survives restarts and is shared between bot replicas.
+"""
+
+import json
+from typing import Any, Dict, Mapping, Optional
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType, DEFAULT_DESTINY
+
+from app.cache.redis_logic import redis_client, session_cache, SESSION_TTL
+
+
+class SessionStorage(BaseStorage):
+    '''FSM storage keeping state and data in the user session hash.'''
+
+    def __init__(self, client=redis_client, ttl: int = SESSION_TTL):
+        '''Initialize storage.
+
+        args:
+            client (redis.asyncio.Redis): Redis client, the shared session client by default
+            ttl (int): TTL of the session key in seconds, set only if the key has none yet
+        '''
+        self.client = client
+        self.ttl = ttl
+
+    @staticmethod
+    def build_fields(key: StorageKey) -> tuple[str, str, str]:
+        '''Build session key and field names for a storage key.
+
+        Private chats with the default destiny use plain `s`/`d` fields, see SESSION_LAYOUT.
+
+        args:
+            key (StorageKey): FSM storage key
+
+        return:
+            tuple[str, str, str]: (session key, state field, data field)
+        '''
+        suffix = ""
+        if key.chat_id != key.user_id or key.thread_id or key.business_connection_id or key.destiny != DEFAULT_DESTINY:
+            suffix = f":{key.business_connection_id or ''}:{key.chat_id}:{key.thread_id or ''}:{key.destiny}"
+        return f"user_session:{key.user_id}", f"s{suffix}", f"d{suffix}"
+
+    async def _set_field(self, name: str, field: str, value: str | None) -> None:
+        '''Set or delete a field, the TTL of the session key is refreshed by session scripts.'''
+        session_cache.invalidate(name)
+        if value is None:
+            await self.client.hdel(name, field)
+            return
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hset(name, field, value)
+        # A key created by this write must expire too
+        pipe.expire(name, self.ttl, nx=True)
+        await pipe.execute()
+
+    async def _get_field(self, name: str, field: str) -> str | None:
+        '''Get a field, from the whole session hash kept by the session cache if it is running.'''
+        if session_cache.ready:
+            return (await session_cache.get(name, lambda: self.client.hgetall(name))).get(field)
+        return await self.client.hget(name, field)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        name, state_field, _ = self.build_fields(key)
+        await self._set_field(name, state_field, state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        name, state_field, _ = self.build_fields(key)
+        return await self._get_field(name, state_field)
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        name, _, data_field = self.build_fields(key)
+        await self._set_field(name, data_field, json.dumps(data) if data else None)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        name, _, data_field = self.build_fields(key)
+        value = await self._get_field(name, data_field)
+        return json.loads(value) if value else {}
+
+    async def close(self) -> None:
+        '''Connection pool is shared with sessions and closed with them.'''
+        pass
@@ -0,0 +1,174 @@
+"""
+Leaderboard of players by balance on a Redis sorted set.
+
+This module defines the Leaderboard class, which:
+- Reads the `leaderboard` sorted set, updated by the session Lua scripts on every balance change
+- Serves paginated top-N pages and O(log N) rank lookups with ZREVRANGE and ZREVRANK
+- Keeps display names of players in the `leaderboard:names` hash
+- Rebuilds the sorted set from the database to correct drift, e.g. after Redis data loss,
+  and drops names of players no longer ranked
+- Caches the rendered top page in memory for LEADERBOARD_CACHE_TTL seconds
+"""
+
+import os
+import time
+from aiogram import html
+from dotenv import load_dotenv
+from loguru import logger
+
+from app.cache.redis_logic import (redis_client, LEADERBOARD_KEY, DIRTY_SESSIONS_KEY, SYNCING_SESSIONS_KEY,
+                                   local_dirty_user_ids)
+import app.database.requests as db
+
+load_dotenv()
+
+LEADERBOARD_NAMES_KEY = "leaderboard:names"
+LEADERBOARD_REBUILD_KEY = "leaderboard:rebuild"
+LEADERBOARD_PAGE_SIZE = int(os.getenv("LEADERBOARD_PAGE_SIZE") or 10)
+LEADERBOARD_CACHE_TTL = float(os.getenv("LEADERBOARD_CACHE_TTL") or 10)
+LEADERBOARD_REBUILD_INTERVAL = int(os.getenv("LEADERBOARD_REBUILD_INTERVAL") or 3600)
+
+# Sets the score of every user ARGV[i] in the sorted set KEYS[1] to the balance of their
+# session KEYS[i + 1], skipping missing sessions.
+OVERLAY_BALANCES_LUA = """
+for i = 2, #KEYS do
+    local coins = redis.call('HGET', KEYS[i], 'c')
+    if coins then
+        redis.call('ZADD', KEYS[1], coins, ARGV[i - 1])
+    end
+end
+"""
+
+overlay_balances_script = redis_client.register_script(OVERLAY_BALANCES_LUA)
+
+
+class Leaderboard():
+    '''Top players and ranks by balance.'''
+
+    def __init__(self):
+        '''Initialize with an empty page cache.'''
+        # Rendered top page: (expiry time, text, number of pages)
+        self.top_page_cache: tuple[float, str, int] | None = None
+
+    async def set_name(self, user_id: int, name: str) -> None:
+        '''Remember the display name of a player.
+
+        args:
+            user_id (int): Telegram User ID
+            name (str): Display name
+        '''
+        await redis_client.hset(LEADERBOARD_NAMES_KEY, str(user_id), name)
+
+    async def remove(self, user_id: int) -> None:
+        '''Remove a player, e.g. a blacklisted one.
+
+        args:
+            user_id (int): Telegram User ID
+        '''
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.zrem(LEADERBOARD_KEY, user_id)
+        pipe.hdel(LEADERBOARD_NAMES_KEY, str(user_id))
+        await pipe.execute()
+
+    async def get_rank(self, user_id: int) -> tuple[int | None, int]:
+        '''Get the rank of a player in one round trip.
+
+        args:
+            user_id (int): Telegram User ID
+
+        return:
+            tuple[int | None, int]: (1-based rank or None if the player is not ranked, number of players)
+        '''
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.zrevrank(LEADERBOARD_KEY, user_id)
+        pipe.zcard(LEADERBOARD_KEY)
+        rank, total = await pipe.execute()
+        return (rank + 1 if rank is not None else None), total
+
+    async def get_page(self, page: int) -> tuple[list[tuple[int, str, int]], int]:
+        '''Get one page of the top players.
+
+        args:
+            page (int): 0-based page number
+
+        return:
+            tuple[list[tuple[int, str, int]], int]: ([(rank, name, coins)], number of pages)
+        '''
+        start = page * LEADERBOARD_PAGE_SIZE
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.zrevrange(LEADERBOARD_KEY, start, start + LEADERBOARD_PAGE_SIZE - 1, withscores=True)
+        pipe.zcard(LEADERBOARD_KEY)
+        players, total = await pipe.execute()
+        names = await redis_client.hmget(LEADERBOARD_NAMES_KEY, [user_id for user_id, _ in players]) if players else []
+        rows = [(start + position + 1, name or f"Player {str(user_id)[-4:]}", int(coins))
+                for position, ((user_id, coins), name) in enumerate(zip(players, names))]
+        return rows, max(1, -(-total // LEADERBOARD_PAGE_SIZE))
+
+    async def render_page(self, page: int) -> tuple[str, int]:
+        '''Render a page as HTML, the top page is served from cache.
+
+        args:
+            page (int): 0-based page number
+
+        return:
+            tuple[str, int]: (text, number of pages)
+        '''
+        if page == 0 and self.top_page_cache and self.top_page_cache[0] > time.monotonic():
+            return self.top_page_cache[1], self.top_page_cache[2]
+        rows, pages = await self.get_page(page)
+        lines = [f'{rank}. {html.quote(name)} — {coins} 🪙' for rank, name, coins in rows] or ["No players yet"]
+        text = f'{html.bold("Leaderboard")} 🏆\n\n' + "\n".join(lines) + f'\n\nPage {page + 1} of {pages}'
+        if page == 0:
+            self.top_page_cache = (time.monotonic() + LEADERBOARD_CACHE_TTL, text, pages)
+        return text, pages
+
+    async def rebuild(self) -> int:
+        '''Rebuild the sorted set from the database and swap it in atomically.
+
+        Balances of sessions which are not saved yet are applied on top after the swap,
+        as the database lags behind them and the scripts changing them meanwhile update
+        the replaced set. Each balance is read and applied atomically, so a newer one is
+        never overwritten. Names of players no longer ranked are dropped.
+
+        return:
+            int: Number of ranked players
+        '''
+        started = time.perf_counter()
+        await redis_client.delete(LEADERBOARD_REBUILD_KEY)
+        async for batch in db.iterate_users_coins():
+            await redis_client.zadd(LEADERBOARD_REBUILD_KEY, dict(batch))
+
+        if await redis_client.zcard(LEADERBOARD_REBUILD_KEY):
+            await redis_client.rename(LEADERBOARD_REBUILD_KEY, LEADERBOARD_KEY)
+
+        unsaved = {int(user_id) for user_id in await redis_client.sunion(DIRTY_SESSIONS_KEY, SYNCING_SESSIONS_KEY)}
+        user_ids = list(unsaved.union(local_dirty_user_ids))
+        for start in range(0, len(user_ids), 1000):
+            chunk = user_ids[start:start + 1000]
+            await overlay_balances_script(keys=[LEADERBOARD_KEY] + [f"user_session:{user_id}" for user_id in chunk],
+                                          args=chunk)
+
+        async for names in self._scan_names():
+            scores = await redis_client.zmscore(LEADERBOARD_KEY, names)
+            unranked = [user_id for user_id, score in zip(names, scores) if score is None]
+            if unranked:
+                await redis_client.hdel(LEADERBOARD_NAMES_KEY, *unranked)
+
+        total = await redis_client.zcard(LEADERBOARD_KEY)
+        self.top_page_cache = None
+        logger.info(f"Leaderboard rebuilt from database: {total} players in {time.perf_counter() - started:.2f}s")
+        return total
+
+    async def _scan_names(self, batch_size: int = 1000):
+        '''Iterate over the user IDs of the names hash in batches.'''
+        batch = []
+        async for user_id, _ in redis_client.hscan_iter(LEADERBOARD_NAMES_KEY, count=batch_size):
+            batch.append(user_id)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+leaderboard = Leaderboard()
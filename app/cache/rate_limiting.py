@@ -0,0 +1,136 @@
+"""
+Rate limiting algorithms executed atomically in Redis.
+
+This module provides:
+- FixedWindow: counter that resets every period
+- SlidingWindowLog: sorted set of request timestamps within the last period
+- TokenBucket: bucket of MESSAGES_PER_PERIOD tokens refilled continuously over the period
+
+Every algorithm is a Lua function `rate_limit(key, period, limit, token)` returning
+the excess: how many requests over the limit were made (0 means the request is allowed).
+The function is embedded into the per-update session script, so limiting costs no
+extra round trip, and can also be run standalone with `hit`.
+"""
+
+import os
+import uuid
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class RateLimitAlgorithm():
+    '''Base class for rate limiting algorithms.'''
+
+    name = ""
+    lua = ""
+
+    def __init__(self):
+        self._script = None
+
+    def standalone_lua(self) -> str:
+        '''Script running only the rate limiting function.
+
+        return:
+            str: Lua script with KEYS[1] = limiter key, ARGV = period, limit, token
+        '''
+        return self.lua + "\nreturn rate_limit(KEYS[1], tonumber(ARGV[1]), tonumber(ARGV[2]), ARGV[3])\n"
+
+    async def hit(self, client, user_id: int, period: int, limit: int) -> int:
+        '''Register a request outside of the session script.
+
+        args:
+            client (redis.asyncio.Redis): Redis client
+            user_id (int): Telegram User ID
+            period (int): Rate limiting period in seconds
+            limit (int): Allowed requests per period
+
+        return:
+            int: Excess over the limit, 0 if the request is allowed
+        '''
+        if self._script is None:
+            self._script = client.register_script(self.standalone_lua())
+        return int(await self._script(keys=[rate_limit_key(user_id)], args=[period, limit, uuid.uuid4().hex], client=client))
+
+
+class FixedWindow(RateLimitAlgorithm):
+    '''Counter that expires one period after the first request.'''
+
+    name = "fixed_window"
+    lua = """
+local function rate_limit(key, period, limit, token)
+    local count = redis.call('INCR', key)
+    if count == 1 then
+        redis.call('EXPIRE', key, period)
+    end
+    return math.max(count - limit, 0)
+end
+"""
+
+
+class SlidingWindowLog(RateLimitAlgorithm):
+    '''Sorted set of request timestamps (microseconds) from the last period.'''
+
+    name = "sliding_window"
+    lua = """
+local function rate_limit(key, period, limit, token)
+    local time = redis.call('TIME')
+    local now = tonumber(time[1]) * 1000000 + tonumber(time[2])
+    redis.call('ZREMRANGEBYSCORE', key, 0, now - period * 1000000)
+    redis.call('ZADD', key, now, token)
+    redis.call('EXPIRE', key, period)
+    return math.max(redis.call('ZCARD', key) - limit, 0)
+end
+"""
+
+
+class TokenBucket(RateLimitAlgorithm):
+    '''Bucket of `limit` tokens refilled at `limit / period` tokens per second.
+
+    Rejected requests still take a token, so the bucket goes into debt and the
+    excess grows while the user keeps flooding.
+    '''
+
+    name = "token_bucket"
+    lua = """
+local function rate_limit(key, period, limit, token)
+    local time = redis.call('TIME')
+    local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+    local rate = limit / period
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or limit
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(limit, tokens + (now - ts) * rate) - 1
+    redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('EXPIRE', key, math.ceil((limit - tokens) / rate))
+    if tokens >= 0 then
+        return 0
+    end
+    return math.ceil(-tokens)
+end
+"""
+
+
+ALGORITHMS = {algorithm.name: algorithm for algorithm in (FixedWindow, SlidingWindowLog, TokenBucket)}
+
+
+def rate_limit_key(user_id: int) -> str:
+    '''Redis key holding the rate limiting state of a user.'''
+    return f"rate_limit:{user_id}"
+
+
+def get_algorithm(name: str) -> RateLimitAlgorithm:
+    '''Create a rate limiting algorithm by name.
+
+    args:
+        name (str): One of "fixed_window", "sliding_window", "token_bucket"
+
+    return:
+        RateLimitAlgorithm: Algorithm instance
+    '''
+    if name not in ALGORITHMS:
+        raise ValueError(f"Unknown rate limiting algorithm {name!r}, expected one of: {', '.join(ALGORITHMS)}")
+    return ALGORITHMS[name]()
+
+
+rate_limit_algorithm = get_algorithm(os.getenv("RATE_LIMITING_ALGORITHM") or "fixed_window")
@@ -6,28 +6,315 @@ This module defines the UserSession class, which handles:
 - Storing and updating user authorization status
 - Managing user coins
 - Handling message rate limiting
-
-All data is stored in Redis hashes with expiration.
+- Tracking sessions with unsaved changes in a dirty set, and the ones changed by this process locally
+- Handling a whole update in one round trip with a server-side Lua script
+- Atomic credit of coins for top-ups
+- Debiting a spin or an autospin together with a pending record in Redis, which is its
+  one-per-user lock and lets the sync leader settle it if the process playing it stops,
+  and settling all its spins with one script call
+- Appending spin outcomes and top-ups to the ledger stream atomically with the balance change
+- Updating the leaderboard sorted set in the same script as every balance change
+- Recording the expiry deadline of every session whenever its TTL is set, so the worker
+  persists changed sessions before they expire
+- A bounded connection pool with checkout statistics and a startup warm-up
+- Converting sessions of the legacy layout to the compact one on first access
+- Optionally serving repeated FSM state and data reads of SessionStorage from an in-process
+  cache (app.cache.session_cache)
+
+Sessions are compact Redis hashes expiring as a whole, see SESSION_LAYOUT.
 """
 
+import asyncio
 import os
-from datetime import datetime
+import uuid
+from collections import Counter
 import redis.asyncio as redis
 from dotenv import load_dotenv
+from loguru import logger
+
+from app.cache.rate_limiting import rate_limit_algorithm, rate_limit_key
+from app.cache.session_cache import SessionCache
+from app.pools import PoolStats
+from app import metrics
 
 load_dotenv()
 
 RATE_LIMITING_PERIOD = int(os.getenv("RATE_LIMITING_PERIOD"))
-
-redis_client = redis.Redis(
+MESSAGES_PER_PERIOD = int(os.getenv("MESSAGES_PER_PERIOD"))
+SESSION_TTL = 1800
+# TTL is refreshed only when less than this many seconds are left, so most updates do not write it
+SESSION_TTL_REFRESH_THRESHOLD = int(os.getenv("SESSION_TTL_REFRESH_THRESHOLD") or SESSION_TTL // 2)
+# Fields of the `user_session:{user_id}` hash. Short names and integer values keep
+# the hash listpack-encoded, and the whole key expires after SESSION_TTL.
+SESSION_LAYOUT = {
+    "c": "coins",
+    "a": "authorized, 0 or 1",
+    "s": "FSM state of SessionStorage, `s:{suffix}` for non-default storage keys",
+    "d": "FSM data of SessionStorage, `d:{suffix}` for non-default storage keys",
+}
+
+# IDs of users whose sessions changed since the last sync with database
+DIRTY_SESSIONS_KEY = "user_sessions:dirty"
+# Dirty IDs taken by a running sync pass, kept until they are saved
+SYNCING_SESSIONS_KEY = "user_sessions:syncing"
+# Stream of spin outcomes and top-ups, written to the database by app.ledger
+LEDGER_STREAM_KEY = "ledger:entries"
+# Sorted set of user IDs scored by the Unix time their session expires at, updated whenever TTL is set
+SESSION_DEADLINES_KEY = "user_sessions:deadlines"
+# Sorted set of user IDs scored by balance, read by app.cache.leaderboard
+LEADERBOARD_KEY = "leaderboard"
+# Sorted set of user IDs with a pending autospin record, scored by the Unix time of its last spin
+AUTOSPINS_KEY = "autospins:pending"
+# IDs of users whose sessions this process changed, each process flushes only them on shutdown.
+# Counts changes, so IDs are pruned once saved by the leader only if they were not changed meanwhile
+local_dirty_user_ids: Counter[int] = Counter()
+
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS") or 50)
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT") or 10)
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL") or 30)
+REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT") or 5)
+REDIS_WARM_CONNECTIONS = int(os.getenv("REDIS_WARM_CONNECTIONS") or 10)
+
+SESSION_CACHE_ENABLED = (os.getenv("SESSION_CACHE_ENABLED") or "false").lower() == "true"
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE") or 10000)
+
+redis_pool_stats = PoolStats("Redis")
+metrics.register_stats("bot_pool", redis_pool_stats.get_stats, {"pool": "redis"})
+
+# Serves FSM reads of SessionStorage only after `session_cache.start` in main, when SESSION_CACHE_ENABLED
+session_cache = SessionCache("user_session:", SESSION_CACHE_SIZE)
+metrics.register_stats("bot_session_cache", session_cache.get_stats)
+
+
+class InstrumentedConnectionPool(redis.BlockingConnectionPool):
+    '''Blocking pool recording checkout counts and time spent waiting for a connection.
+
+    Unlike the default pool it waits up to REDIS_POOL_TIMEOUT for a free connection
+    instead of failing once REDIS_MAX_CONNECTIONS are in use.
+    '''
+
+    async def get_connection(self, *args, **kwargs):
+        with redis_pool_stats.measure():
+            return await super().get_connection(*args, **kwargs)
+
+
+redis_client = redis.Redis(connection_pool=InstrumentedConnectionPool(
     host=os.getenv("REDIS_HOST"),
     port=int(os.getenv("REDIS_PORT")),
     username=os.getenv("REDIS_USER"),
     password=os.getenv("REDIS_PASSWORD"),
-    decode_responses=True
-)
+    decode_responses=True,
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT,
+    health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+    socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+))
+
+# Functions shared by session scripts:
+# - load_session returns whether the session exists. A session of the legacy layout
+#   (long field names, string timestamp, per-field HEXPIRE) is converted to SESSION_LAYOUT
+#   on first access, so sessions survive an upgrade without downtime. The timestamp, which
+#   nothing reads, is dropped. The converted key has no TTL until refresh_ttl is called.
+# - refresh_ttl sets the TTL of the whole key only when less than `threshold` seconds are left,
+#   and records the new expiry deadline of `member` in the `deadlines` sorted set.
+SESSION_LUA = """
+local function load_session(key)
+    if redis.call('HEXISTS', key, 'c') == 1 then
+        return true
+    end
+    local legacy = redis.call('HGETALL', key)
+    local fields, coins = {}, nil
+    for i = 1, #legacy, 2 do
+        local name, value = legacy[i], legacy[i + 1]
+        if name == 'coins' then
+            coins = value
+        elseif name == 'authorized' then
+            table.insert(fields, 'a')
+            table.insert(fields, value)
+        elseif name:sub(1, 9) == 'fsm_state' then
+            table.insert(fields, 's' .. name:sub(10))
+            table.insert(fields, value)
+        elseif name:sub(1, 8) == 'fsm_data' then
+            table.insert(fields, 'd' .. name:sub(9))
+            table.insert(fields, value)
+        end
+    end
+    if not coins then
+        return false
+    end
+    redis.call('DEL', key)
+    redis.call('HSET', key, 'c', coins, unpack(fields))
+    return true
+end
+
+local function refresh_ttl(key, ttl, threshold, deadlines, member)
+    if redis.call('TTL', key) < tonumber(threshold) then
+        redis.call('EXPIRE', key, ttl)
+        redis.call('ZADD', deadlines, tonumber(redis.call('TIME')[1]) + tonumber(ttl), member)
+    end
+end
+"""
+
+# Ensures the session (creating it from ARGV[7..] if given and adding it to the leaderboard KEYS[4]),
+# applies the configured rate limiting algorithm, authorizes the user and refreshes TTL
+# ARGV[3] if less than ARGV[4] seconds are left, recording the deadline in KEYS[5].
+# Returns {excess over rate limit, coins} or nil if session is missing.
+HANDLE_UPDATE_LUA = rate_limit_algorithm.lua + SESSION_LUA + """
+local key = KEYS[1]
+if not load_session(key) then
+    if #ARGV < 7 then
+        return false
+    end
+    redis.call('HSET', key, unpack(ARGV, 7))
+    redis.call('ZADD', KEYS[4], redis.call('HGET', key, 'c'), ARGV[1])
+end
+local excess = rate_limit(KEYS[3], tonumber(ARGV[2]), tonumber(ARGV[5]), ARGV[6])
+if redis.call('HGET', key, 'a') ~= '1' then
+    redis.call('HSET', key, 'a', 1)
+    redis.call('SADD', KEYS[2], ARGV[1])
+end
+refresh_ttl(key, ARGV[3], ARGV[4], KEYS[5], ARGV[1])
+return {excess, tonumber(redis.call('HGET', key, 'c'))}
+"""
+
+# Ensures the session KEYS[1] of user ARGV[3] is in the compact layout and refreshes TTL ARGV[1]
+# if less than ARGV[2] seconds are left, recording the deadline in KEYS[2].
+# Returns coins or nil if session is missing.
+TOUCH_LUA = SESSION_LUA + """
+if not load_session(KEYS[1]) then
+    return false
+end
+refresh_ttl(KEYS[1], ARGV[1], ARGV[2], KEYS[2], ARGV[3])
+return tonumber(redis.call('HGET', KEYS[1], 'c'))
+"""
+
+# Debits ARGV[2] spins of ARGV[3] coins if the balance allows it and no autospin of the user
+# is pending, records autospin ARGV[4] in KEYS[4] and its start time in KEYS[5], and updates
+# the leaderboard KEYS[3]. Returns {1, new balance} on success, {0, balance} if the balance is
+# insufficient, {-1, balance} if an autospin is pending, or nil if session is missing.
+START_AUTOSPIN_LUA = """
+local coins = tonumber(redis.call('HGET', KEYS[1], 'c'))
+if not coins then
+    return false
+end
+if redis.call('EXISTS', KEYS[4]) == 1 then
+    return {-1, coins}
+end
+local amount = tonumber(ARGV[2]) * tonumber(ARGV[3])
+if amount <= 0 or coins < amount then
+    return {0, coins}
+end
+redis.call('SADD', KEYS[2], ARGV[1])
+local balance = redis.call('HINCRBY', KEYS[1], 'c', -amount)
+redis.call('ZADD', KEYS[3], balance, ARGV[1])
+redis.call('HSET', KEYS[4], 'id', ARGV[4], 'n', ARGV[2], 'b', ARGV[3], 'd', '')
+redis.call('ZADD', KEYS[5], redis.call('TIME')[1], ARGV[1])
+return {1, balance}
+"""
+
+# Stores the comma-separated dice values ARGV[2] played so far by autospin ARGV[1] of user ARGV[3]
+# in its record KEYS[1] and the time in KEYS[2]. Returns 1, or 0 if the autospin was settled meanwhile.
+RECORD_AUTOSPIN_LUA = """
+if redis.call('HGET', KEYS[1], 'id') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'd', ARGV[2])
+redis.call('ZADD', KEYS[2], redis.call('TIME')[1], ARGV[3])
+return 1
+"""
+
+# Credits ARGV[2] coins and, if ARGV[3] is given, records the credit in the ledger
+# stream KEYS[3] as an entry of kind ARGV[3]. Updates the leaderboard KEYS[4].
+# Returns new balance or nil if session is missing.
+ADD_COINS_LUA = """
+if redis.call('HEXISTS', KEYS[1], 'c') == 0 then
+    return false
+end
+redis.call('SADD', KEYS[2], ARGV[1])
+local balance = redis.call('HINCRBY', KEYS[1], 'c', ARGV[2])
+redis.call('ZADD', KEYS[4], balance, ARGV[1])
+if ARGV[3] then
+    redis.call('XADD', KEYS[3], '*', 'user_id', ARGV[1], 'kind', ARGV[3], 'bid', 0, 'payout', ARGV[2], 'dice', '', 'balance', balance)
+end
+return balance
+"""
+
+# Settles autospin ARGV[4] whose bids ARGV[2] each were already debited: credits the payouts,
+# records every spin in the ledger stream KEYS[3], then returns ARGV[3] coins of spins which
+# did not happen, recorded as a separate refund entry, and deletes the autospin record KEYS[5]
+# and its entry in KEYS[6]. ARGV[5..] are dice value and payout pairs. Updates the leaderboard
+# KEYS[4]. Returns new balance, or nil if session is missing or the autospin was settled already.
+SETTLE_SPINS_LUA = """
+if redis.call('HGET', KEYS[5], 'id') ~= ARGV[4] then
+    return false
+end
+local coins = tonumber(redis.call('HGET', KEYS[1], 'c'))
+if not coins then
+    return false
+end
+redis.call('DEL', KEYS[5])
+redis.call('ZREM', KEYS[6], ARGV[1])
+local balance = coins
+for i = 5, #ARGV, 2 do
+    balance = balance + tonumber(ARGV[i + 1])
+    redis.call('XADD', KEYS[3], '*', 'user_id', ARGV[1], 'kind', 'spin', 'bid', ARGV[2], 'payout', ARGV[i + 1], 'dice', ARGV[i], 'balance', balance)
+end
+local refund = tonumber(ARGV[3])
+if refund > 0 then
+    balance = balance + refund
+    redis.call('XADD', KEYS[3], '*', 'user_id', ARGV[1], 'kind', 'refund', 'bid', 0, 'payout', refund, 'dice', '', 'balance', balance)
+end
+if balance ~= coins then
+    redis.call('SADD', KEYS[2], ARGV[1])
+    redis.call('HINCRBY', KEYS[1], 'c', balance - coins)
+end
+redis.call('ZADD', KEYS[4], balance, ARGV[1])
+return balance
+"""
+
+# EVALSHA with automatic reload if the script cache was flushed
+handle_update_script = redis_client.register_script(HANDLE_UPDATE_LUA)
+touch_script = redis_client.register_script(TOUCH_LUA)
+start_autospin_script = redis_client.register_script(START_AUTOSPIN_LUA)
+record_autospin_script = redis_client.register_script(RECORD_AUTOSPIN_LUA)
+add_coins_script = redis_client.register_script(ADD_COINS_LUA)
+settle_spins_script = redis_client.register_script(SETTLE_SPINS_LUA)
+
+
+async def load_scripts() -> None:
+    '''Load Lua scripts into the Redis script cache.'''
+    for script in (HANDLE_UPDATE_LUA, TOUCH_LUA, START_AUTOSPIN_LUA, RECORD_AUTOSPIN_LUA, ADD_COINS_LUA,
+                   SETTLE_SPINS_LUA):
+        await redis_client.script_load(script)
+
 
+async def migrate_sessions(user_ids: list[int]) -> None:
+    '''Convert sessions of the legacy layout to SESSION_LAYOUT in one pipelined round trip.
 
+    Sessions already in the compact layout are left unchanged, including their TTL.
+
+    args:
+        user_ids (list[int]): Telegram User IDs
+    '''
+    pipe = redis_client.pipeline(transaction=False)
+    for user_id in user_ids:
+        await touch_script(keys=[f"user_session:{user_id}", SESSION_DEADLINES_KEY], args=[SESSION_TTL, 0, user_id],
+                           client=pipe)
+    await pipe.execute()
+
+
+async def warm_redis_pool() -> None:
+    '''Open REDIS_WARM_CONNECTIONS connections with concurrent PINGs.
+
+    Fails startup early if Redis is unreachable and saves first handlers
+    from paying for connection setup.
+    '''
+    count = min(REDIS_WARM_CONNECTIONS, REDIS_MAX_CONNECTIONS)
+    await asyncio.gather(*(redis_client.ping() for _ in range(count)))
+    logger.info(f"Warmed {count} connections, {redis_pool_stats}")
+
+
+@metrics.timed_methods(metrics.redis_latency)
 class UserSession():
     '''User session manager for Redis.'''
 
@@ -38,110 +325,113 @@ class UserSession():
             user_id (int | None): Telegram User ID
         '''
         self.user_id = int(user_id)
+        self.key = f"user_session:{self.user_id}"
+        self.autospin_key = f"autospin:{self.user_id}"
+
+    async def handle_update(self, authorized_user=None, create: bool = False) -> tuple[int, int] | None:
+        '''Register an incoming update in a single round trip.
 
-    async def ensure_session(self, authorized_user=None) -> None:
-        '''Ensure a session existence.
+        Applies rate limiting, authorizes the user and refreshes TTL.
 
         args:
-            authorized_user (object | None): Database user object for initialization
+            authorized_user (object | None): Database user object used when creating the session
+            create (bool): Create the session if it does not exist
 
         return:
-            None
+            tuple[int, int] | None: (excess over rate limit, coins) or None if session does not exist
         '''
-        exists = await redis_client.exists(f"user_session:{self.user_id}")
-        if not exists:
+        args = [self.user_id, RATE_LIMITING_PERIOD, SESSION_TTL, SESSION_TTL_REFRESH_THRESHOLD, MESSAGES_PER_PERIOD, uuid.uuid4().hex]
+        if create:
             if authorized_user:
-                await self.init_instance_from_db(authorized_user)
+                args += ["a", 1, "c", authorized_user.coins]
             else:
-                await self.init_instance_from_scratch()
-
-    async def touch(self) -> None:
-        '''Refresh TTL'''
-        await redis_client.hexpire(f"user_session:{self.user_id}", 1800, "id", "user_id", "authorized", "coins", "timestamp")
-
-    async def init_instance_from_scratch(self) -> None:
-        '''Create a new session with default values.'''
-        await redis_client.hset(f"user_session:{self.user_id}", mapping={
-            "id": await redis_client.hincrby(f"user_session:{self.user_id}", "id"),
-            "user_id": self.user_id,
-            "messages": 0,
-            "authorized": 0,
-            "coins": 1000,
-            "timestamp": str(datetime.now())
-        })
-        await self.touch()
-
-    async def init_instance_from_db(self, authorized_user) -> None:
-        '''Initialize session from a database user object.
+                args += ["a", 0, "c", 1000]
+        keys = [self.key, DIRTY_SESSIONS_KEY, rate_limit_key(self.user_id), LEADERBOARD_KEY, SESSION_DEADLINES_KEY]
+        result = await handle_update_script(keys=keys, args=args)
+        if result is None:
+            return None
+        if create:
+            session_cache.invalidate(self.key)
+            local_dirty_user_ids[self.user_id] += 1
+        excess, coins = result
+        return int(excess), int(coins) if coins is not None else 0
+
+    async def start_autospin(self, autospin_id: str, count: int, bid: int) -> tuple[int, int] | None:
+        '''Atomically debit the bids of an autospin and record it as pending, one autospin per user.
+
+        A single spin is played as an autospin of one spin.
 
         args:
-            authorized_user (object): User from database
+            autospin_id (str): Unique ID of the autospin
+            count (int): Number of spins
+            bid (int): Bid of every spin
 
         return:
-            None
+            tuple[int, int] | None: (1, new balance) if started, (0, balance) if the balance is insufficient,
+            (-1, balance) if another autospin of the user is pending, or None if session is missing
         '''
-        await redis_client.hset(f"user_session:{self.user_id}", mapping={
-            "id": authorized_user.id,
-            "user_id": authorized_user.user_id,
-            "messages": 0,
-            "authorized": 1,
-            "coins": authorized_user.coins,
-            "timestamp": str(authorized_user.timestamp)
-        })
-        await self.touch()
-
-    async def get_instance(self) -> dict:
-        '''Get the current session data.
+        keys = [self.key, DIRTY_SESSIONS_KEY, LEADERBOARD_KEY, self.autospin_key, AUTOSPINS_KEY]
+        result = await start_autospin_script(keys=keys, args=[self.user_id, count, bid, autospin_id])
+        if result is None:
+            return None
+        status, balance = int(result[0]), int(result[1])
+        if status == 1:
+            session_cache.invalidate(self.key)
+            local_dirty_user_ids[self.user_id] += 1
+        return status, balance
+
+    async def record_autospin(self, autospin_id: str, dice_values: list[int]) -> bool:
+        '''Store the dice values played so far by a pending autospin.
 
-        return:
-            dict: Session data from Redis
-        '''
-        return await redis_client.hgetall(f"user_session:{self.user_id}")
-
-    async def handle_messages(self):
-        '''Increment message counter.
+        args:
+            autospin_id (str): ID given to start_autospin
+            dice_values (list[int]): Values of all dice sent so far
 
         return:
-            int: Current message count
+            bool: False if the autospin was settled meanwhile, e.g. by the sync leader
         '''
-        await redis_client.hexpire(f"user_session:{self.user_id}", RATE_LIMITING_PERIOD, "messages")
-        value = await redis_client.hincrby(f"user_session:{self.user_id}", "messages")
-        return int(value) if value else 0
+        args = [autospin_id, ",".join(map(str, dice_values)), self.user_id]
+        return bool(await record_autospin_script(keys=[self.autospin_key, AUTOSPINS_KEY], args=args))
 
-    async def authorize_user(self) -> int:
-        '''Mark user as authorized in session.'''
-        await redis_client.hset(f"user_session:{self.user_id}", "authorized", "1")
+    async def add_coins(self, coins_amount: int, ledger_kind: str | None = None) -> int | None:
+        '''Atomically credit coins.
 
-    async def check_authorization_status(self):
-        '''Check if user is authorized.
-
-        return:
-            int: 1 if authorized, 0 if not
-        '''
-        value = await redis_client.hget(f"user_session:{self.user_id}", "authorized")
-        return int(value) if value else 0
-
-    async def get_coins_qty(self) -> int:
-        '''Get current coin balance.
+        args:
+            coins_amount (int): Amount to credit
+            ledger_kind (str | None): Ledger entry kind, e.g. "top_up", None to leave the ledger unchanged
 
         return:
-            int: Number of coins
+            int | None: New balance, or None if session is missing
         '''
-        await self.touch()
-        value = await redis_client.hget(f"user_session:{self.user_id}", "coins")
-        return int(value) if value else 0
+        args = [self.user_id, coins_amount] + ([ledger_kind] if ledger_kind else [])
+        result = await add_coins_script(keys=[self.key, DIRTY_SESSIONS_KEY, LEDGER_STREAM_KEY, LEADERBOARD_KEY], args=args)
+        if result is None:
+            return None
+        session_cache.invalidate(self.key)
+        local_dirty_user_ids[self.user_id] += 1
+        return int(result)
 
-    async def change_coins_qty(self, coins_amount: int) -> None:
-        '''Update user's coin balance.
+    async def settle_spins(self, autospin_id: str, bid: int, spins: list[tuple[int, int]], refund: int = 0) -> int | None:
+        '''Atomically settle the spins of a pending autospin, record them in the ledger and delete its record.
 
         args:
-            coins_amount (int): New coin amount
+            autospin_id (str): ID given to start_autospin
+            bid (int): Bid of every spin
+            spins (list[tuple[int, int]]): Dice value and payout (the bid included, 0 for a loss) of every spin
+            refund (int): Debited amount to return for spins which did not happen
 
         return:
-            None
+            int | None: New balance, or None if session is missing or the autospin was settled already
         '''
-        await self.touch()
-        await redis_client.hset(f"user_session:{self.user_id}", "coins", coins_amount)
+        args = [self.user_id, bid, refund, autospin_id] + [item for spin in spins for item in spin]
+        keys = [self.key, DIRTY_SESSIONS_KEY, LEDGER_STREAM_KEY, LEADERBOARD_KEY, self.autospin_key, AUTOSPINS_KEY]
+        result = await settle_spins_script(keys=keys, args=args)
+        if result is None:
+            return None
+        session_cache.invalidate(self.key)
+        if refund or any(payout for _, payout in spins):
+            local_dirty_user_ids[self.user_id] += 1
+        return int(result)
 
     async def delete_instance(self) -> None:
         '''Delete session and all related keys
@@ -149,4 +439,10 @@ class UserSession():
         return:
             None
         '''
-        await redis_client.hdel(f"user_session:{self.user_id}", "id", "user_id", "messages","authorized", "coins", "timestamp")
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.delete(self.key, self.autospin_key)
+        pipe.zrem(LEADERBOARD_KEY, self.user_id)
+        pipe.zrem(SESSION_DEADLINES_KEY, self.user_id)
+        pipe.zrem(AUTOSPINS_KEY, self.user_id)
+        await pipe.execute()
+        session_cache.invalidate(self.key)
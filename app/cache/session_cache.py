@@ -0,0 +1,175 @@
+"""
+In-process LRU cache of session hashes invalidated by Redis client-side caching.
+
+This module defines the SessionCache class, which:
+- Keeps up to SESSION_CACHE_SIZE session hashes, evicting the least recently used one
+- Listens on a dedicated connection with CLIENT TRACKING in broadcasting mode (BCAST) for
+  the `user_session:` prefix, so a write to a session from any process evicts it
+- Evicts sessions written by this process immediately, without waiting for the invalidation message
+- Drops hashes read while an invalidation of the same key arrived, so a stale read is never cached
+- Serves nothing from memory while the tracking connection is down, and clears itself on reconnect
+- Counts hits, misses and invalidations
+
+SessionStorage (app.cache.fsm_storage) reads FSM state and data through this cache. aiogram
+reads the state of every update, so between balance changes updates of a user cost no
+FSM round trip. In exchange every session write of any process sends an invalidation
+message to the tracking connection of every replica.
+
+Invalidation messages are asynchronous: a write made by another process may be followed by
+reads of the old hash in this process for the time the message is in flight (usually below
+a millisecond). The shared pool uses RESP2, so invalidations are redirected to a connection
+subscribed to `__redis__:invalidate`.
+"""
+
+import asyncio
+from collections import OrderedDict
+from typing import Awaitable, Callable
+import redis.asyncio as redis
+from loguru import logger
+
+INVALIDATION_CHANNEL = "__redis__:invalidate"
+
+
+class SessionCache():
+    '''LRU cache of Redis hashes under one key prefix, kept coherent with CLIENT TRACKING.'''
+
+    def __init__(self, prefix: str, max_size: int):
+        '''Initialize a disabled cache, `start` must be called to use it.
+
+        args:
+            prefix (str): Prefix of tracked keys
+            max_size (int): Maximum number of cached hashes
+        '''
+        self.prefix = prefix
+        self.max_size = max_size
+        self.entries: OrderedDict[str, dict] = OrderedDict()
+        # In-flight loads per key and keys invalidated while loads were in flight
+        self.loading: dict[str, int] = {}
+        self.stale: set[str] = set()
+        # Entries are served only while invalidations are received
+        self.ready = False
+        self.task: asyncio.Task | None = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    async def get(self, key: str, load: Callable[[], Awaitable[dict]]) -> dict:
+        '''Get a hash from memory or load it from Redis.
+
+        args:
+            key (str): Redis key
+            load (Callable[[], Awaitable[dict]]): Coroutine function reading the hash
+
+        return:
+            dict: Hash fields, empty if the key does not exist
+        '''
+        if not self.ready:
+            return await load()
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+        self.misses += 1
+        self.loading[key] = self.loading.get(key, 0) + 1
+        try:
+            value = await load()
+        finally:
+            fresh = self.ready and key not in self.stale
+            if self.loading[key] == 1:
+                del self.loading[key]
+                self.stale.discard(key)
+            else:
+                self.loading[key] -= 1
+        if fresh:
+            self.entries[key] = value
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key: str) -> None:
+        '''Evict a hash, e.g. after this process wrote it.'''
+        self.entries.pop(key, None)
+        if key in self.loading:
+            self.stale.add(key)
+
+    def clear(self) -> None:
+        '''Evict everything, e.g. after invalidations may have been missed.'''
+        self.entries.clear()
+        self.stale.update(self.loading)
+
+    def get_stats(self) -> dict:
+        '''Get hit ratio and counters.'''
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+    def __str__(self) -> str:
+        stats = self.get_stats()
+        return (f"session cache: {stats['size']} entries, {stats['hits']} hits, {stats['misses']} misses "
+                f"({stats['hit_ratio']:.1%} hit ratio), {stats['invalidations']} invalidations")
+
+    async def start(self, client: redis.Redis) -> None:
+        '''Start receiving invalidations, entries are served once tracking is enabled.
+
+        args:
+            client (redis.asyncio.Redis): Client whose connection settings are used for the tracking connection
+        '''
+        if self.task is None:
+            self.task = asyncio.create_task(self._run(client))
+
+    async def stop(self) -> None:
+        '''Stop receiving invalidations and disable the cache.'''
+        self.ready = False
+        self.clear()
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def _listen(self, connection: redis.Connection) -> None:
+        await connection.connect()
+        await connection.send_command("CLIENT", "ID")
+        client_id = await connection.read_response()
+        # Invalidations of every key under the prefix are sent to this connection itself
+        await connection.send_command("CLIENT", "TRACKING", "ON", "REDIRECT", client_id, "BCAST", "PREFIX", self.prefix)
+        await connection.read_response()
+        await connection.send_command("SUBSCRIBE", INVALIDATION_CHANNEL)
+        await connection.read_response()
+        self.clear()
+        self.ready = True
+        logger.info(f"Session cache is tracking {self.prefix}* keys")
+        while True:
+            kind, _, keys = await connection.read_response()
+            if kind != "message":
+                continue
+            if keys is None:
+                # FLUSHDB or FLUSHALL
+                self.invalidations += len(self.entries)
+                self.clear()
+                continue
+            for key in keys:
+                self.invalidations += 1
+                self.invalidate(key)
+
+    async def _run(self, client: redis.Redis) -> None:
+        # Health checks would send PING in the subscribed state, the connection is idle by design
+        kwargs = {**client.connection_pool.connection_kwargs, "health_check_interval": 0}
+        while True:
+            connection = client.connection_pool.connection_class(**kwargs)
+            try:
+                await self._listen(connection)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Session cache tracking connection failed, cache disabled until reconnected: {e}")
+            finally:
+                self.ready = False
+                self.clear()
+                await connection.disconnect()
+            await asyncio.sleep(1)
@@ -32,7 +32,7 @@ def generate_captcha_items(correct_emoji: str) -> list:
     Returns:
         list: List of 4 emojis (3 random + 1 correct), shuffled.
     """
-    emojis_list.remove(correct_emoji)
-    generated_items = random.sample(emojis_list, 3) + [correct_emoji]
+    other_emojis = [emoji for emoji in emojis_list if emoji != correct_emoji]
+    generated_items = random.sample(other_emojis, 3) + [correct_emoji]
     random.shuffle(generated_items)
     return generated_items
\ No newline at end of file
@@ -0,0 +1,87 @@
+"""
+Versioned schema migrations for PostgreSQL.
+
+This module provides:
+- MIGRATIONS: ordered list of (version, description, SQL statements)
+- run_migrations: applies pending migrations and records them in `schema_migrations`
+
+All pending migrations are applied in one transaction under an advisory lock,
+so several bot replicas starting at once do not race each other.
+New schema changes are added as new entries at the end of MIGRATIONS.
+"""
+
+from loguru import logger
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+# Arbitrary constant identifying the migration lock
+MIGRATIONS_LOCK_ID = 7_305_202_501
+
+MIGRATIONS = [
+    (1, "Create authorized_users and blacklisted_users", [
+        """CREATE TABLE IF NOT EXISTS authorized_users (
+            id SERIAL NOT NULL,
+            user_id BIGINT,
+            coins INTEGER NOT NULL,
+            timestamp TIMESTAMP WITH TIME ZONE,
+            PRIMARY KEY (id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS blacklisted_users (
+            id SERIAL NOT NULL,
+            user_id BIGINT,
+            timestamp TIMESTAMP WITH TIME ZONE,
+            PRIMARY KEY (id)
+        )""",
+    ]),
+    (2, "Unique index on authorized_users.user_id", [
+        # Keep the newest row of users duplicated by racing inserts
+        "DELETE FROM authorized_users a USING authorized_users b WHERE a.user_id = b.user_id AND a.id < b.id",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_authorized_users_user_id ON authorized_users (user_id)",
+    ]),
+    (3, "Unique index on blacklisted_users.user_id", [
+        "DELETE FROM blacklisted_users a USING blacklisted_users b WHERE a.user_id = b.user_id AND a.id > b.id",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_blacklisted_users_user_id ON blacklisted_users (user_id)",
+    ]),
+    (4, "Create sync_state for fencing tokens of the sync worker leader", [
+        "CREATE TABLE IF NOT EXISTS sync_state (name TEXT PRIMARY KEY, fencing_token BIGINT NOT NULL)",
+        "INSERT INTO sync_state (name, fencing_token) VALUES ('sync_worker', 0) ON CONFLICT DO NOTHING",
+    ]),
+    (5, "Create ledger_entries for spins and top-ups", [
+        """CREATE TABLE IF NOT EXISTS ledger_entries (
+            stream_id VARCHAR NOT NULL,
+            user_id BIGINT NOT NULL,
+            kind VARCHAR NOT NULL,
+            bid INTEGER NOT NULL,
+            payout INTEGER NOT NULL,
+            dice SMALLINT,
+            balance INTEGER NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            PRIMARY KEY (stream_id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS ix_ledger_entries_user_id_created_at ON ledger_entries (user_id, created_at)",
+    ]),
+]
+
+
+async def run_migrations(engine: AsyncEngine) -> None:
+    """Apply pending migrations.
+
+    Args:
+        engine (AsyncEngine): Database engine.
+    """
+    async with engine.begin() as conn:
+        await conn.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), {"lock_id": MIGRATIONS_LOCK_ID})
+        await conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INTEGER PRIMARY KEY, description TEXT NOT NULL, "
+            "applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now())"))
+        applied = set(await conn.scalars(text("SELECT version FROM schema_migrations")))
+        for version, description, statements in MIGRATIONS:
+            if version in applied:
+                continue
+            for statement in statements:
+                await conn.execute(text(statement))
+            await conn.execute(
+                text("INSERT INTO schema_migrations (version, description) VALUES (:version, :description)"),
+                {"version": version, "description": description})
+            logger.info(f"Applied migration {version}: {description}")
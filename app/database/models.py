@@ -4,8 +4,12 @@ Async database models and engine setup for managing authorized and blacklisted u
 This module provides:
 - SQLAlchemy async engine and session setup
 - Base declarative models
-- Tables for authorized and blacklisted users
+- Tables for authorized and blacklisted users, unique by user_id
+- Sync state table holding the fencing token of the sync worker leader
+- Ledger of spins and top-ups, keyed by the ID of the Redis Stream entry
+- Configurable connection pool with checkout statistics and a startup warm-up
 
+Schema is managed by versioned migrations from app.database.migrations.
 All database operations should be performed using async sessions.
 """
 
@@ -14,15 +18,49 @@ import os
 import sys
 from loguru import logger
 from dotenv import load_dotenv
-from sqlalchemy import BigInteger, DateTime
+from contextlib import AsyncExitStack
+from sqlalchemy import BigInteger, DateTime, Index, SmallInteger, String, text
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlalchemy.ext.asyncio import AsyncAttrs, async_sessionmaker, create_async_engine
 
+from app.database.migrations import run_migrations
+from app.pools import PoolStats
+from app import metrics
+
 load_dotenv()
-logger.add("logs/log.log", rotation="1 day", level="INFO", enqueue=True)
+
+POSTGRES_POOL_SIZE = int(os.getenv("POSTGRES_POOL_SIZE") or 10)
+POSTGRES_MAX_OVERFLOW = int(os.getenv("POSTGRES_MAX_OVERFLOW") or 10)
+POSTGRES_POOL_TIMEOUT = float(os.getenv("POSTGRES_POOL_TIMEOUT") or 30)
+POSTGRES_POOL_RECYCLE = int(os.getenv("POSTGRES_POOL_RECYCLE") or 1800)
+POSTGRES_POOL_PRE_PING = (os.getenv("POSTGRES_POOL_PRE_PING") or "true").lower() == "true"
+# Executions of a query before psycopg prepares it server-side, "none" disables prepared statements
+# (required behind PgBouncer in transaction mode)
+POSTGRES_PREPARE_THRESHOLD = os.getenv("POSTGRES_PREPARE_THRESHOLD") or "5"
+POSTGRES_PREPARE_THRESHOLD = None if POSTGRES_PREPARE_THRESHOLD.lower() == "none" else int(POSTGRES_PREPARE_THRESHOLD)
+
+db_pool_stats = PoolStats("Postgres")
+metrics.register_stats("bot_pool", db_pool_stats.get_stats, {"pool": "postgres"})
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """Queue pool recording checkout counts and time spent waiting for a connection."""
+
+    def _do_get(self):
+        with db_pool_stats.measure():
+            return super()._do_get()
+
 
 engine = create_async_engine(
-    url=f"postgresql+psycopg://{os.getenv("POSTGRES_USER")}:{os.getenv("POSTGRES_PASSWORD")}@{os.getenv("POSTGRES_HOST")}:{os.getenv("POSTGRES_PORT")}/{os.getenv("POSTGRES_DB")}")
+    url=f"postgresql+psycopg://{os.getenv("POSTGRES_USER")}:{os.getenv("POSTGRES_PASSWORD")}@{os.getenv("POSTGRES_HOST")}:{os.getenv("POSTGRES_PORT")}/{os.getenv("POSTGRES_DB")}",
+    poolclass=InstrumentedPool,
+    pool_size=POSTGRES_POOL_SIZE,
+    max_overflow=POSTGRES_MAX_OVERFLOW,
+    pool_timeout=POSTGRES_POOL_TIMEOUT,
+    pool_recycle=POSTGRES_POOL_RECYCLE,
+    pool_pre_ping=POSTGRES_POOL_PRE_PING,
+    connect_args={"prepare_threshold": POSTGRES_PREPARE_THRESHOLD})
 
 async_session = async_sessionmaker(engine)
 
@@ -41,8 +79,9 @@ class AuthorizedUser(Base):
     __tablename__ = "authorized_users"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    user_id = mapped_column(BigInteger)
+    user_id = mapped_column(BigInteger, index=True, unique=True)
     coins: Mapped[int] = mapped_column()
+    # When the balance was last saved from the cache, replayed snapshots never overwrite newer balances
     timestamp = mapped_column(DateTime(timezone=True))
 
 
@@ -51,12 +90,47 @@ class BlacklistedUser(Base):
     __tablename__ = "blacklisted_users"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    user_id = mapped_column(BigInteger)
+    user_id = mapped_column(BigInteger, index=True, unique=True)
     timestamp = mapped_column(DateTime(timezone=True))
 
 
+class SyncState(Base):
+    """Represents the latest fencing token accepted from a sync worker leader."""
+    __tablename__ = "sync_state"
+
+    name: Mapped[str] = mapped_column(String, primary_key=True)
+    fencing_token = mapped_column(BigInteger, nullable=False)
+
+
+class LedgerEntry(Base):
+    """Represents a spin, a top-up or a refund of autospin bids, written in batches from the ledger stream."""
+    __tablename__ = "ledger_entries"
+    __table_args__ = (Index("ix_ledger_entries_user_id_created_at", "user_id", "created_at"),)
+
+    stream_id: Mapped[str] = mapped_column(String, primary_key=True)
+    user_id = mapped_column(BigInteger, nullable=False)
+    kind: Mapped[str] = mapped_column(String)
+    bid: Mapped[int] = mapped_column()
+    payout: Mapped[int] = mapped_column()
+    dice = mapped_column(SmallInteger, nullable=True)
+    balance: Mapped[int] = mapped_column()
+    created_at = mapped_column(DateTime(timezone=True), nullable=False)
+
+
 async def async_main() -> None:
-    """Create all tables in the database if they do not exist."""
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
-    logger.info("Created tables in database")
+    """Create or upgrade database schema by applying pending migrations."""
+    await run_migrations(engine)
+    logger.info("Database schema is up to date")
+
+
+async def warm_db_pool() -> None:
+    """Open POSTGRES_POOL_SIZE connections at once and check each with a query.
+
+    Fails startup early if the database is unreachable and saves first handlers
+    from paying for connection setup.
+    """
+    async with AsyncExitStack() as stack:
+        for _ in range(POSTGRES_POOL_SIZE):
+            conn = await stack.enter_async_context(engine.connect())
+            await conn.execute(text("SELECT 1"))
+    logger.info(f"Warmed {POSTGRES_POOL_SIZE} connections, {db_pool_stats}")
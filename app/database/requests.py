@@ -2,19 +2,27 @@
 Database helper functions for managing authorized and blacklisted users.
 
 This module provides async functions to interact with the database:
-- Add, update, and fetch authorized users
-- Manage user coins
-- Move users to blacklist and check blacklist status
-
-All functions use SQLAlchemy async sessions.
+- Fetch authorized users
+- Manage user coins, including bulk upserts for the cache sync worker and streaming all balances
+- Check fencing tokens of the sync worker leader
+- Write batches of ledger entries with COPY
+- Move users to blacklist and list blacklisted users for the in-process blacklist cache
+
+Every function runs a single statement in a single session (plus the fencing check
+of leader writes), relying on the unique indexes on user_id (INSERT ... ON CONFLICT
+instead of lookups before writes).
+All functions use SQLAlchemy async sessions and record their duration when metrics are enabled.
 """
 
-from app.database.models import async_session
-from app.database.models import AuthorizedUser, BlacklistedUser
-from sqlalchemy import select, update, delete
+from app.database.models import async_session, engine
+from app.database.models import AuthorizedUser, BlacklistedUser, SyncState
+from app.metrics import timed, db_latency
+from sqlalchemy import select, update, delete, text, or_
+from sqlalchemy.dialects.postgresql import insert
 from datetime import datetime
 
 
+@timed(db_latency)
 async def helper_get_user(model, user_id: int) -> object:
     '''Fetch a user from the database by model and user_id.
 
@@ -29,40 +37,120 @@ async def helper_get_user(model, user_id: int) -> object:
         return await session.scalar(select(model).where(model.user_id == user_id))
 
 
-async def add_user_to_authorized(user_id: int) -> None:
-    '''Add a user to authorized list with default coins.
+class StaleLeaderError(Exception):
+    '''Raised when a write carries a fencing token older than one already accepted.'''
+    pass
+
+
+@timed(db_latency)
+async def get_sync_fencing_token() -> int:
+    '''Get the latest fencing token accepted from the sync worker leader.
+
+    return:
+        int: Fencing token, 0 if no leader has written yet
+    '''
+    async with async_session() as session:
+        return await session.scalar(select(SyncState.fencing_token).where(SyncState.name == "sync_worker")) or 0
+
+
+@timed(db_latency)
+async def upsert_users_coins(balances: dict[int, int], fencing_token: int | None = None,
+                             saved_at: dict[int, datetime] | None = None) -> None:
+    '''Insert or update coin balances for many authorized users in one statement.
+
+    Every written row gets the time its balance was read as `timestamp`. With a fencing token
+    the write is accepted only if no newer leader has written yet. The token row is locked
+    FOR SHARE until commit, so batches of one leader run concurrently while a new leader
+    waits for them before raising the token.
 
     args:
-        user_id (int): Telegram User ID
+        balances (dict[int, int]): Mapping of Telegram User ID to coin amount
+        fencing_token (int | None): Fencing token of the sync worker leader, None to skip the check
+        saved_at (dict[int, datetime] | None): Time each balance was read at, e.g. of a snapshot.
+            Rows are then updated only if their balance is older, None to write the current time unconditionally
 
     return:
         None
+
+    raises:
+        StaleLeaderError: A newer leader has already written
     '''
+    if not balances:
+        return
+    timestamp = datetime.now()
+    statement = insert(AuthorizedUser).values(
+        [{"user_id": user_id, "coins": coins, "timestamp": saved_at[user_id] if saved_at else timestamp}
+         for user_id, coins in balances.items()])
+    newer = or_(AuthorizedUser.timestamp.is_(None), AuthorizedUser.timestamp < statement.excluded.timestamp)
+    statement = statement.on_conflict_do_update(
+        index_elements=[AuthorizedUser.user_id],
+        set_={"coins": statement.excluded.coins, "timestamp": statement.excluded.timestamp},
+        where=newer if saved_at else None)
     async with async_session() as session:
-        authorized_user = await helper_get_user(AuthorizedUser, user_id)
-        if not authorized_user:
-            session.add(AuthorizedUser(user_id=user_id,
-                        coins=1000, timestamp=datetime.now()))
+        if fencing_token is not None:
+            await session.execute(update(SyncState).where(
+                SyncState.name == "sync_worker", SyncState.fencing_token < fencing_token).values(fencing_token=fencing_token))
+            accepted = await session.scalar(select(SyncState.fencing_token).where(SyncState.name == "sync_worker").with_for_update(read=True))
+            if accepted != fencing_token:
+                raise StaleLeaderError(f"Fencing token {fencing_token} is older than {accepted}")
+        await session.execute(statement)
         await session.commit()
 
 
-async def update_user_coins(user_id: int, coins: int) -> None:
-    '''Update coin balance for an authorized user.
+@timed(db_latency)
+async def add_user_coins(user_id: int, coins: int) -> int | None:
+    '''Credit coins to an authorized user whose session is not cached.
 
     args:
         user_id (int): Telegram User ID
-        coins (int): New coin amount
+        coins (int): Amount to credit
 
     return:
-        None
+        int | None: New balance, or None if the user is not authorized
     '''
+    statement = (update(AuthorizedUser).where(AuthorizedUser.user_id == user_id)
+                 .values(coins=AuthorizedUser.coins + coins, timestamp=datetime.now()).returning(AuthorizedUser.coins))
     async with async_session() as session:
-        authorized_user = await helper_get_user(AuthorizedUser, user_id)
-        if authorized_user:
-            await session.execute(update(AuthorizedUser).where(AuthorizedUser.user_id == user_id).values(coins=coins))
+        balance = await session.scalar(statement)
         await session.commit()
+        return balance
+
+
+@timed(db_latency)
+async def get_users_coins(user_ids: list[int]) -> dict[int, int]:
+    '''Get coin balances for many authorized users at once.
+
+    args:
+        user_ids (list[int]): Telegram User IDs
+
+    return:
+        dict[int, int]: Mapping of Telegram User ID to coin amount for users found in database
+    '''
+    if not user_ids:
+        return {}
+    async with async_session() as session:
+        result = await session.execute(
+            select(AuthorizedUser.user_id, AuthorizedUser.coins).where(AuthorizedUser.user_id.in_(user_ids)))
+        return {user_id: coins for user_id, coins in result}
+
+
+async def iterate_users_coins(batch_size: int = 10000):
+    '''Stream coin balances of all authorized users with a server-side cursor.
+
+    args:
+        batch_size (int): Number of rows fetched per round trip
 
+    yields:
+        list[tuple[int, int]]: Batches of (Telegram User ID, coin amount)
+    '''
+    async with async_session() as session:
+        result = await session.stream(
+            select(AuthorizedUser.user_id, AuthorizedUser.coins).execution_options(yield_per=batch_size))
+        async for partition in result.partitions():
+            yield [(user_id, coins) for user_id, coins in partition]
 
+
+@timed(db_latency)
 async def get_user_from_authorized(user_id: int) -> AuthorizedUser | None:
     '''Get authorized user by ID.
 
@@ -75,35 +163,59 @@ async def get_user_from_authorized(user_id: int) -> AuthorizedUser | None:
     return await helper_get_user(AuthorizedUser, user_id)
 
 
+@timed(db_latency)
 async def add_user_to_blacklist(user_id: int) -> None:
     '''Add a user to blacklist and remove from authorized if exists.
 
+    Both changes are made by one statement: DELETE ... RETURNING in a CTE
+    followed by INSERT ... ON CONFLICT DO NOTHING.
+
     args:
         user_id (int): Telegram User ID
 
     return:
         None
     '''
+    removed = delete(AuthorizedUser).where(AuthorizedUser.user_id == user_id).returning(AuthorizedUser.user_id).cte("removed")
+    statement = insert(BlacklistedUser).values(user_id=user_id, timestamp=datetime.now()).add_cte(removed)
     async with async_session() as session:
-        blacklisted_user = await helper_get_user(BlacklistedUser, user_id)
-        authorized_user = await helper_get_user(AuthorizedUser, user_id)
+        await session.execute(statement.on_conflict_do_nothing(index_elements=[BlacklistedUser.user_id]))
+        await session.commit()
 
-        if authorized_user:
-            await session.execute(delete(AuthorizedUser).where(AuthorizedUser.user_id == user_id))
 
-        if not blacklisted_user:
-            session.add(BlacklistedUser(
-                user_id=user_id, timestamp=datetime.now()))
-        await session.commit()
+@timed(db_latency)
+async def get_blacklisted_user_ids() -> list[int]:
+    '''Get IDs of all blacklisted users.
 
+    return:
+        list[int]: Telegram User IDs
+    '''
+    async with async_session() as session:
+        return list(await session.scalars(select(BlacklistedUser.user_id)))
 
-async def get_user_from_blacklist(user_id: int):
-    '''Check if a user is in the blacklist.
+
+@timed(db_latency)
+async def insert_ledger_entries(entries: list[tuple]) -> None:
+    '''Write ledger entries with COPY, skipping entries which were already written.
+
+    Entries are copied into a temporary table and moved with INSERT ... ON CONFLICT DO NOTHING,
+    so a batch redelivered after a crash does not fail on duplicates.
 
     args:
-        user_id (int): Telegram User ID
+        entries (list[tuple]): Rows of (stream_id, user_id, kind, bid, payout, dice, balance, created_at)
 
     return:
-        bool: True if in blacklist, False otherwise
+        None
     '''
-    return bool(await helper_get_user(BlacklistedUser, user_id))
+    if not entries:
+        return
+    async with engine.begin() as conn:
+        await conn.execute(text(
+            "CREATE TEMPORARY TABLE ledger_staging (LIKE ledger_entries INCLUDING DEFAULTS) ON COMMIT DROP"))
+        raw_connection = await conn.get_raw_connection()
+        async with raw_connection.driver_connection.cursor() as cursor:
+            async with cursor.copy(
+                    "COPY ledger_staging (stream_id, user_id, kind, bid, payout, dice, balance, created_at) FROM STDIN") as copy:
+                for entry in entries:
+                    await copy.write_row(entry)
+        await conn.execute(text("INSERT INTO ledger_entries SELECT * FROM ledger_staging ON CONFLICT (stream_id) DO NOTHING"))
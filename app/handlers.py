@@ -4,13 +4,17 @@ Telegram slot machine bot handlers using Aiogram.
 This module defines:
 - Message and callback query handlers for Magic Spin slot machine simulator.
 - Captcha-based user authorization.
-- Slot machine spin logic, coin management, and profile display.
+- Slot machine spin logic, coin management, and profile display with leaderboard rank.
+- Paginated leaderboard of top players.
 - Bid selection, coin top-up, and rules display.
+- Autospin: several spins of one bid played in the background and settled together.
 
 All handlers are async and use FSMContext for user states, and Redis-based UserSession for coin storage.
+The session and its cached coins are provided by RateLimiter middleware as `user_session` and `cached_coins`.
 """
 
 import asyncio
+import uuid
 from aiogram import F, Router, html
 from aiogram.filters import CommandStart
 from aiogram.types import Message, CallbackQuery
@@ -21,15 +25,29 @@ from loguru import logger
 
 import app.keyboards as kb
 from app.cache.redis_logic import UserSession
+from app.cache.leaderboard import leaderboard
 from app.middleware import RateLimiter
+from app import metrics, log
+from app.scheduler import scheduler
 from app.worker import push_all_users_to_db
-banner_text = f'🎰 {html.bold("Magic Spin - Slot machine simulator")}\n\n💸 Win {html.bold("combinations:")}\n\n7️⃣7️⃣7️⃣ = Bid Amount x10\n⬜️⬜️⬜️ = Bid Amount x5\n🍋🍋🍋 = Bid Amount x2\n🍇🍇🍇 = Bid Amount x2\n\n{html.bold("This project is a non-commercial simulation of Telegram’s slot machine dice feature. It has been developed solely for educational and demonstration purposes.")}'
+from app.payouts import payout, payout_lines
+from app.autospin import autospin_runner, AUTOSPIN_COUNTS
+from app.profiling import UpdateProfiler
+combinations_text = "\n".join(f'{reels} = Bid Amount x{multiplier}' for reels, multiplier in payout_lines())
+banner_text = f'🎰 {html.bold("Magic Spin - Slot machine simulator")}\n\n💸 Win {html.bold("combinations:")}\n\n{combinations_text}\n\n{html.bold("This project is a non-commercial simulation of Telegram’s slot machine dice feature. It has been developed solely for educational and demonstration purposes.")}'
+
+# Time of the dice animation, the spin result is sent after it
+DICE_ANIMATION_DELAY = 2.2
 
 router = Router()
+# Registered first to time the whole update, RateLimiter included
+router.message.middleware(UpdateProfiler())
+router.callback_query.middleware(UpdateProfiler())
 router.message.middleware(RateLimiter())
 router.callback_query.middleware(RateLimiter())
-
-logger.add("logs/log.log", rotation="1 day", level="INFO", enqueue=True)
+# Registered last to time only the handler itself
+router.message.middleware(metrics.HandlerTimer())
+router.callback_query.middleware(metrics.HandlerTimer())
 
 
 class AuthorizationStatus(StatesGroup):
@@ -37,21 +55,17 @@ class AuthorizationStatus(StatesGroup):
     authorized = State()
 
 
-async def get_coins(callback_from_handler: CallbackQuery) -> tuple:
+def get_amount(callback_from_handler: CallbackQuery) -> int:
     """
-    Retrieve the bid amount and current coin balance for a user.
+    Retrieve the bid or top-up amount from callback data.
 
     Args:
         callback_from_handler (CallbackQuery): The callback query triggered by the user.
 
     Returns:
-        tuple: (bid_amount, UserSession object, cached_coins)
+        int: Amount of coins
     """
-    amount = int(callback_from_handler.data.split(":")[1])
-    session = UserSession(callback_from_handler.from_user.id)
-    await session.ensure_session()
-    cached_coins = int(await session.get_coins_qty())
-    return amount, session, cached_coins
+    return int(callback_from_handler.data.split(":")[1])
 
 
 @router.message(CommandStart())
@@ -80,21 +94,21 @@ async def check_if_human(callback: CallbackQuery, state: FSMContext) -> None:
     """
     Check the user's captcha response and authorize if correct.
 
+    Session authorization and TTL refresh are already done by RateLimiter.
+
     Args:
         callback (CallbackQuery): The callback query triggered by the captcha button.
         state (FSMContext): FSM context for the user state.
     """
-    _, chosen_emoji, correct, user_id = callback.data.split(":")
-    session = UserSession(user_id)
-    await session.ensure_session()
+    _, chosen_emoji, correct, _ = callback.data.split(":")
     if chosen_emoji == correct:
+        metrics.captcha_attempts.inc("passed")
         await state.set_state(AuthorizationStatus.authorized)
-        await session.authorize_user()
-        await session.get_coins_qty()
         await callback.answer(None)
         await callback.message.edit_text("You solved captcha! ✅")
         await callback.message.answer(banner_text, parse_mode="html", reply_markup=kb.main_menu_keyboard)
     else:
+        metrics.captcha_attempts.inc("failed")
         await callback.answer("False!")
         await callback.message.edit_text("Try again! ⛔")
 
@@ -124,66 +138,202 @@ async def add_coins_from_main(callback: CallbackQuery) -> None:
 
 
 @router.callback_query(F.data.startswith("bid_amount:"))
-async def send_slotmachine(callback: CallbackQuery) -> None:
+async def send_slotmachine(callback: CallbackQuery, user_session: UserSession) -> None:
     """
     Perform the slot machine spin based on user's bid.
 
-    - Deducts coins for the bid.
-    - Determines prize multiplier based on slot result.
-    - Updates user coin balance accordingly.
+    - Atomically deducts coins for the bid and records the spin as pending in Redis, like an autospin
+      of one spin, rejecting insufficient balance and spins while another one of the user is pending.
+    - Determines the payout of the slot result from the payout table (app.payouts).
+    - Settles the spin atomically: credits the win (bid included) and records the spin in the ledger.
+      If settling fails, the dice value is recorded and the sync leader settles the spin.
+    - Schedules the result message after the dice animation and returns immediately.
 
     Args:
         callback (CallbackQuery): Callback query triggered by a bid amount button.
+        user_session (UserSession): Session of the user, provided by middleware.
     """
-    amount, session, cached_coins = await get_coins(callback)
+    amount = get_amount(callback)
+    spin_id = uuid.uuid4().hex
+    started = await user_session.start_autospin(spin_id, 1, amount)
+    if started is not None and started[0] == -1:
+        await callback.answer("Wait until your spins are finished")
+        return
     await callback.answer(None)
-    if cached_coins > 0 and cached_coins >= amount:
-        await callback.message.edit_text(f'You chose {amount} 🪙', reply_markup=None)
-        result = await callback.message.answer_dice(emoji="🎰")
-        prizes = {64: 10, 43: 2, 22: 2, 1: 5}
-        multiplier = prizes.get(result.dice.value, 0)
-
-        if multiplier:
-            win = amount * multiplier
-            new_balance = cached_coins + win
-            await session.change_coins_qty(new_balance)
-            await asyncio.sleep(2.2)
-            await callback.message.answer(f'💰 {html.bold("JACKPOT")} 💰\n\n{html.bold("YOU GOT:")} {win} 🪙\n\nYour balance: {new_balance}', parse_mode="html", reply_markup=kb.main_menu_keyboard)
+    if started is not None and started[0] == 1:
+        try:
+            await callback.message.edit_text(f'You chose {amount} 🪙', reply_markup=None)
+            result = await callback.message.answer_dice(emoji="🎰")
+        except Exception:
+            # The spin did not happen, return the bid
+            metrics.spins.inc("failed")
+            await user_session.settle_spins(spin_id, amount, [], amount)
+            raise
+        returned = payout(amount, result.dice.value)
+
+        metrics.spins.inc("win" if returned else "loss")
+        win = returned - amount if returned else 0
+        try:
+            new_balance = await user_session.settle_spins(spin_id, amount, [(result.dice.value, returned)])
+        except Exception as e:
+            logger.error(f"Spin in chat {callback.message.chat.id} was not settled, the sync leader settles it: {e}")
+            new_balance = None
+            try:
+                await user_session.record_autospin(spin_id, [result.dice.value])
+            except Exception as e:
+                logger.error(f"Dice of the spin in chat {callback.message.chat.id} was not recorded, the sync leader returns the bid: {e}")
+        log.debug("Spin settled: bid {}, dice {}, win {}, balance {}", amount, result.dice.value, win, new_balance)
+        balance_text = f'Your balance: {new_balance}' if new_balance is not None else 'Your balance will be updated shortly'
+        if returned:
+            await scheduler.schedule(DICE_ANIMATION_DELAY, callback.message.chat.id, f'💰 {html.bold("JACKPOT")} 💰\n\n{html.bold("YOU GOT:")} {win} 🪙\n\n{balance_text}', parse_mode="html", reply_markup=kb.main_menu_keyboard)
         else:
-            new_balance = cached_coins - amount
-            await session.change_coins_qty(new_balance)
-            await asyncio.sleep(2.2)
-            await callback.message.answer(f'😟 {html.bold("Not this time! Try again and WIN!")}\n\nYour balance: {new_balance}\n\nTap {html.bold("Get coins")} 🪙 if you need more!', parse_mode="html", reply_markup=kb.main_menu_keyboard)
+            await scheduler.schedule(DICE_ANIMATION_DELAY, callback.message.chat.id, f'😟 {html.bold("Not this time! Try again and WIN!")}\n\n{balance_text}\n\nTap {html.bold("Get coins")} 🪙 if you need more!', parse_mode="html", reply_markup=kb.main_menu_keyboard)
     else:
+        metrics.spins.inc("insufficient_coins")
         await callback.message.answer(f'😟 {html.bold("You ran out of coins!")} Add some: ', parse_mode="html", reply_markup=kb.add_coins_keyboard)
 
 
+@router.callback_query(F.data.regexp(r"^autospin:\d+$"))
+async def get_autospin_bid_amount(callback: CallbackQuery) -> None:
+    """
+    Prompt the user to choose a bid amount for an autospin.
+
+    Args:
+        callback (CallbackQuery): Callback query triggered by an autospin button.
+    """
+    count = get_amount(callback)
+    await callback.answer(None)
+    await callback.message.edit_text(f"Choose the Bid Amount of each of {count} spins:", reply_markup=kb.create_autospin_keyboard(count))
+
+
+@router.callback_query(F.data.regexp(r"^autospin:\d+:\d+$"))
+async def start_autospin(callback: CallbackQuery, user_session: UserSession) -> None:
+    """
+    Start an autospin of the chosen number of spins and bid.
+
+    - Atomically deducts the bids of all spins and records the autospin as pending in Redis,
+      rejecting insufficient balance and a second autospin of the user on any replica.
+    - Plays the spins in the background (see play_autospin) and returns immediately.
+
+    Args:
+        callback (CallbackQuery): Callback query triggered by an autospin bid button.
+        user_session (UserSession): Session of the user, provided by middleware.
+    """
+    _, count, amount = callback.data.split(":")
+    count, amount = int(count), int(amount)
+    if count not in AUTOSPIN_COUNTS:
+        await callback.answer(None)
+        return
+    autospin_id = uuid.uuid4().hex
+    result = await user_session.start_autospin(autospin_id, count, amount)
+    if result is not None and result[0] == -1:
+        await callback.answer("Autospin is already running")
+        return
+    await callback.answer(None)
+    if result is None or not result[0]:
+        metrics.spins.inc("insufficient_coins")
+        await callback.message.answer(f'😟 {html.bold("Not enough coins for")} {count} x {amount} 🪙! Add some: ', parse_mode="html", reply_markup=kb.add_coins_keyboard)
+        return
+    await callback.message.edit_text(f'Autospin: {count} spins of {amount} 🪙', reply_markup=None)
+    autospin_runner.start(callback.from_user.id, play_autospin(callback.message, user_session, autospin_id, count, amount))
+
+
+async def play_autospin(message: Message, user_session: UserSession, autospin_id: str, count: int, amount: int) -> None:
+    """
+    Play the spins of an autospin whose bids are already deducted.
+
+    - Sends the dice one after another, paced by the outbound limiter, and records every dice value
+      in the pending autospin, so the sync leader can settle it if this process stops.
+    - Stops at the first dice that could not be sent, or when cancelled on shutdown.
+    - Settles all spins played with one atomic script call, returning the bids of the others.
+    - Stops without settling if the sync leader has settled the autospin as stale meanwhile.
+    - Schedules one summary message after the animation of the last dice.
+
+    Args:
+        message (Message): Message of the autospin, its chat receives the dice.
+        user_session (UserSession): Session of the user.
+        autospin_id (str): ID of the pending autospin.
+        count (int): Number of spins.
+        amount (int): Bid of each spin.
+    """
+    spins = []
+    try:
+        for _ in range(count):
+            result = await message.answer_dice(emoji="🎰")
+            spins.append((result.dice.value, payout(amount, result.dice.value)))
+            if not await user_session.record_autospin(autospin_id, [value for value, _ in spins]):
+                logger.warning(f"Autospin in chat {message.chat.id} was settled as stale after {len(spins) - 1} of {count} spins")
+                return
+    except asyncio.CancelledError:
+        logger.warning(f"Autospin in chat {message.chat.id} stopped after {len(spins)} of {count} spins by shutdown")
+    except Exception as e:
+        logger.error(f"Autospin in chat {message.chat.id} stopped after {len(spins)} of {count} spins: {e}")
+
+    refund = (count - len(spins)) * amount
+    try:
+        new_balance = await user_session.settle_spins(autospin_id, amount, spins, refund)
+    except Exception as e:
+        logger.error(f"Autospin in chat {message.chat.id} was not settled, the sync leader settles its recorded spins: {e}")
+        return
+    if new_balance is None:
+        logger.warning(f"Autospin in chat {message.chat.id} was settled as stale or its session expired")
+        return
+    for _, returned in spins:
+        metrics.spins.inc("win" if returned else "loss")
+    if refund:
+        metrics.spins.inc("failed", amount=count - len(spins))
+    wins = [returned - amount for _, returned in spins if returned]
+    net = sum(returned for _, returned in spins) - len(spins) * amount
+    log.debug("Autospin settled: {} spins of {}, {} wins, net {}, balance {}", len(spins), amount, len(wins), net, new_balance)
+    text = (f'🔁 {html.bold("Autospin finished")}\n\nSpins: {len(spins)} of {amount} 🪙\nWins: {len(wins)}\n'
+            f'Best win: {max(wins, default=0)} 🪙\nResult: {net:+d} 🪙\n\nYour balance: {new_balance}')
+    if refund:
+        text += f'\n\n{count - len(spins)} spins did not happen, their {refund} 🪙 were returned'
+    await scheduler.schedule(DICE_ANIMATION_DELAY, message.chat.id, text, parse_mode="html", reply_markup=kb.main_menu_keyboard)
+
+
 @router.callback_query(F.data.startswith("add_coins:"))
-async def add_coins_from_spin(callback: CallbackQuery) -> None:
+async def add_coins_from_spin(callback: CallbackQuery, user_session: UserSession) -> None:
     """
-    Top up user's balance.
+    Top up user's balance with an atomic increment recorded in the ledger.
 
     Args:
         callback (CallbackQuery): Callback query triggered by an "Add Coins" button.
+        user_session (UserSession): Session of the user, provided by middleware.
     """
-    amount, session, cached_coins = await get_coins(callback)
+    amount = get_amount(callback)
     await callback.answer(None)
-    await session.change_coins_qty((cached_coins + amount))
-    await callback.message.edit_text(f'Your balance is {cached_coins + amount} 🪙\n\nChoose an action from below:', reply_markup=kb.main_menu_keyboard)
+    new_balance = await user_session.add_coins(amount, ledger_kind="top_up")
+    await callback.message.edit_text(f'Your balance is {new_balance} 🪙\n\nChoose an action from below:', reply_markup=kb.main_menu_keyboard)
 
 
 @router.callback_query(F.data == "main:profile")
-async def get_profile(callback: CallbackQuery) -> None:
+async def get_profile(callback: CallbackQuery, cached_coins: int) -> None:
     """
-    Show the user's profile with name from Telegram and coin balance.
+    Show the user's profile with name from Telegram, coin balance and leaderboard rank.
 
     Args:
         callback (CallbackQuery): Callback query triggered by "Profile" button.
+        cached_coins (int): Current coin balance, provided by middleware.
+    """
+    await callback.answer(None)
+    rank, players = await leaderboard.get_rank(callback.from_user.id)
+    rank_text = f'#{rank} of {players}' if rank else 'not ranked yet'
+    await callback.message.edit_text(f'{html.bold("Your profile")} 👤\n\nName: {html.quote(callback.from_user.full_name)}\nCoins: {cached_coins} 🪙\nRank: {rank_text} 🏆', parse_mode="html", reply_markup=kb.profile_keyboard)
+
+
+@router.callback_query(F.data.startswith("leaderboard:"))
+async def show_leaderboard(callback: CallbackQuery) -> None:
+    """
+    Show a page of the leaderboard.
+
+    Args:
+        callback (CallbackQuery): Callback query triggered by "Leaderboard" or a page button.
     """
-    session = UserSession(callback.from_user.id)
-    await session.ensure_session()
+    page = max(0, int(callback.data.split(":")[1]))
     await callback.answer(None)
-    await callback.message.edit_text(f'{html.bold("Your profile")} 👤\n\nName: {callback.from_user.full_name}\nCoins: {await session.get_coins_qty()} 🪙', parse_mode="html", reply_markup=kb.single_back_button)
+    text, pages = await leaderboard.render_page(page)
+    await callback.message.edit_text(text, parse_mode="html", reply_markup=kb.create_leaderboard_keyboard(page, pages))
 
 
 @router.callback_query(F.data == "main:rules")
@@ -223,9 +373,11 @@ async def log_errors(event: ErrorEvent) -> None:
 @router.shutdown()
 async def save_redis_data():
     """
-    Performs save of all data from cache to db on bot shutdown
+    Performs save of data changed by this process from cache to db on bot shutdown, after updates stopped being accepted
+    and running autospins were settled
     """
+    await autospin_runner.stop()
     logger.info("Saving cached data to database, please wait")
     await push_all_users_to_db(forced=True)
-    logger.info("Cached data was successfully transfered to database. Shutting down...")
+    logger.info("Shutting down...")
 
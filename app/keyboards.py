@@ -4,15 +4,19 @@ Inline keyboards for the MagicSpin Telegram bot.
 This module provides:
 - Captcha keyboard generator
 - Main menu keyboard
-- Bid selection keyboard
+- Bid selection keyboard with autospin options and the autospin bid keyboard generator
 - Add coins keyboard
 - Back button keyboard
+- Profile keyboard and leaderboard pagination keyboard generator
 """
 
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from app.captcha import emojis_list, choose_control_emoji, generate_captcha_items
+from app.autospin import AUTOSPIN_COUNTS
+
+bid_amounts = (10, 20, 50, 100)
 
 
 async def create_captcha_keyboard(user_id: int) -> tuple:
@@ -45,8 +49,26 @@ bid_amounts_keyboard = InlineKeyboardMarkup(inline_keyboard=[
      InlineKeyboardButton(text="20 🪙", callback_data="bid_amount:20")],
     [InlineKeyboardButton(text="50 🪙", callback_data="bid_amount:50"), InlineKeyboardButton(
         text="100 🪙", callback_data="bid_amount:100")],
+    [InlineKeyboardButton(text=f"🔁 x{count}", callback_data=f"autospin:{count}") for count in AUTOSPIN_COUNTS],
     [InlineKeyboardButton(text="Cancel ❌", callback_data="cancel")]])
 
+
+def create_autospin_keyboard(count: int) -> InlineKeyboardMarkup:
+    '''Create bid selection keyboard of an autospin.
+
+    args:
+        count (int): Number of spins
+
+    return:
+        InlineKeyboardMarkup: Bid buttons and a cancel button
+    '''
+    keyboard = InlineKeyboardBuilder()
+    for bid in bid_amounts:
+        keyboard.add(InlineKeyboardButton(text=f"{bid} 🪙", callback_data=f"autospin:{count}:{bid}"))
+    keyboard.adjust(2)
+    keyboard.row(InlineKeyboardButton(text="Cancel ❌", callback_data="cancel"))
+    return keyboard.as_markup()
+
 add_coins_keyboard = InlineKeyboardMarkup(inline_keyboard=[
     [InlineKeyboardButton(text="Add 50 🪙", callback_data="add_coins:50"), InlineKeyboardButton(
         text="Add 100 🪙", callback_data="add_coins:100")],
@@ -56,3 +78,26 @@ add_coins_keyboard = InlineKeyboardMarkup(inline_keyboard=[
 
 single_back_button = InlineKeyboardMarkup(inline_keyboard=[
                                           [InlineKeyboardButton(text="⬅️ Back to main", callback_data="cancel")]])
+
+profile_keyboard = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Leaderboard 🏆", callback_data="leaderboard:0")],
+    [InlineKeyboardButton(text="⬅️ Back to main", callback_data="cancel")]])
+
+
+def create_leaderboard_keyboard(page: int, pages: int) -> InlineKeyboardMarkup:
+    '''Create leaderboard navigation keyboard.
+
+    args:
+        page (int): Current 0-based page
+        pages (int): Number of pages
+
+    return:
+        InlineKeyboardMarkup: Previous/next page buttons and a back button
+    '''
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton(text="⬅️", callback_data=f"leaderboard:{page - 1}"))
+    if page + 1 < pages:
+        navigation.append(InlineKeyboardButton(text="➡️", callback_data=f"leaderboard:{page + 1}"))
+    back = [InlineKeyboardButton(text="⬅️ Back to main", callback_data="cancel")]
+    return InlineKeyboardMarkup(inline_keyboard=[navigation, back] if navigation else [back])
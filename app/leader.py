@@ -0,0 +1,142 @@
+"""
+Redis lease-based leader election.
+
+This module defines the LeaderElection class, which:
+- Acquires a lease key with SET NX PX, so only one process holds it at a time
+- Issues a fencing token (a monotonic counter) with every acquired lease
+- Renews the lease periodically and treats it as lost once renewal fails or is late
+- Releases the lease on shutdown so another process takes over immediately
+- Resigns when the database rejects its token, e.g. after the fencing counter was lost,
+  so the next acquisition issues a token above the raised floor
+
+Followers retry acquisition every LEADER_RENEW_INTERVAL seconds, so a crashed leader is
+replaced within LEADER_LEASE_TTL + LEADER_RENEW_INTERVAL seconds. Writes of the leader
+carry its fencing token, so a paused leader whose lease has expired is rejected by the
+database instead of overwriting newer data.
+"""
+
+import asyncio
+import os
+import socket
+import time
+import uuid
+from dotenv import load_dotenv
+from loguru import logger
+
+from app.cache.redis_logic import redis_client
+
+load_dotenv()
+
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL") or 10)
+LEADER_RENEW_INTERVAL = float(os.getenv("LEADER_RENEW_INTERVAL") or LEADER_LEASE_TTL / 3)
+
+# Takes the lease KEYS[1] for ARGV[2] ms and returns a new fencing token from KEYS[2],
+# which is never lower than ARGV[3] + 1. Returns nil if the lease is held by another process.
+ACQUIRE_LUA = """
+if not redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return false
+end
+local token = redis.call('INCR', KEYS[2])
+if token <= tonumber(ARGV[3]) then
+    token = tonumber(ARGV[3]) + 1
+    redis.call('SET', KEYS[2], token)
+end
+return token
+"""
+
+# Extends the lease if it is still held by ARGV[1]. Returns 1 on success, 0 otherwise.
+RENEW_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Deletes the lease if it is still held by ARGV[1].
+RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+acquire_script = redis_client.register_script(ACQUIRE_LUA)
+renew_script = redis_client.register_script(RENEW_LUA)
+release_script = redis_client.register_script(RELEASE_LUA)
+
+
+class LeaderElection():
+    '''Lease-based leadership of one named role among bot processes.'''
+
+    def __init__(self, name: str, ttl: float = LEADER_LEASE_TTL, renew_interval: float = LEADER_RENEW_INTERVAL):
+        '''Initialize a follower, `start` must be called to take part in the election.
+
+        args:
+            name (str): Role name, processes electing the same name compete for one lease
+            ttl (float): Lease duration in seconds
+            renew_interval (float): Seconds between renewals and acquisition attempts
+        '''
+        self.name = name
+        self.key = f"leader:{name}"
+        self.fencing_key = f"leader:{name}:fencing"
+        self.instance_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.ttl = ttl
+        self.renew_interval = renew_interval
+        # Fencing tokens issued from now on are higher than this, e.g. the last one accepted by the database
+        self.fencing_floor = 0
+        self.token: int | None = None
+        self.valid_until = 0.0
+        self.task: asyncio.Task | None = None
+
+    @property
+    def is_leader(self) -> bool:
+        '''Check if this process holds an unexpired lease.'''
+        return self.token is not None and time.monotonic() < self.valid_until
+
+    async def campaign(self) -> None:
+        '''Renew the held lease or try to acquire a free one.'''
+        started = time.monotonic()
+        ttl_ms = int(self.ttl * 1000)
+        if self.token is None:
+            token = await acquire_script(keys=[self.key, self.fencing_key],
+                                         args=[self.instance_id, ttl_ms, self.fencing_floor])
+            if token is not None:
+                self.token = int(token)
+                self.valid_until = started + self.ttl
+                logger.info(f"Became {self.name} leader with fencing token {self.token}")
+        elif await renew_script(keys=[self.key], args=[self.instance_id, ttl_ms]):
+            self.valid_until = started + self.ttl
+        else:
+            logger.warning(f"Lost {self.name} leadership (fencing token {self.token})")
+            self.token = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.campaign()
+            except Exception as e:
+                logger.error(f"Leader election for {self.name} failed: {e}")
+            await asyncio.sleep(self.renew_interval)
+
+    async def start(self) -> None:
+        '''Start campaigning in the background.'''
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        '''Stop campaigning and release the lease if it is held.'''
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.resign()
+
+    async def resign(self) -> None:
+        '''Release the lease if it is held, campaigning goes on and the next acquisition issues a new token.'''
+        if self.token is not None:
+            self.token = None
+            await release_script(keys=[self.key], args=[self.instance_id])
+            logger.info(f"Released {self.name} leadership")
+
+
+sync_leader = LeaderElection("sync_worker")
@@ -0,0 +1,152 @@
+"""
+Ledger writer moving spin outcomes and top-ups from a Redis Stream to the database.
+
+This module defines the LedgerWriter class, which:
+- Reads the `ledger:entries` stream as a member of the `ledger_writers` consumer group,
+  so every bot process writes a share of the entries
+- Collects entries into batches of up to LEDGER_BATCH_SIZE, writing a batch at the latest
+  LEDGER_MAX_BATCH_LATENCY seconds after its first entry arrived
+- Writes each batch with COPY and acknowledges (XACK) and deletes its entries only after commit
+- Claims entries left pending by crashed consumers for longer than LEDGER_CLAIM_IDLE
+
+Entries are appended by the Lua scripts settling spins and top-ups, atomically with the
+balance change, so handlers never wait for the database.
+"""
+
+import asyncio
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+from loguru import logger
+from redis.exceptions import ResponseError
+
+from app.cache.redis_logic import redis_client, LEDGER_STREAM_KEY
+import app.database.requests as rq
+
+load_dotenv()
+
+LEDGER_GROUP = "ledger_writers"
+LEDGER_BATCH_SIZE = int(os.getenv("LEDGER_BATCH_SIZE") or 500)
+LEDGER_MAX_BATCH_LATENCY = float(os.getenv("LEDGER_MAX_BATCH_LATENCY") or 1)
+LEDGER_CLAIM_IDLE = float(os.getenv("LEDGER_CLAIM_IDLE") or 60)
+
+
+def to_row(entry_id: str, fields: dict) -> tuple:
+    '''Convert a stream entry to a ledger_entries row.
+
+    args:
+        entry_id (str): Stream entry ID, `<milliseconds>-<sequence>`
+        fields (dict): Entry fields
+
+    return:
+        tuple: (stream_id, user_id, kind, bid, payout, dice, balance, created_at)
+    '''
+    created_at = datetime.fromtimestamp(int(entry_id.split("-")[0]) / 1000, tz=timezone.utc)
+    return (entry_id, int(fields["user_id"]), fields["kind"], int(fields["bid"]), int(fields["payout"]),
+            int(fields["dice"]) if fields["dice"] else None, int(fields["balance"]), created_at)
+
+
+class LedgerWriter():
+    '''Consumer group member writing ledger entries to the database in batches.'''
+
+    def __init__(self):
+        '''Initialize an idle writer, `start` must be called to consume entries.'''
+        self.consumer = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.task: asyncio.Task | None = None
+        self.running = False
+        self.last_claim = 0.0
+
+    async def start(self) -> None:
+        '''Create the consumer group if needed and start consuming.'''
+        try:
+            await redis_client.xgroup_create(LEDGER_STREAM_KEY, LEDGER_GROUP, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self.running = True
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        '''Write the batch being collected and stop, entries left pending are claimed by other writers.'''
+        if self.task is None:
+            return
+        self.running = False
+        try:
+            await asyncio.wait_for(self.task, LEDGER_MAX_BATCH_LATENCY + 10)
+        except asyncio.TimeoutError:
+            logger.warning("Ledger writer did not stop in time, its pending entries will be claimed later")
+        self.task = None
+
+    async def claim_stale(self) -> list:
+        '''Take over entries pending longer than LEDGER_CLAIM_IDLE with other, probably crashed, consumers.'''
+        self.last_claim = time.monotonic()
+        claimed, start = [], "0-0"
+        while len(claimed) < LEDGER_BATCH_SIZE:
+            start, entries, *_ = await redis_client.xautoclaim(
+                LEDGER_STREAM_KEY, LEDGER_GROUP, self.consumer, int(LEDGER_CLAIM_IDLE * 1000),
+                start_id=start, count=LEDGER_BATCH_SIZE - len(claimed))
+            claimed += [entry for entry in entries if entry[1]]
+            if start == "0-0":
+                break
+        if claimed:
+            logger.warning(f"Claimed {len(claimed)} stale ledger entries")
+        return claimed
+
+    async def collect(self) -> list:
+        '''Collect a batch, waiting at most LEDGER_MAX_BATCH_LATENCY after the first entry.
+
+        Returns an empty batch if nothing arrived within LEDGER_MAX_BATCH_LATENCY, so
+        stale entries are checked regularly.
+        '''
+        batch = []
+        if time.monotonic() - self.last_claim >= LEDGER_CLAIM_IDLE:
+            batch = await self.claim_stale()
+        deadline = None
+        while len(batch) < LEDGER_BATCH_SIZE and self.running:
+            now = time.monotonic()
+            if deadline is None and batch:
+                deadline = now + LEDGER_MAX_BATCH_LATENCY
+            timeout = deadline - now if deadline else LEDGER_MAX_BATCH_LATENCY
+            if timeout <= 0:
+                break
+            response = await redis_client.xreadgroup(
+                LEDGER_GROUP, self.consumer, {LEDGER_STREAM_KEY: ">"},
+                count=LEDGER_BATCH_SIZE - len(batch), block=max(1, int(timeout * 1000)))
+            if not response and not batch:
+                break
+            for _, entries in response:
+                batch += entries
+        return batch
+
+    async def write(self, batch: list) -> None:
+        '''Write a batch, then acknowledge and delete its entries.'''
+        await rq.insert_ledger_entries([to_row(entry_id, fields) for entry_id, fields in batch])
+        entry_ids = [entry_id for entry_id, _ in batch]
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.xack(LEDGER_STREAM_KEY, LEDGER_GROUP, *entry_ids)
+        pipe.xdel(LEDGER_STREAM_KEY, *entry_ids)
+        await pipe.execute()
+
+    async def _run(self) -> None:
+        batch = []
+        while self.running:
+            try:
+                batch = batch or await self.collect()
+                if batch:
+                    await self.write(batch)
+                    batch = []
+            except Exception as e:
+                # The batch stays pending and is written again on the next iteration
+                logger.error(f"Writing ledger entries failed: {e}")
+                await asyncio.sleep(LEDGER_MAX_BATCH_LATENCY)
+        if batch:
+            try:
+                await self.write(batch)
+            except Exception as e:
+                logger.error(f"Writing ledger entries failed on shutdown: {e}")
+
+
+ledger_writer = LedgerWriter()
@@ -0,0 +1,114 @@
+"""
+Logging setup shared by the whole bot.
+
+This module provides:
+- setup_logging: replaces loguru's default handler with one enqueued file sink writing
+  JSON lines and an optional enqueued console sink, so records are written by background
+  threads and handlers never wait for disk I/O
+- LogContext: outer update middleware adding `update_id` and `user_id` to every record
+  logged while the update is handled
+- debug: per-update debug logging which is sampled (LOG_DEBUG_SAMPLE_RATE) and rate limited
+  (LOG_DEBUG_MAX_PER_SECOND), so its cost stays flat as traffic grows
+
+setup_logging is called once by main.py, modules only import `logger` from loguru.
+"""
+
+import json
+import os
+import random
+import sys
+import time
+import traceback
+from dotenv import load_dotenv
+from loguru import logger
+
+load_dotenv()
+
+LOG_LEVEL = (os.getenv("LOG_LEVEL") or "INFO").upper()
+LOG_FILE = os.getenv("LOG_FILE") or "logs/log.log"
+LOG_ROTATION = os.getenv("LOG_ROTATION") or "1 day"
+LOG_CONSOLE_LEVEL = (os.getenv("LOG_CONSOLE_LEVEL") or "INFO").upper()
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE") or 0.01)
+LOG_DEBUG_MAX_PER_SECOND = float(os.getenv("LOG_DEBUG_MAX_PER_SECOND") or 100)
+
+# Updated by setup_logging, debug records are dropped for free when the level is above DEBUG
+debug_enabled = False
+
+
+def format_json(record) -> str:
+    '''Serialize a record to one compact JSON line, stored in `extra` for the sink format.'''
+    entry = {
+        "time": record["time"].isoformat(),
+        "level": record["level"].name,
+        "message": record["message"],
+        "logger": record["name"],
+        "function": record["function"],
+        "line": record["line"],
+    }
+    entry.update({key: value for key, value in record["extra"].items() if key != "json" and value is not None})
+    if record["exception"] is not None:
+        entry["exception"] = "".join(traceback.format_exception(*record["exception"]))
+    record["extra"]["json"] = json.dumps(entry, default=str, ensure_ascii=False)
+    return "{extra[json]}\n"
+
+
+def setup_logging() -> None:
+    '''Install the sinks, replacing any installed before.'''
+    global debug_enabled
+    logger.remove()
+    logger.configure(extra={"update_id": None, "user_id": None})
+    logger.add(LOG_FILE, level=LOG_LEVEL, format=format_json, rotation=LOG_ROTATION, enqueue=True)
+    if LOG_CONSOLE_LEVEL != "NONE":
+        logger.add(sys.stderr, level=LOG_CONSOLE_LEVEL, enqueue=True)
+    debug_enabled = logger.level(LOG_LEVEL).no <= logger.level("DEBUG").no
+
+
+class DebugSampler():
+    '''Token bucket admitting a sampled share of debug records, at most `rate` per second.'''
+
+    def __init__(self, sample_rate: float, rate: float):
+        self.sample_rate = sample_rate
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        # Records dropped by the rate limit since the last admitted one
+        self.dropped = 0
+
+    def admit(self) -> bool:
+        if random.random() >= self.sample_rate:
+            return False
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            self.dropped += 1
+            return False
+        self.tokens -= 1
+        return True
+
+
+debug_sampler = DebugSampler(LOG_DEBUG_SAMPLE_RATE, LOG_DEBUG_MAX_PER_SECOND)
+
+
+def debug(message: str, *args, **kwargs) -> None:
+    '''Log a per-update debug record if it is sampled and within the rate limit.
+
+    Arguments are formatted only for admitted records, so pass them separately
+    instead of formatting the message in advance.
+
+    args:
+        message (str): Message with `{}` placeholders for args and kwargs
+    '''
+    if not debug_enabled or not debug_sampler.admit():
+        return
+    dropped, debug_sampler.dropped = debug_sampler.dropped, 0
+    logger.opt(depth=1).bind(sampled=LOG_DEBUG_SAMPLE_RATE, dropped=dropped or None).debug(message, *args, **kwargs)
+
+
+class LogContext():
+    '''Outer update middleware adding update_id and user_id to records logged while handling the update.'''
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        with logger.contextualize(update_id=event.update_id, user_id=user.id if user else None):
+            return await handler(event, data)
@@ -0,0 +1,228 @@
+"""
+Prometheus metrics for handlers, backends and the sync worker.
+
+This module provides:
+- Histogram, Counter: minimal metric types rendered in the Prometheus text format
+- timed / timed_methods: decorators recording the duration of coroutines into a histogram
+- HandlerTimer: innermost router middleware timing each handler
+- TelegramRequestTimer: Bot session middleware timing each Telegram API call
+- register_stats: exposes `get_stats()` dictionaries (pools, outbound queue) as gauges
+- start_metrics_server: aiohttp server answering GET /metrics
+
+Metrics are collected only when METRICS_ENABLED=true. Otherwise decorators return
+functions unchanged and observing or counting returns immediately.
+"""
+
+import bisect
+import functools
+import inspect
+import os
+import time
+from contextlib import contextmanager
+from typing import Callable
+from aiohttp import web
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from dotenv import load_dotenv
+from loguru import logger
+
+load_dotenv()
+
+METRICS_ENABLED = (os.getenv("METRICS_ENABLED") or "false").lower() == "true"
+METRICS_HOST = os.getenv("METRICS_HOST") or "0.0.0.0"
+METRICS_PORT = int(os.getenv("METRICS_PORT") or 9100)
+
+# Latency buckets in seconds, from a single Redis round trip to a slow Telegram call
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = []
+STATS_SOURCES = []
+
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    '''Render a label set, e.g. `{handler="get_profile",le="0.1"}`.'''
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram():
+    '''Histogram with fixed buckets and optional labels.'''
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # label values -> [count per bucket..., +Inf count, sum]
+        self.series: dict[tuple, list] = {}
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *labels) -> None:
+        '''Record a value for the given label values.'''
+        if not METRICS_ENABLED:
+            return
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        '''Record the duration of the wrapped block.'''
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labels, f'le="{bound}"')} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Counter():
+    '''Monotonic counter with optional labels.'''
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values: dict[tuple, float] = {}
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        '''Increase the counter for the given label values.'''
+        if not METRICS_ENABLED:
+            return
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+handler_latency = Histogram("bot_handler_duration_seconds", "Duration of router handlers", ("handler",))
+rate_limiter_latency = Histogram("bot_rate_limiter_duration_seconds", "Duration of RateLimiter excluding the handler")
+redis_latency = Histogram("bot_redis_operation_duration_seconds", "Duration of UserSession Redis operations", ("operation",))
+db_latency = Histogram("bot_db_query_duration_seconds", "Duration of database requests", ("query",))
+telegram_latency = Histogram("bot_telegram_request_duration_seconds", "Duration of Telegram API calls", ("method",))
+sync_pass_latency = Histogram("bot_sync_pass_duration_seconds", "Duration of cache-to-database sync passes", ("kind",),
+                              buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0))
+blacklisted_users = Counter("bot_blacklisted_users_total", "Users blacklisted for flooding")
+captcha_attempts = Counter("bot_captcha_attempts_total", "Captcha answers by result", ("result",))
+spins = Counter("bot_spins_total", "Spins by outcome", ("outcome",))
+slow_updates = Counter("bot_slow_updates_total", "Updates slower than PROFILING_SLOW_UPDATE_THRESHOLD by handler", ("handler",))
+
+
+def timed(histogram: Histogram, label: str | None = None) -> Callable:
+    '''Decorate a coroutine function to record its duration.
+
+    args:
+        histogram (Histogram): Histogram with a single label
+        label (str | None): Label value, the function name by default
+
+    return:
+        Callable: Decorator, which returns the function unchanged when metrics are disabled
+    '''
+    def decorator(func):
+        if not METRICS_ENABLED:
+            return func
+        label_value = label or func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, label_value)
+        return wrapper
+    return decorator
+
+
+def timed_methods(histogram: Histogram) -> Callable:
+    '''Class decorator applying `timed` to every public coroutine method, labelled by method name.'''
+    def decorator(cls):
+        for name, member in list(vars(cls).items()):
+            if not name.startswith("_") and inspect.iscoroutinefunction(member):
+                setattr(cls, name, timed(histogram)(member))
+        return cls
+    return decorator
+
+
+def register_stats(prefix: str, get_stats: Callable[[], dict], labels: dict | None = None) -> None:
+    '''Expose every value of a statistics dictionary as a gauge named `{prefix}_{key}`.
+
+    args:
+        prefix (str): Metric name prefix
+        get_stats (Callable[[], dict]): Function returning current statistics
+        labels (dict | None): Labels added to every gauge, e.g. {"pool": "redis"}
+    '''
+    STATS_SOURCES.append((prefix, get_stats, labels or {}))
+
+
+class HandlerTimer():
+    '''Router middleware recording the duration of the handler, it must be registered last.'''
+
+    async def __call__(self, handler, event, data):
+        if not METRICS_ENABLED:
+            return await handler(event, data)
+        with handler_latency.time(data["handler"].callback.__name__):
+            return await handler(event, data)
+
+
+class TelegramRequestTimer(BaseRequestMiddleware):
+    '''Bot session middleware recording the duration of Telegram API calls, excluding outbound queueing.'''
+
+    async def __call__(self, make_request, bot, method):
+        with telegram_latency.time(method.__api_method__):
+            return await make_request(bot, method)
+
+
+def render() -> str:
+    '''Render all metrics in the Prometheus text format.'''
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    gauges: dict[str, list[str]] = {}
+    for prefix, get_stats, labels in STATS_SOURCES:
+        for key, value in get_stats().items():
+            name = f"{prefix}_{key}"
+            gauges.setdefault(name, []).append(
+                f"{name}{format_labels(tuple(labels), tuple(labels.values()))} {value}")
+    for name, samples in gauges.items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server() -> web.AppRunner | None:
+    '''Serve GET /metrics on METRICS_HOST:METRICS_PORT if metrics are enabled.
+
+    return:
+        web.AppRunner | None: Runner to clean up on shutdown, None if metrics are disabled
+    '''
+    if not METRICS_ENABLED:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info(f"Serving metrics on {METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
@@ -2,22 +2,29 @@
 Custom Aiogram middleware for user rate limiting and registration.
 
 This module provides:
-- RateLimiter: Limits the number of messages or callbacks a user can send within a time period. Blacklists users who exceed the limit.
+- RateLimiter: Limits the number of messages or callbacks a user can send within a time period. Throttles users who exceed the limit and blacklists users who keep flooding.
 - RegisterUser: Ensures that users are registered in the session and authorized in the database.
 """
 
 import os
+import time
 from dotenv import load_dotenv
 from abc import ABC, abstractmethod
 from aiogram.types import TelegramObject, Message, CallbackQuery
 from typing import Callable, Dict, Any, Awaitable
 
 from app.cache.redis_logic import UserSession
+from app.cache.blacklist import blacklist
+from app.cache.leaderboard import leaderboard
+from app import metrics, log
+from app.profiling import stage
 import app.database.requests as db
 
 load_dotenv()
 
 MESSAGES_PER_PERIOD = int(os.getenv("MESSAGES_PER_PERIOD"))
+# How many requests over the limit are throttled before the user is blacklisted
+RATE_LIMITING_BLACKLIST_EXCESS = int(os.getenv("RATE_LIMITING_BLACKLIST_EXCESS") or MESSAGES_PER_PERIOD)
 
 
 class BaseMiddlware(ABC):
@@ -35,9 +42,11 @@ class RateLimiter(BaseMiddlware):
     """
     Middleware to limit the number of messages/callbacks a user can send.
 
-    - Checks if the user is blacklisted.
-    - Limits messages per MESSAGES_PER_PERIOD.
-    - Adds users to blacklist if limit exceeded.
+    - Checks if the user is blacklisted using the in-process blacklist cache.
+    - Limits messages per MESSAGES_PER_PERIOD with the algorithm from RATE_LIMITING_ALGORITHM.
+    - Drops updates over the limit, warning the user on the first one.
+    - Adds users to blacklist if the excess grows over RATE_LIMITING_BLACKLIST_EXCESS.
+    - Passes the session and its cached coins to handlers as `user_session` and `cached_coins`.
     """
     async def __call__(self, handler, event, data) -> Callable | None:
         """
@@ -51,22 +60,59 @@ class RateLimiter(BaseMiddlware):
         Returns:
             Callable | None: Executes the handler if user is within limits, otherwise None.
         """ 
-        if await db.get_user_from_blacklist(event.from_user.id):
-            return
+        started = time.perf_counter()
+        admitted = await self.admit(event, data)
+        metrics.rate_limiter_latency.observe(time.perf_counter() - started)
+        if admitted:
+            with stage("handler"):
+                return await handler(event, data)
+
+    async def admit(self, event, data) -> bool:
+        """
+        Apply rate limiting and blacklisting, and add the session to handler data.
+
+        Args:
+            event (TelegramObject): Incoming Telegram event (Message or CallbackQuery).
+            data (Dict[str, Any]): Additional data passed to the handler.
+
+        Returns:
+            bool: True if the update should be handled.
+        """
+        with stage("blacklist_check"):
+            if event.from_user.id in blacklist:
+                return False
 
-        user_in_db = await db.get_user_from_authorized(event.from_user.id)
         session = UserSession(event.from_user.id)
-        # Creates session for a user from db or from scratch
-        await session.ensure_session(user_in_db)
+        # Applies rate limiting, authorizes the user and refreshes TTL in one round trip
+        with stage("rate_count_and_session"):
+            counters = await session.handle_update()
+        if counters is None:
+            # Creates session for a user from db or from scratch, db is only queried on a cache miss
+            with stage("session_create"):
+                user_in_db = await db.get_user_from_authorized(event.from_user.id)
+                counters = await session.handle_update(user_in_db, create=True)
+                await leaderboard.set_name(event.from_user.id, event.from_user.full_name)
+        excess, coins = counters
 
-        user_messages = await session.handle_messages()
-        
-        if user_messages > MESSAGES_PER_PERIOD:
+        if excess > RATE_LIMITING_BLACKLIST_EXCESS:
             if isinstance(event, Message) or isinstance(event, CallbackQuery):
-                await db.add_user_to_blacklist(event.from_user.id)
-                await session.delete_instance()
+                with stage("blacklisting"):
+                    await db.add_user_to_blacklist(event.from_user.id)
+                    await blacklist.add(event.from_user.id)
+                    await session.delete_instance()
+                    await leaderboard.remove(event.from_user.id)
+                metrics.blacklisted_users.inc()
                 await event.answer("You were blocked! Please contact administrator!")           
-                return
-            
-        await session.authorize_user()
-        return await handler(event, data)
\ No newline at end of file
+                return False
+
+        if excess > 0:
+            log.debug("Throttled with excess {}", excess)
+            # Callbacks are always answered to stop the loading indicator
+            if excess == 1 or isinstance(event, CallbackQuery):
+                await event.answer("Too many requests! Please slow down.")
+            return False
+
+        data["user_session"] = session
+        data["cached_coins"] = coins
+        log.debug("Admitted with {} coins", coins)
+        return True
\ No newline at end of file
@@ -0,0 +1,177 @@
+"""
+Outbound Telegram API dispatch with rate shaping.
+
+This module defines the OutboundLimiter class, a Bot session request middleware which:
+- Queues messaging calls (methods with a chat_id) behind a per-chat token bucket
+  and a global token bucket, keeping Telegram's per-chat and global limits
+- Honors `retry_after` from 429 responses by pausing the chat and retrying
+- Coalesces superseded edit_text calls: a newer edit of a message whose previous edit is still
+  queued replaces its text, so only one API call is made and both callers get its result
+- Records queue depth and wait time statistics
+"""
+
+import asyncio
+import os
+import time
+from dotenv import load_dotenv
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import EditMessageText
+from loguru import logger
+
+from app import metrics
+
+load_dotenv()
+
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE") or 30)
+OUTBOUND_GLOBAL_BURST = int(os.getenv("OUTBOUND_GLOBAL_BURST") or 30)
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE") or 1)
+OUTBOUND_CHAT_BURST = int(os.getenv("OUTBOUND_CHAT_BURST") or 3)
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES") or 3)
+# Idle per-chat buckets are dropped once more chats than this are tracked
+OUTBOUND_MAX_TRACKED_CHATS = 10000
+
+
+class TokenBucket():
+    '''Reservation-based token bucket.
+
+    Every call reserves a token immediately and gets the delay until the token is
+    available, so callers are served in FIFO order without locks.
+    '''
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        '''Take a token.
+
+        return:
+            float: Seconds to wait before the token may be used
+        '''
+        self._refill()
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        '''Make the next reservations wait at least `seconds`.'''
+        self._refill()
+        self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+    def is_idle(self) -> bool:
+        '''Check if the bucket is full, so dropping it changes nothing.'''
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class OutboundLimiter(BaseRequestMiddleware):
+    '''Request middleware shaping outgoing Telegram API calls.'''
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_BURST)
+        self.chat_buckets: dict[int | str, TokenBucket] = {}
+        # (chat_id, message_id) -> latest queued edit method, whether it was sent, future with its response
+        self.pending_edits: dict[tuple, dict] = {}
+        self.queue_depth = 0
+        self.stats = {"calls": 0, "queued": 0, "max_queue_depth": 0, "wait_total": 0.0,
+                      "wait_max": 0.0, "coalesced": 0, "retries": 0}
+
+    def chat_bucket(self, chat_id: int | str) -> TokenBucket:
+        '''Get or create the token bucket of a chat.'''
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= OUTBOUND_MAX_TRACKED_CHATS:
+                self.chat_buckets = {key: value for key, value in self.chat_buckets.items() if not value.is_idle()}
+            bucket = self.chat_buckets[chat_id] = TokenBucket(OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST)
+        return bucket
+
+    async def wait_for_slot(self, chat_id: int | str) -> None:
+        '''Wait for a per-chat token, then for a global token.'''
+        started = time.monotonic()
+        self.queue_depth += 1
+        self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], self.queue_depth)
+        try:
+            delay = self.chat_bucket(chat_id).reserve()
+            if delay:
+                await asyncio.sleep(delay)
+            delay = self.global_bucket.reserve()
+            if delay:
+                await asyncio.sleep(delay)
+        finally:
+            self.queue_depth -= 1
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            self.stats["queued"] += 1
+            self.stats["wait_total"] += waited
+            self.stats["wait_max"] = max(self.stats["wait_max"], waited)
+
+    async def __call__(self, make_request, bot, method):
+        '''Shape the call and send it, retrying after flood control errors.'''
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        self.stats["calls"] += 1
+
+        edit = None
+        if isinstance(method, EditMessageText) and method.message_id is not None:
+            edit_key = (chat_id, method.message_id)
+            edit = self.pending_edits.get(edit_key)
+            if edit is not None and not edit["sent"]:
+                # An older edit of this message is still queued, it will send this text instead
+                edit["method"] = method
+                self.stats["coalesced"] += 1
+                return await asyncio.shield(edit["future"])
+            edit = self.pending_edits[edit_key] = {
+                "method": method, "sent": False, "future": asyncio.get_running_loop().create_future()}
+
+        try:
+            for attempt in range(OUTBOUND_MAX_RETRIES + 1):
+                await self.wait_for_slot(chat_id)
+                if edit:
+                    edit["sent"] = True
+                    method = edit["method"]
+                try:
+                    response = await make_request(bot, method)
+                except TelegramRetryAfter as e:
+                    if attempt == OUTBOUND_MAX_RETRIES:
+                        raise
+                    self.stats["retries"] += 1
+                    logger.warning(f"Flood control in chat {chat_id}, retrying in {e.retry_after}s")
+                    self.chat_bucket(chat_id).pause(e.retry_after)
+                    continue
+                if edit:
+                    edit["future"].set_result(response)
+                return response
+        except BaseException as e:
+            if edit and not edit["future"].done():
+                if isinstance(e, asyncio.CancelledError):
+                    edit["future"].cancel()
+                else:
+                    edit["future"].set_exception(e)
+                    # Nobody may wait for this edit, avoid "exception was never retrieved"
+                    edit["future"].exception()
+            raise
+        finally:
+            if edit and self.pending_edits.get(edit_key) is edit:
+                del self.pending_edits[edit_key]
+
+    def get_stats(self) -> dict:
+        '''Get queue statistics.
+
+        return:
+            dict: Counters, current queue depth and average wait in seconds
+        '''
+        queued = self.stats["queued"]
+        return {**self.stats, "queue_depth": self.queue_depth,
+                "wait_avg": self.stats["wait_total"] / queued if queued else 0.0}
+
+
+outbound_limiter = OutboundLimiter()
+metrics.register_stats("bot_outbound", outbound_limiter.get_stats)
@@ -0,0 +1,79 @@
+"""
+Payout table of the slot machine.
+
+Telegram's 🎰 dice has 64 equally likely values, each showing three reels of four symbols
+(bar, grapes, lemon, seven). The value is decoded as value - 1 = left + 4 * middle + 16 * right,
+e.g. 1 is bar bar bar and 64 is seven seven seven.
+
+The table maps combinations of reel symbols to bid multipliers and is loaded from the
+JSON file PAYOUTS_FILE (app/payouts.json by default), for example:
+
+    {"seven seven seven": 10, "bar bar bar": 5}
+
+A winning spin pays the bid times the multiplier and returns the bid, any other spin loses the bid.
+
+This module provides:
+- PAYOUTS: multiplier of every winning dice value
+- payout: coins returned for a spin
+- payout_lines: table rows as emoji and multiplier, for the banner
+- return_to_player: expected share of bids returned
+"""
+
+import json
+import os
+from pathlib import Path
+from dotenv import load_dotenv
+
+load_dotenv()
+
+PAYOUTS_FILE = os.getenv("PAYOUTS_FILE") or str(Path(__file__).with_name("payouts.json"))
+SYMBOLS = ("bar", "grapes", "lemon", "seven")
+SYMBOL_EMOJI = {"bar": "⬜️", "grapes": "🍇", "lemon": "🍋", "seven": "7️⃣"}
+DICE_VALUES = range(1, 65)
+
+
+def dice_value(combination: str) -> int:
+    '''Get the dice value of a combination of three symbols, e.g. "seven seven seven".'''
+    reels = combination.split()
+    if len(reels) != 3 or any(symbol not in SYMBOLS for symbol in reels):
+        raise ValueError(f"Invalid combination {combination!r}, expected three of {', '.join(SYMBOLS)}")
+    return 1 + sum(SYMBOLS.index(symbol) * 4 ** position for position, symbol in enumerate(reels))
+
+
+def load_payouts(path: str) -> dict[int, int]:
+    '''Load a payout table.
+
+    args:
+        path (str): JSON file mapping combinations to multipliers
+
+    return:
+        dict[int, int]: Multiplier per winning dice value, in the order of the file
+    '''
+    with open(path, encoding="utf-8") as file:
+        table = json.load(file)
+    payouts = {}
+    for combination, multiplier in table.items():
+        if not isinstance(multiplier, int) or multiplier <= 0:
+            raise ValueError(f"Multiplier of {combination!r} must be a positive integer, got {multiplier!r}")
+        payouts[dice_value(combination)] = multiplier
+    return payouts
+
+
+PAYOUTS = load_payouts(PAYOUTS_FILE)
+
+
+def payout(bid: int, value: int, payouts: dict[int, int] = PAYOUTS) -> int:
+    '''Get coins returned for a spin, the bid included, 0 for a loss.'''
+    multiplier = payouts.get(value, 0)
+    return bid * (multiplier + 1) if multiplier else 0
+
+
+def payout_lines(payouts: dict[int, int] = PAYOUTS) -> list[tuple[str, int]]:
+    '''Get winning combinations as reel emoji and multiplier.'''
+    return [("".join(SYMBOL_EMOJI[SYMBOLS[(value - 1) >> 2 * reel & 3]] for reel in range(3)), multiplier)
+            for value, multiplier in payouts.items()]
+
+
+def return_to_player(payouts: dict[int, int] = PAYOUTS) -> float:
+    '''Get the exact expected share of bids returned to players.'''
+    return sum(payout(1, value, payouts) for value in DICE_VALUES) / len(DICE_VALUES)
@@ -0,0 +1,58 @@
+"""
+Connection pool statistics.
+
+This module defines the PoolStats class, which records for a connection pool:
+- How many connections were checked out
+- How long callers waited for a connection (total, maximum and average)
+- How many checkouts failed, e.g. timed out because the pool was exhausted
+
+The Postgres and Redis pools update their own PoolStats instance on every checkout.
+"""
+
+import time
+from contextlib import contextmanager
+
+
+class PoolStats():
+    '''Checkout counters and wait times of one connection pool.'''
+
+    def __init__(self, name: str):
+        '''Initialize empty statistics.
+
+        args:
+            name (str): Pool name used in logs
+        '''
+        self.name = name
+        self.checkouts = 0
+        self.failures = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @contextmanager
+    def measure(self):
+        '''Time a checkout wrapped in this context manager.'''
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.failures += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    def get_stats(self) -> dict:
+        '''Get pool statistics.
+
+        return:
+            dict: Counters and wait times in seconds
+        '''
+        return {"checkouts": self.checkouts, "failures": self.failures, "wait_total": self.wait_total,
+                "wait_max": self.wait_max, "wait_avg": self.wait_total / self.checkouts if self.checkouts else 0.0}
+
+    def __str__(self) -> str:
+        stats = self.get_stats()
+        return (f"{self.name} pool: {stats['checkouts']} checkouts, {stats['failures']} failed, "
+                f"wait avg {stats['wait_avg'] * 1000:.2f}ms max {stats['wait_max'] * 1000:.2f}ms")
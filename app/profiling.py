@@ -0,0 +1,190 @@
+"""
+Opt-in profiling of slow updates.
+
+This module provides:
+- UpdateProfiler: router middleware, registered before RateLimiter, timing every update
+  handled by the router and logging a per-stage breakdown of updates slower than
+  PROFILING_SLOW_UPDATE_THRESHOLD
+- stage: context manager timing a stage of the update being handled, e.g. the blacklist
+  check, the session round trip or the handler
+- TelegramCallProfiler: Bot session middleware adding every Telegram API call, outbound
+  queueing included, as a stage of the update making it
+- Sampled captures: PROFILING_CAPTURE_SAMPLE_RATE of updates are run under cProfile (or
+  yappi with PROFILING_CAPTURE_BACKEND=yappi) and the profile is written to
+  PROFILING_CAPTURE_DIR in the pstats format, e.g. for `python -m pstats` or snakeviz
+
+Stages are collected in a context variable, so concurrent updates never mix. Profilers
+see the whole thread though: a capture also contains coroutines of other updates
+interleaved with the sampled one, and only one capture runs at a time.
+
+Nothing is timed unless PROFILING_ENABLED=true, stage then returns a shared no-op context.
+"""
+
+import asyncio
+import cProfile
+import os
+import random
+import time
+from contextlib import nullcontext
+from contextvars import ContextVar
+from pathlib import Path
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from dotenv import load_dotenv
+from loguru import logger
+
+from app import metrics
+
+load_dotenv()
+
+PROFILING_ENABLED = (os.getenv("PROFILING_ENABLED") or "false").lower() == "true"
+PROFILING_SLOW_UPDATE_THRESHOLD = float(os.getenv("PROFILING_SLOW_UPDATE_THRESHOLD") or 0.5)
+PROFILING_CAPTURE_SAMPLE_RATE = float(os.getenv("PROFILING_CAPTURE_SAMPLE_RATE") or 0)
+PROFILING_CAPTURE_BACKEND = (os.getenv("PROFILING_CAPTURE_BACKEND") or "cprofile").lower()
+PROFILING_CAPTURE_DIR = os.getenv("PROFILING_CAPTURE_DIR") or "logs/profiles"
+
+NO_STAGE = nullcontext()
+
+
+class UpdateProfile():
+    '''Stages of one update, as offsets from its start and durations in seconds.'''
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: list[tuple[str, float, float]] = []
+        self.finished = False
+
+    def record(self, name: str, started: float, duration: float) -> None:
+        # Background tasks started by the handler inherit the profile, their stages come too late
+        if not self.finished:
+            self.stages.append((name, started - self.started, duration))
+
+    def stage(self, name: str) -> "Stage":
+        return Stage(self, name)
+
+    def as_records(self) -> list[dict]:
+        '''Get stages as dictionaries with offset and duration in milliseconds, for JSON logs.'''
+        return [{"stage": name, "offset_ms": round(offset * 1000, 2), "duration_ms": round(duration * 1000, 2)}
+                for name, offset, duration in self.stages]
+
+    def breakdown(self) -> str:
+        '''Render stages in the order they started, e.g. `+0.1ms handler 2.3ms`.'''
+        return ", ".join(f"+{offset * 1000:.1f}ms {name} {duration * 1000:.1f}ms"
+                         for name, offset, duration in sorted(self.stages, key=lambda stage: stage[1]))
+
+
+class Stage():
+    '''Context manager recording its duration as a stage of a profile.'''
+
+    def __init__(self, profile: UpdateProfile, name: str):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profile.record(self.name, self.started, time.perf_counter() - self.started)
+
+
+current_profile: ContextVar[UpdateProfile | None] = ContextVar("current_profile", default=None)
+
+
+def stage(name: str):
+    '''Time a stage of the update being profiled, a no-op outside of profiled updates.
+
+    args:
+        name (str): Stage name shown in the breakdown
+    '''
+    profile = current_profile.get()
+    if profile is None:
+        return NO_STAGE
+    return profile.stage(name)
+
+
+class Capture():
+    '''cProfile or yappi profiler of one update, written to PROFILING_CAPTURE_DIR.'''
+
+    # Profilers are per thread, a second one cannot be enabled while one is running
+    running = False
+
+    def __init__(self):
+        self.backend = PROFILING_CAPTURE_BACKEND
+        if self.backend == "yappi":
+            try:
+                import yappi
+            except ImportError:
+                logger.warning("PROFILING_CAPTURE_BACKEND=yappi but yappi is not installed, using cProfile")
+                self.backend = "cprofile"
+            else:
+                self.yappi = yappi
+        self.profiler = cProfile.Profile() if self.backend == "cprofile" else None
+
+    def start(self) -> None:
+        Capture.running = True
+        if self.profiler is not None:
+            self.profiler.enable()
+        else:
+            # Wall time, so awaited I/O is attributed to the coroutines waiting for it
+            self.yappi.set_clock_type("wall")
+            self.yappi.start()
+
+    def stop(self) -> None:
+        if self.profiler is not None:
+            self.profiler.disable()
+        else:
+            self.yappi.stop()
+        Capture.running = False
+
+    def save(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if self.profiler is not None:
+            self.profiler.dump_stats(path)
+        else:
+            self.yappi.get_func_stats().save(str(path), type="pstat")
+            self.yappi.clear_stats()
+
+
+class UpdateProfiler():
+    '''Router middleware profiling updates, it must be registered before RateLimiter.'''
+
+    async def __call__(self, handler, event, data):
+        if not PROFILING_ENABLED:
+            return await handler(event, data)
+        profile = UpdateProfile()
+        token = current_profile.set(profile)
+        capture = None
+        if PROFILING_CAPTURE_SAMPLE_RATE and not Capture.running and random.random() < PROFILING_CAPTURE_SAMPLE_RATE:
+            capture = Capture()
+            capture.start()
+        try:
+            return await handler(event, data)
+        finally:
+            if capture is not None:
+                capture.stop()
+            profile.finished = True
+            current_profile.reset(token)
+            duration = time.perf_counter() - profile.started
+            name = data["handler"].callback.__name__
+            if duration >= PROFILING_SLOW_UPDATE_THRESHOLD:
+                metrics.slow_updates.inc(name)
+                logger.bind(stages=profile.as_records()).warning(
+                    f"Slow update handled by {name} in {duration * 1000:.1f}ms: {profile.breakdown()}")
+            if capture is not None:
+                update_id = data["event_update"].update_id
+                path = Path(PROFILING_CAPTURE_DIR) / f"{int(time.time())}-{update_id}-{name}-{duration * 1000:.0f}ms.prof"
+                await self.save(capture, path)
+
+    async def save(self, capture: Capture, path: Path) -> None:
+        try:
+            await asyncio.to_thread(capture.save, path)
+        except Exception as e:
+            logger.error(f"Profile capture was not written to {path}: {e}")
+
+
+class TelegramCallProfiler(BaseRequestMiddleware):
+    '''Bot session middleware recording Telegram API calls as stages, it must be registered before OutboundLimiter.'''
+
+    async def __call__(self, make_request, bot, method):
+        with stage(f"telegram:{method.__api_method__}"):
+            return await make_request(bot, method)
@@ -0,0 +1,218 @@
+"""
+Durable scheduler for delayed bot replies.
+
+This module defines the ReplyScheduler class, which:
+- Stores scheduled messages in the Redis sorted set `scheduled_replies` scored by due time
+- Keeps an in-process timer (a heap served by one task) that sends messages when they are due
+- Claims every message by moving it to the in-flight sorted set `scheduled_replies:inflight`
+  before sending, so one replica sends it at a time, and removes it only once it is sent
+- Reschedules messages whose sending failed with an exponential backoff, up to
+  SCHEDULER_MAX_ATTEMPTS attempts, and drops the ones Telegram rejects for good
+- Picks up overdue messages left by restarted or crashed processes, and returns messages
+  claimed more than SCHEDULER_CLAIM_TIMEOUT seconds ago to the schedule
+
+Delivery is at least once: a process stalled past the claim timeout may send a message
+which another process sends again. Handlers schedule the reply and return immediately
+instead of sleeping.
+"""
+
+import asyncio
+import heapq
+import json
+import os
+import time
+import uuid
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramNotFound
+from aiogram.types import InlineKeyboardMarkup
+from dotenv import load_dotenv
+from loguru import logger
+
+from app.cache.redis_logic import redis_client
+
+load_dotenv()
+
+SCHEDULED_REPLIES_KEY = "scheduled_replies"
+# Messages being sent, scored by the time their claim expires at in ms
+INFLIGHT_REPLIES_KEY = "scheduled_replies:inflight"
+# How often Redis is checked for overdue messages of other processes, seconds
+SCHEDULER_POLL_INTERVAL = float(os.getenv("SCHEDULER_POLL_INTERVAL") or 5)
+# Seconds after which a claimed message which was neither sent nor rescheduled is scheduled again
+SCHEDULER_CLAIM_TIMEOUT = float(os.getenv("SCHEDULER_CLAIM_TIMEOUT") or 60)
+SCHEDULER_MAX_ATTEMPTS = int(os.getenv("SCHEDULER_MAX_ATTEMPTS") or 5)
+# Delay before the second attempt, doubled for every further one, seconds
+SCHEDULER_RETRY_DELAY = float(os.getenv("SCHEDULER_RETRY_DELAY") or 5)
+
+# Moves message ARGV[1] from the schedule KEYS[1] to the in-flight set KEYS[2] with claim expiry ARGV[2].
+# Returns 1, or 0 if another process has claimed it.
+CLAIM_LUA = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+return 1
+"""
+
+# Removes message ARGV[1] from the in-flight set KEYS[1] and, if ARGV[2] is given, schedules
+# message ARGV[2] in KEYS[2] at ARGV[3]. Returns 0 without rescheduling if the claim was lost.
+RELEASE_LUA = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+if ARGV[2] then
+    redis.call('ZADD', KEYS[2], ARGV[3], ARGV[2])
+end
+return 1
+"""
+
+# Moves up to ARGV[2] messages whose claim expired by ARGV[1] from the in-flight set KEYS[1]
+# back to the schedule KEYS[2], due at ARGV[1]. Returns the number of moved messages.
+REQUEUE_LUA = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, payload in ipairs(expired) do
+    redis.call('ZREM', KEYS[1], payload)
+    redis.call('ZADD', KEYS[2], ARGV[1], payload)
+end
+return #expired
+"""
+
+claim_script = redis_client.register_script(CLAIM_LUA)
+release_script = redis_client.register_script(RELEASE_LUA)
+requeue_script = redis_client.register_script(REQUEUE_LUA)
+
+
+class ReplyScheduler():
+    '''Scheduler of delayed messages backed by a Redis sorted set.'''
+
+    def __init__(self):
+        '''Initialize an idle scheduler, `start` must be called with a bot.'''
+        self.bot: Bot | None = None
+        self.timers: list[tuple[float, str]] = []
+        self.wakeup = asyncio.Event()
+        self.tasks: list[asyncio.Task] = []
+
+    async def start(self, bot: Bot) -> None:
+        '''Load pending messages and start delivering.
+
+        args:
+            bot (Bot): Bot used to send messages
+
+        return:
+            None
+        '''
+        self.bot = bot
+        pending = await redis_client.zrange(SCHEDULED_REPLIES_KEY, 0, -1, withscores=True)
+        for payload, due in pending:
+            heapq.heappush(self.timers, (due / 1000, payload))
+        self.tasks = [asyncio.create_task(self._run()), asyncio.create_task(self._poll())]
+        logger.info(f"Scheduler started with {len(pending)} pending replies")
+
+    async def stop(self) -> None:
+        '''Stop delivering, undelivered messages stay in Redis.'''
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def schedule(self, delay: float, chat_id: int, text: str, parse_mode: str | None = None,
+                       reply_markup: InlineKeyboardMarkup | None = None) -> None:
+        '''Schedule a message.
+
+        args:
+            delay (float): Seconds until the message is sent
+            chat_id (int): Telegram chat ID
+            text (str): Message text
+            parse_mode (str | None): Telegram parse mode
+            reply_markup (InlineKeyboardMarkup | None): Inline keyboard
+
+        return:
+            None
+        '''
+        payload = json.dumps({
+            "id": uuid.uuid4().hex,
+            "chat_id": chat_id,
+            "text": text,
+            "parse_mode": parse_mode,
+            "reply_markup": reply_markup.model_dump(exclude_none=True) if reply_markup else None,
+        }, ensure_ascii=False)
+        due = time.time() + delay
+        await redis_client.zadd(SCHEDULED_REPLIES_KEY, {payload: int(due * 1000)})
+        self._push(due, payload)
+
+    def _push(self, due: float, payload: str) -> None:
+        '''Add a timer, waking the delivery task if it is the earliest one.'''
+        heapq.heappush(self.timers, (due, payload))
+        if self.timers[0][1] == payload:
+            self.wakeup.set()
+
+    async def _run(self) -> None:
+        '''Sleep until the earliest timer and deliver due messages.'''
+        while True:
+            self.wakeup.clear()
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                _, payload = heapq.heappop(self.timers)
+                asyncio.create_task(self._deliver(payload))
+            timeout = self.timers[0][0] - now if self.timers else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _poll(self) -> None:
+        '''Take over overdue messages scheduled by other processes and reschedule expired claims.'''
+        while True:
+            await asyncio.sleep(SCHEDULER_POLL_INTERVAL)
+            try:
+                requeued = await requeue_script(keys=[INFLIGHT_REPLIES_KEY, SCHEDULED_REPLIES_KEY],
+                                                args=[int(time.time() * 1000), 100])
+                if requeued:
+                    logger.warning(f"{requeued} scheduled replies claimed by stalled or stopped processes were rescheduled")
+                overdue = await redis_client.zrangebyscore(
+                    SCHEDULED_REPLIES_KEY, "-inf", int((time.time() - SCHEDULER_POLL_INTERVAL) * 1000))
+                for payload in overdue:
+                    asyncio.create_task(self._deliver(payload))
+            except Exception as e:
+                logger.error(f"Polling scheduled replies failed: {e}")
+
+    async def _deliver(self, payload: str) -> None:
+        '''Claim a message, send it and release it, rescheduling it if sending failed.'''
+        try:
+            # Only the process that moves the message to the in-flight set sends it
+            claim_expiry = int((time.time() + SCHEDULER_CLAIM_TIMEOUT) * 1000)
+            if not await claim_script(keys=[SCHEDULED_REPLIES_KEY, INFLIGHT_REPLIES_KEY], args=[payload, claim_expiry]):
+                return
+        except Exception as e:
+            logger.error(f"Scheduled reply was not claimed: {e}")
+            return
+        message = json.loads(payload)
+        retry = None
+        try:
+            reply_markup = message["reply_markup"]
+            await self.bot.send_message(
+                chat_id=message["chat_id"],
+                text=message["text"],
+                parse_mode=message["parse_mode"],
+                reply_markup=InlineKeyboardMarkup.model_validate(reply_markup) if reply_markup else None,
+            )
+        except (TelegramBadRequest, TelegramForbiddenError, TelegramNotFound) as e:
+            logger.error(f"Scheduled reply to chat {message['chat_id']} was rejected and dropped: {e}")
+        except Exception as e:
+            attempts = message.get("attempts", 1)
+            if attempts >= SCHEDULER_MAX_ATTEMPTS:
+                logger.error(f"Scheduled reply to chat {message['chat_id']} was dropped after {attempts} attempts: {e}")
+            else:
+                retry = json.dumps(message | {"attempts": attempts + 1}, ensure_ascii=False)
+                due = time.time() + SCHEDULER_RETRY_DELAY * 2 ** (attempts - 1)
+                logger.warning(f"Scheduled reply to chat {message['chat_id']} was not delivered, "
+                               f"retrying in {due - time.time():.0f}s: {e}")
+        try:
+            args = [payload] + ([retry, int(due * 1000)] if retry else [])
+            # A lost claim was rescheduled by another process already
+            if await release_script(keys=[INFLIGHT_REPLIES_KEY, SCHEDULED_REPLIES_KEY], args=args) and retry:
+                self._push(due, retry)
+        except Exception as e:
+            logger.error(f"Scheduled reply was not released, it is rescheduled when its claim expires: {e}")
+
+
+scheduler = ReplyScheduler()
@@ -0,0 +1,161 @@
+"""
+Monte Carlo simulator of the slot machine payout table.
+
+Spins are drawn as uniformly distributed dice values and mapped to payouts with NumPy
+array indexing, so millions of spins are simulated per second. For a payout table
+(app/payouts.json or --payouts) this module reports:
+- Return to player (RTP), simulated and exact, and the hit frequency
+- Variance and standard deviation of the net result of one spin, in bids
+- Bankroll survival: the share of players starting with --balance coins and betting --bid
+  every spin who can still afford a bid after n spins, and the median number of spins until
+  they run out of coins, i.e. how often players need a top-up
+
+Usage:
+    python -m app.simulator --spins 10000000 --players 100000 --balance 1000 --bid 10
+    python -m app.simulator --payouts new_payouts.json --curve survival.csv
+"""
+
+import argparse
+import time
+import numpy as np
+
+from app.payouts import PAYOUTS, PAYOUTS_FILE, DICE_VALUES, load_payouts, payout, return_to_player
+
+# Random numbers drawn per NumPy call, bounds memory to a few tens of MB
+CHUNK_SIZE = 1_000_000
+# New users start with 1000 coins
+STARTING_BALANCE = 1000
+SURVIVAL_CHECKPOINTS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def payout_vector(payouts: dict[int, int], bid: int = 1) -> np.ndarray:
+    '''Get coins returned for a bid, indexed by dice value - 1.'''
+    return np.array([payout(bid, value, payouts) for value in DICE_VALUES], dtype=np.int64)
+
+
+def simulate_spins(payouts: dict[int, int], spins: int, rng: np.random.Generator) -> dict:
+    '''Simulate independent spins with a bid of 1.
+
+    args:
+        payouts (dict[int, int]): Multiplier per winning dice value
+        spins (int): Number of spins
+        rng (np.random.Generator): Random number generator
+
+    return:
+        dict: rtp, hit_rate, variance and std of the net result per spin, spins_per_second
+    '''
+    returned = payout_vector(payouts)
+    total = total_squared = hits = 0
+    started = time.perf_counter()
+    for start in range(0, spins, CHUNK_SIZE):
+        results = returned[rng.integers(0, len(returned), size=min(CHUNK_SIZE, spins - start))]
+        total += int(results.sum())
+        # The net result is the returned amount minus the bid
+        total_squared += int(np.square(results - 1).sum())
+        hits += int(np.count_nonzero(results))
+    elapsed = time.perf_counter() - started
+    mean_net = total / spins - 1
+    variance = total_squared / spins - mean_net ** 2
+    return {
+        "rtp": total / spins,
+        "hit_rate": hits / spins,
+        "variance": variance,
+        "std": variance ** 0.5,
+        "spins_per_second": spins / elapsed,
+    }
+
+
+def exact_variance(payouts: dict[int, int]) -> float:
+    '''Get the exact variance of the net result of one spin with a bid of 1.'''
+    net = payout_vector(payouts) - 1
+    return float(np.mean(np.square(net)) - np.mean(net) ** 2)
+
+
+def simulate_bankrolls(payouts: dict[int, int], players: int, balance: int, bid: int, max_spins: int,
+                       rng: np.random.Generator) -> np.ndarray:
+    '''Simulate players betting the same bid every spin until they cannot afford it.
+
+    Players are simulated in blocks of spins: a block's balances are the cumulative sum of
+    net results, the first spin leaving less than a bid is where the player stops, and only
+    players still able to bid are carried over to the next block.
+
+    args:
+        payouts (dict[int, int]): Multiplier per winning dice value
+        players (int): Number of players
+        balance (int): Starting balance of every player
+        bid (int): Bid of every spin
+        max_spins (int): Spins after which surviving players stop
+        rng (np.random.Generator): Random number generator
+
+    return:
+        np.ndarray: Spins after which every player ran out of coins, max_spins + 1 for players who never did
+    '''
+    net = payout_vector(payouts, bid) - bid
+    played = np.full(players, max_spins + 1, dtype=np.int64)
+    if balance < bid:
+        played[:] = 0
+        return played
+    alive = np.arange(players)
+    balances = np.full(players, balance, dtype=np.int64)
+    spin = 0
+    while len(alive) and spin < max_spins:
+        block = min(max_spins - spin, max(1, CHUNK_SIZE // len(alive)))
+        paths = balances[:, None] + np.cumsum(net[rng.integers(0, len(net), size=(len(alive), block))], axis=1)
+        broke = paths < bid
+        ruined = broke.any(axis=1)
+        played[alive[ruined]] = spin + 1 + broke[ruined].argmax(axis=1)
+        alive, balances = alive[~ruined], paths[~ruined, -1]
+        spin += block
+    return played
+
+
+def survival_curve(played: np.ndarray, max_spins: int) -> np.ndarray:
+    '''Get the share of players able to bid after n spins, for n from 0 to max_spins.'''
+    ruined = np.bincount(played, minlength=max_spins + 2)[:max_spins + 1]
+    return 1 - np.cumsum(ruined) / len(played)
+
+
+def main(payouts_file: str, spins: int, players: int, balance: int, bid: int, max_spins: int,
+         seed: int | None, curve_file: str | None) -> None:
+    payouts = PAYOUTS if payouts_file == PAYOUTS_FILE else load_payouts(payouts_file)
+    rng = np.random.default_rng(seed)
+
+    result = simulate_spins(payouts, spins, rng)
+    print(f"payout table {payouts_file}: {spins} spins, {result['spins_per_second'] / 1e6:.1f}M spins/s")
+    print(f"RTP:                 {result['rtp']:.4%} (exact {return_to_player(payouts):.4%})")
+    print(f"hit frequency:       {result['hit_rate']:.4%}")
+    print(f"net result variance: {result['variance']:.4f} bids² (exact {exact_variance(payouts):.4f}), "
+          f"std {result['std']:.4f} bids")
+
+    started = time.perf_counter()
+    played = simulate_bankrolls(payouts, players, balance, bid, max_spins, rng)
+    elapsed = time.perf_counter() - started
+    curve = survival_curve(played, max_spins)
+    ruined = np.count_nonzero(played <= max_spins)
+    print(f"\n{players} players, balance {balance}, bid {bid}, up to {max_spins} spins "
+          f"({np.minimum(played, max_spins).sum() / elapsed / 1e6:.1f}M spins/s)")
+    if ruined * 2 > players:
+        print(f"median spins until out of coins: {np.median(played):.0f}")
+    else:
+        print(f"median spins until out of coins: over {max_spins}")
+    for checkpoint in SURVIVAL_CHECKPOINTS:
+        if checkpoint <= max_spins:
+            print(f"    able to bid after {checkpoint:>6} spins: {curve[checkpoint]:.2%}")
+    if curve_file:
+        np.savetxt(curve_file, np.column_stack((np.arange(max_spins + 1), curve)), fmt=("%d", "%.6f"),
+                   delimiter=",", header="spins,survival", comments="")
+        print(f"survival curve written to {curve_file}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--payouts", default=PAYOUTS_FILE, help="payout table JSON file")
+    parser.add_argument("--spins", type=int, default=10_000_000, help="spins simulated for RTP and variance")
+    parser.add_argument("--players", type=int, default=100_000, help="players simulated for bankroll survival")
+    parser.add_argument("--balance", type=int, default=STARTING_BALANCE, help="starting balance of every player")
+    parser.add_argument("--bid", type=int, default=10)
+    parser.add_argument("--max-spins", type=int, default=1000, help="spins after which surviving players stop")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--curve", default=None, help="write the survival curve to this CSV file")
+    args = parser.parse_args()
+    main(args.payouts, args.spins, args.players, args.balance, args.bid, args.max_spins, args.seed, args.curve)
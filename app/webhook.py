@@ -0,0 +1,141 @@
+"""
+Webhook entry point for running the bot behind a load balancer.
+
+This module provides:
+- BoundedRequestHandler: webhook request handler that checks the secret token,
+  processes at most WEBHOOK_MAX_CONCURRENT_UPDATES updates at once and rejects
+  requests with 429 once WEBHOOK_MAX_PENDING_UPDATES are waiting, so Telegram
+  retries them later instead of piling up work while Redis or Postgres are slow.
+  Once shutting down it rejects every update with 503, so Telegram redelivers them
+  to other replicas while the cache is flushed.
+- run_webhook: starts the aiohttp server and registers the webhook in Telegram.
+"""
+
+import asyncio
+import os
+import re
+import signal
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from dotenv import load_dotenv
+from loguru import logger
+
+load_dotenv()
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH") or "/webhook"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST") or "0.0.0.0"
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT") or 8080)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS") or 40)
+WEBHOOK_MAX_CONCURRENT_UPDATES = int(os.getenv("WEBHOOK_MAX_CONCURRENT_UPDATES") or 100)
+WEBHOOK_MAX_PENDING_UPDATES = int(os.getenv("WEBHOOK_MAX_PENDING_UPDATES") or 1000)
+# Characters and length Telegram accepts for secret_token
+WEBHOOK_SECRET_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,256}")
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """
+    Webhook handler with a bound on concurrently processed updates.
+
+    Updates are processed before responding, so a slow backend holds the request
+    and Telegram's own delivery slows down accordingly.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, max_concurrent: int, max_pending: int, **kwargs) -> None:
+        """
+        Args:
+            dispatcher (Dispatcher): Dispatcher to feed updates into.
+            bot (Bot): Bot instance.
+            max_concurrent (int): Maximum number of updates processed at once.
+            max_pending (int): Maximum number of updates processed or waiting before rejecting.
+        """
+        super().__init__(dispatcher, bot, handle_in_background=False, **kwargs)
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.max_pending = max_pending
+        self.pending = 0
+        # Cleared on shutdown, before the dispatcher's shutdown handlers flush the cache
+        self.accepting = True
+
+    async def handle(self, request: web.Request) -> web.Response:
+        """
+        Verify the secret token and process the update within the concurrency bound.
+
+        Args:
+            request (web.Request): Incoming webhook request.
+
+        Returns:
+            web.Response: Webhook response, 401 for a wrong secret, 429 when overloaded, 503 when shutting down.
+        """
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), self.bot):
+            return web.Response(body="Unauthorized", status=401)
+        if not self.accepting:
+            return web.Response(body="Service Unavailable", status=503, headers={"Retry-After": "1"})
+        if self.pending >= self.max_pending:
+            return web.Response(body="Too Many Requests", status=429, headers={"Retry-After": "1"})
+        self.pending += 1
+        try:
+            async with self.semaphore:
+                return await self._handle_request(bot=self.bot, request=request)
+        finally:
+            self.pending -= 1
+
+    __call__ = handle
+
+
+async def run_webhook(dispatcher: Dispatcher, bot: Bot) -> None:
+    """
+    Serve webhook requests until SIGINT/SIGTERM.
+
+    - Refuses to start without a valid WEBHOOK_SECRET: aiogram accepts every request when the
+      secret is empty, so anyone reaching the port could post forged updates for any user.
+    - Registers the webhook in Telegram if WEBHOOK_URL is set. Without it the server
+      only accepts locally POSTed updates, e.g. from benchmarks/replay_updates.py.
+    - Emits dispatcher startup and shutdown events with the aiohttp application.
+
+    Args:
+        dispatcher (Dispatcher): Dispatcher with routers included.
+        bot (Bot): Bot instance.
+
+    Raises:
+        ValueError: If WEBHOOK_SECRET is empty or not accepted by Telegram.
+    """
+    if not WEBHOOK_SECRET_PATTERN.fullmatch(WEBHOOK_SECRET or ""):
+        raise ValueError("WEBHOOK_SECRET is required with BOT_MODE=webhook: 1-256 characters of A-Z, a-z, 0-9, _ and -")
+    app = web.Application()
+    handler = BoundedRequestHandler(
+        dispatcher,
+        bot,
+        max_concurrent=WEBHOOK_MAX_CONCURRENT_UPDATES,
+        max_pending=WEBHOOK_MAX_PENDING_UPDATES,
+        secret_token=WEBHOOK_SECRET,
+    )
+    handler.register(app, path=WEBHOOK_PATH)
+    setup_application(app, dispatcher, bot=bot)
+
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=dispatcher.resolve_used_update_types(),
+        )
+
+    stop = asyncio.Event()
+    for signal_name in (signal.SIGINT, signal.SIGTERM):
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal_name, stop.set)
+        except NotImplementedError:
+            # Windows event loops do not support signal handlers, KeyboardInterrupt still works
+            pass
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logger.info(f"Listening for webhook updates on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    try:
+        await stop.wait()
+    finally:
+        handler.accepting = False
+        await runner.cleanup()
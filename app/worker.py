@@ -1,42 +1,455 @@
 """
 Background task to synchronize user coin balances from Redis to the database.
 
-This module defines an async function that:
-- Periodically retrieves all user sessions from Redis.
-- Ensures consistency between cache and database.
+This module defines async functions that:
+- Periodically drain the set of changed (dirty) sessions from Redis, only in the elected leader process.
+- Persist changed sessions shortly before they expire, found by their deadlines in a sorted set,
+  so no balance is lost to TTL however long SYNC_INTERVAL is.
+- Iterate over all user sessions with SCAN for a full pass when a process becomes the leader,
+  converting sessions of the legacy layout on the way.
+- Read balances in pipelined batches and write each batch with one bulk upsert fenced by the leader's token.
+- Flush only the sessions changed by this process on shutdown, concurrently and within a deadline,
+  snapshotting balances left unsaved at the deadline to an append-only file replayed on next startup.
+- Forget sessions changed by this process once the leader has saved them, in every process.
+- Rebuild the leaderboard from the database every LEADERBOARD_REBUILD_INTERVAL seconds in the leader.
+- Settle autospins left pending by stopped processes in the leader.
+- Ensure consistency between cache and database.
 """
 
 import asyncio
+import json
+import os
+import time
+from datetime import datetime
+from dotenv import load_dotenv
 from loguru import logger
-from app.cache.redis_logic import redis_client, UserSession
+from app.cache.redis_logic import (redis_client, DIRTY_SESSIONS_KEY, SYNCING_SESSIONS_KEY, SESSION_DEADLINES_KEY,
+                                   local_dirty_user_ids, migrate_sessions, SESSION_TTL)
+from app.database.models import POSTGRES_POOL_SIZE
+from app.leader import sync_leader
+from app.cache.leaderboard import leaderboard, LEADERBOARD_REBUILD_INTERVAL
+from app.autospin import settle_stale_autospins
 import app.database.requests as rq
+from app import metrics
 
-logger.add("logs/log.log", rotation="1 day", level="INFO", enqueue=True)
+load_dotenv()
 
+SYNC_BATCH_SIZE = int(os.getenv("SYNC_BATCH_SIZE", 500))
+SYNC_CONCURRENCY = int(os.getenv("SYNC_CONCURRENCY", 4))
+SYNC_INTERVAL = int(os.getenv("SYNC_INTERVAL", 60))
+SYNC_EXPIRY_INTERVAL = int(os.getenv("SYNC_EXPIRY_INTERVAL", 15))
+SYNC_EXPIRY_MARGIN = int(os.getenv("SYNC_EXPIRY_MARGIN", 120))
+SHUTDOWN_FLUSH_TIMEOUT = float(os.getenv("SHUTDOWN_FLUSH_TIMEOUT", 20))
+SHUTDOWN_FLUSH_CONCURRENCY = int(os.getenv("SHUTDOWN_FLUSH_CONCURRENCY", POSTGRES_POOL_SIZE))
+SHUTDOWN_SNAPSHOT_PATH = os.getenv("SHUTDOWN_SNAPSHOT_PATH", "data/unflushed_balances.jsonl")
 
-async def push_all_users_to_db(forced=False):
+# Pops up to ARGV[2] users whose sessions expire by ARGV[1] from the deadlines KEYS[1] and moves
+# the changed ones from the dirty set KEYS[2] to the syncing set KEYS[3].
+# Returns {number of popped users, IDs of changed sessions}.
+POP_EXPIRING_LUA = """
+local user_ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #user_ids == 0 then
+    return {0, {}}
+end
+redis.call('ZREM', KEYS[1], unpack(user_ids))
+local changed = {}
+for _, user_id in ipairs(user_ids) do
+    if redis.call('SMOVE', KEYS[2], KEYS[3], user_id) == 1 or redis.call('SISMEMBER', KEYS[3], user_id) == 1 then
+        table.insert(changed, user_id)
+    end
+end
+return {#user_ids, changed}
+"""
+
+pop_expiring_script = redis_client.register_script(POP_EXPIRING_LUA)
+
+
+async def scan_session_batches(batch_size: int = SYNC_BATCH_SIZE):
     """
-    Continuously push all user coin balances from Redis to the database.
+    Iterate over cached user sessions without blocking Redis.
+
+    Sessions of the legacy layout are converted before their batch is yielded, so the first
+    full pass after an upgrade migrates every cached session.
+
+    Args:
+        batch_size (int): Number of user IDs per yielded batch.
+
+    Yields:
+        list[int]: Telegram User IDs of cached sessions.
+    """
+    batch = []
+    async for key in redis_client.scan_iter(match="user_session:*", count=batch_size):
+        batch.append(int(key.split(":")[1]))
+        if len(batch) >= batch_size:
+            await migrate_sessions(batch)
+            yield batch
+            batch = []
+    if batch:
+        await migrate_sessions(batch)
+        yield batch
+
+
+async def drain_dirty_batches(batch_size: int = SYNC_BATCH_SIZE):
+    """
+    Atomically take all dirty sessions and iterate over them in batches.
+
+    Dirty IDs are moved to the syncing set in one transaction, so sessions changed during
+    the pass are left for the next one. IDs left over from an interrupted pass are retried.
+
+    Args:
+        batch_size (int): Number of user IDs per yielded batch.
+
+    Yields:
+        list[int]: Telegram User IDs of changed sessions.
+    """
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.sunionstore(SYNCING_SESSIONS_KEY, [SYNCING_SESSIONS_KEY, DIRTY_SESSIONS_KEY])
+    pipe.delete(DIRTY_SESSIONS_KEY)
+    await pipe.execute()
+
+    batch = []
+    async for user_id in redis_client.sscan_iter(SYNCING_SESSIONS_KEY, count=batch_size):
+        batch.append(int(user_id))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def expiring_batches(batch_size: int = SYNC_BATCH_SIZE):
+    """
+    Take changed sessions expiring within SYNC_EXPIRY_MARGIN seconds and iterate over them in batches.
+
+    Deadlines are popped atomically, so a session whose TTL is refreshed meanwhile keeps its new
+    deadline. Changed sessions are moved to the syncing set, so the next dirty pass retries
+    them if this pass is interrupted.
 
-    - Runs indefinitely with a 60-second interval between updates.
+    Args:
+        batch_size (int): Number of user IDs per yielded batch.
 
+    Yields:
+        list[int]: Telegram User IDs of changed sessions.
     """
-    if not forced:
-        await asyncio.sleep(10)
+    cutoff = int(time.time()) + SYNC_EXPIRY_MARGIN
+    batch = []
     while True:
-        keys = await redis_client.keys("user_session:*")
-        for key in keys:
-            user_id = int(key.split(":")[1])
-            session = UserSession(user_id)
-            coins = await session.get_coins_qty()
-            if coins is not None and await session.check_authorization_status():
-                await rq.add_user_to_authorized(user_id)
-                await rq.update_user_coins(user_id, coins)
-            else:
-                user_from_db = await rq.get_user_from_authorized(user_id)
-                coins = user_from_db.coins
-                await session.change_coins_qty(coins)
-        logger.info("Redis data was saved in DB")
-        if forced:
+        popped, changed = await pop_expiring_script(
+            keys=[SESSION_DEADLINES_KEY, DIRTY_SESSIONS_KEY, SYNCING_SESSIONS_KEY], args=[cutoff, batch_size])
+        batch += [int(user_id) for user_id in changed]
+        if len(batch) >= batch_size:
+            yield batch[:batch_size]
+            batch = batch[batch_size:]
+        if popped < batch_size:
             break
-        await asyncio.sleep(60)
\ No newline at end of file
+    if batch:
+        yield batch
+
+
+async def local_dirty_batches(batch_size: int = SYNC_BATCH_SIZE):
+    """
+    Take the sessions changed by this process and iterate over them in batches.
+
+    The IDs are moved from the dirty set to the syncing set, so the leader retries
+    them if this process stops before they are saved.
+
+    Args:
+        batch_size (int): Number of user IDs per yielded batch.
+
+    Yields:
+        list[int]: Telegram User IDs of changed sessions.
+    """
+    user_ids = list(local_dirty_user_ids)
+    local_dirty_user_ids.clear()
+    for start in range(0, len(user_ids), batch_size):
+        batch = user_ids[start:start + batch_size]
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.sadd(SYNCING_SESSIONS_KEY, *batch)
+        pipe.srem(DIRTY_SESSIONS_KEY, *batch)
+        await pipe.execute()
+        yield batch
+
+
+async def prune_local_dirty(batch_size: int = SYNC_BATCH_SIZE) -> int:
+    """
+    Forget the sessions changed by this process which are neither dirty nor syncing anymore.
+
+    Such sessions were saved by a sync pass of the leader, whichever process it runs in.
+    An ID changed again while its batch is checked is kept for a later pass.
+
+    Args:
+        batch_size (int): Number of user IDs checked per round trip.
+
+    Returns:
+        int: Number of forgotten sessions.
+    """
+    changes = dict(local_dirty_user_ids)
+    user_ids = list(changes)
+    pruned = 0
+    for start in range(0, len(user_ids), batch_size):
+        batch = user_ids[start:start + batch_size]
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.smismember(DIRTY_SESSIONS_KEY, batch)
+        pipe.smismember(SYNCING_SESSIONS_KEY, batch)
+        dirty, syncing = await pipe.execute()
+        for user_id, is_dirty, is_syncing in zip(batch, dirty, syncing):
+            if not is_dirty and not is_syncing and local_dirty_user_ids.get(user_id) == changes[user_id]:
+                del local_dirty_user_ids[user_id]
+                pruned += 1
+    return pruned
+
+
+async def sync_batch(user_ids: list[int], fencing_token: int | None = None) -> int:
+    """
+    Synchronize one batch of sessions between Redis and the database.
+
+    - Reads balances and authorization flags with a single pipelined round trip.
+    - Upserts balances of authorized users with one statement.
+    - Restores balances of unauthorized sessions from the database.
+
+    Args:
+        user_ids (list[int]): Telegram User IDs to synchronize.
+        fencing_token (int | None): Fencing token of the sync leader, None for writes outside leadership.
+
+    Returns:
+        int: Number of sessions saved to the database.
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.hmget(f"user_session:{user_id}", "c", "a")
+    sessions = await pipe.execute()
+
+    authorized, unauthorized = {}, []
+    for user_id, (coins, is_authorized) in zip(user_ids, sessions):
+        # Session expired between SCAN and HMGET
+        if coins is None:
+            continue
+        if is_authorized == "1":
+            authorized[user_id] = int(coins)
+        else:
+            unauthorized.append(user_id)
+
+    await rq.upsert_users_coins(authorized, fencing_token)
+
+    if unauthorized:
+        coins_from_db = await rq.get_users_coins(unauthorized)
+        pipe = redis_client.pipeline(transaction=False)
+        for user_id, coins in coins_from_db.items():
+            pipe.hset(f"user_session:{user_id}", "c", coins)
+            # The session may have expired since it was read
+            pipe.expire(f"user_session:{user_id}", SESSION_TTL, nx=True)
+        await pipe.execute()
+
+    return len(authorized)
+
+
+async def sync_pass(kind: str = "dirty", batch_size: int = SYNC_BATCH_SIZE, concurrency: int = SYNC_CONCURRENCY,
+                    fencing_token: int | None = None) -> None:
+    """
+    Run one synchronization pass.
+
+    Batches are written concurrently, at most `concurrency` at a time. Saved users are
+    removed from the syncing set once their batch is written.
+
+    Args:
+        kind (str): "full" scans all cached sessions, "dirty" drains all changed sessions,
+            "expiring" takes changed sessions about to expire, "local" takes only the sessions
+            changed by this process.
+        batch_size (int): Number of sessions per batch.
+        concurrency (int): Maximum number of batches processed at once.
+        fencing_token (int | None): Fencing token of the sync leader, None for writes outside leadership.
+    """
+    started = time.perf_counter()
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = []
+
+    async def run(batch):
+        try:
+            saved = await sync_batch(batch, fencing_token)
+            await redis_client.srem(SYNCING_SESSIONS_KEY, *batch)
+            return saved
+        finally:
+            semaphore.release()
+
+    batches = {"full": scan_session_batches, "dirty": drain_dirty_batches, "expiring": expiring_batches,
+               "local": local_dirty_batches}[kind](batch_size)
+    async for batch in batches:
+        await semaphore.acquire()
+        tasks.append(asyncio.create_task(run(batch)))
+
+    saved = sum(await asyncio.gather(*tasks))
+    elapsed = time.perf_counter() - started
+    metrics.sync_pass_latency.observe(elapsed, kind)
+    # Expiring passes run often and mostly find nothing
+    if tasks or kind != "expiring":
+        logger.info(f"Redis data was saved in DB ({kind} pass): {saved} sessions in {len(tasks)} batches, {elapsed:.2f}s")
+
+
+async def write_snapshot(user_ids: list[int], path: str = SHUTDOWN_SNAPSHOT_PATH) -> int:
+    """
+    Append balances of authorized sessions to the snapshot file, one JSON object per line.
+
+    Args:
+        user_ids (list[int]): Telegram User IDs whose balances were not saved.
+        path (str): Snapshot file path.
+
+    Returns:
+        int: Number of balances written.
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.hmget(f"user_session:{user_id}", "c", "a")
+    sessions = await pipe.execute()
+    snapshot_at = int(time.time())
+    lines = [json.dumps({"user_id": user_id, "coins": int(coins), "at": snapshot_at}) + "\n"
+             for user_id, (coins, is_authorized) in zip(user_ids, sessions) if coins is not None and is_authorized == "1"]
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a") as file:
+        file.writelines(lines)
+        file.flush()
+        os.fsync(file.fileno())
+    return len(lines)
+
+
+async def replay_snapshot(path: str = SHUTDOWN_SNAPSHOT_PATH) -> None:
+    """
+    Save balances left in the snapshot file by an interrupted shutdown flush, then remove the file.
+
+    Balances of users whose sessions are cached again are skipped, as the session is newer
+    and is saved by the sync worker. The others are written only if the database row was
+    saved before the snapshot, e.g. not by a sync pass of another replica since. Later lines
+    of a user override earlier ones.
+
+    Args:
+        path (str): Snapshot file path.
+    """
+    if not os.path.exists(path):
+        return
+    balances, saved_at = {}, {}
+    with open(path) as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line may be cut off by a kill during the write
+                logger.warning(f"Skipping a malformed line of {path}")
+                continue
+            balances[entry["user_id"]] = entry["coins"]
+            saved_at[entry["user_id"]] = datetime.fromtimestamp(entry["at"])
+    user_ids = list(balances)
+    for start in range(0, len(user_ids), SYNC_BATCH_SIZE):
+        batch = user_ids[start:start + SYNC_BATCH_SIZE]
+        pipe = redis_client.pipeline(transaction=False)
+        for user_id in batch:
+            pipe.exists(f"user_session:{user_id}")
+        cached = await pipe.execute()
+        await rq.upsert_users_coins({user_id: balances[user_id] for user_id, exists in zip(batch, cached) if not exists},
+                                    saved_at=saved_at)
+    os.remove(path)
+    logger.info(f"Replayed {len(balances)} balances from {path}")
+
+
+async def flush_on_shutdown(timeout: float = SHUTDOWN_FLUSH_TIMEOUT, concurrency: int = SHUTDOWN_FLUSH_CONCURRENCY,
+                            batch_size: int = SYNC_BATCH_SIZE) -> None:
+    """
+    Save the sessions changed by this process, giving up after `timeout` seconds.
+
+    - Writes batches concurrently over at most `concurrency` database connections.
+    - Logs progress every second.
+    - At the deadline cancels the remaining batches and appends their balances to SHUTDOWN_SNAPSHOT_PATH,
+      which is replayed on next startup. They also stay in the syncing set for the sync leader.
+
+    Args:
+        timeout (float): Seconds until the deadline, keep it below the container stop grace period.
+        concurrency (int): Maximum number of batches written at once.
+        batch_size (int): Number of sessions per batch.
+    """
+    started = time.perf_counter()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(batch):
+        async with semaphore:
+            await sync_batch(batch)
+            await redis_client.srem(SYNCING_SESSIONS_KEY, *batch)
+
+    tasks = {asyncio.create_task(run(batch)): batch async for batch in local_dirty_batches(batch_size)}
+    total = sum(len(batch) for batch in tasks.values())
+    deadline = started + timeout
+    pending = set(tasks)
+    while pending and time.perf_counter() < deadline:
+        _, pending = await asyncio.wait(pending, timeout=min(1.0, max(deadline - time.perf_counter(), 0)))
+        saved = sum(len(tasks[task]) for task in tasks if task not in pending)
+        logger.info(f"Shutdown flush: {saved} of {total} sessions saved, {time.perf_counter() - started:.1f}s")
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+    unsaved = [user_id for task, batch in tasks.items()
+               if task in pending or task.exception() is not None for user_id in batch]
+    for task in tasks:
+        if task not in pending and task.exception() is not None:
+            logger.error(f"Shutdown flush of a batch failed: {task.exception()}")
+    if unsaved:
+        written = await write_snapshot(unsaved)
+        logger.warning(f"Shutdown flush incomplete: {written} balances of {len(unsaved)} unsaved sessions "
+                       f"written to {SHUTDOWN_SNAPSHOT_PATH}")
+    else:
+        logger.info(f"Shutdown flush: all {total} sessions saved in {time.perf_counter() - started:.2f}s")
+
+
+async def push_all_users_to_db(forced=False):
+    """
+    Continuously push changed user coin balances from Redis to the database.
+
+    - Takes part in the sync leader election, only the leader runs passes.
+    - A new leader starts with a full pass over all cached sessions, then only flushes dirty sessions.
+    - Runs indefinitely with a SYNC_INTERVAL-second interval between passes, and persists changed sessions
+      about to expire every SYNC_EXPIRY_INTERVAL seconds in between.
+    - Rebuilds the leaderboard after a pass, when the database is fresh, once per LEADERBOARD_REBUILD_INTERVAL.
+    - Settles autospins left pending by stopped processes, see app.autospin.
+    - Forgets the sessions changed by this process once they are saved, in followers too.
+    - Flushes sessions changed by this process within SHUTDOWN_FLUSH_TIMEOUT when forced (e.g. on shutdown).
+
+    """
+    if forced:
+        await flush_on_shutdown()
+        return
+    sync_leader.fencing_floor = await rq.get_sync_fencing_token()
+    await sync_leader.start()
+    await asyncio.sleep(10)
+    synced_token = None
+    synced_at = 0.0
+    rebuilt_at = None
+    while True:
+        token = sync_leader.token
+        if sync_leader.is_leader:
+            try:
+                if token != synced_token or time.monotonic() - synced_at >= SYNC_INTERVAL:
+                    await sync_pass("full" if token != synced_token else "dirty", fencing_token=token)
+                    synced_token = token
+                    synced_at = time.monotonic()
+                    if rebuilt_at is None or time.monotonic() - rebuilt_at >= LEADERBOARD_REBUILD_INTERVAL:
+                        await leaderboard.rebuild()
+                        rebuilt_at = time.monotonic()
+                else:
+                    await sync_pass("expiring", fencing_token=token)
+            except rq.StaleLeaderError as e:
+                # Either a newer leader took over, or Redis lost the fencing counter and issued
+                # a token below the accepted one: raise the floor and let the next lease go above it
+                logger.warning(f"Sync pass rejected with fencing token {token}, resigning leadership: {e}")
+                try:
+                    sync_leader.fencing_floor = await rq.get_sync_fencing_token()
+                    await sync_leader.resign()
+                except Exception as e:
+                    logger.error(f"Resigning sync leadership failed: {e}")
+            except Exception as e:
+                logger.error(f"Sync between cache and database failed: {e}")
+            try:
+                await settle_stale_autospins(batch_size=SYNC_BATCH_SIZE)
+            except Exception as e:
+                logger.error(f"Settling stale autospins failed: {e}")
+        try:
+            await prune_local_dirty()
+        except Exception as e:
+            logger.error(f"Pruning sessions saved by the sync leader failed: {e}")
+        await asyncio.sleep(min(SYNC_INTERVAL, SYNC_EXPIRY_INTERVAL))
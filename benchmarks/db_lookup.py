@@ -0,0 +1,79 @@
+"""
+Benchmark of user lookups by user_id with and without the unique index.
+
+Creates an unlogged scratch table shaped like authorized_users, fills it with
+--rows rows using generate_series, and measures random point lookups
+(the query behind get_user_from_authorized) first as a sequential scan and
+then with a unique index on user_id. The table is dropped afterwards.
+
+Runs against the PostgreSQL database configured in .env.
+
+Usage:
+    python -m benchmarks.db_lookup --rows 1000000 --lookups 200
+"""
+
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+from sqlalchemy import text
+
+from app.database.models import engine
+
+TABLE = "benchmark_authorized_users"
+
+
+async def measure(lookups: int, rows: int) -> tuple[float, float]:
+    """
+    Run random point lookups.
+
+    Args:
+        lookups (int): Number of lookups.
+        rows (int): Number of rows in the table, user IDs are 1..rows.
+
+    Returns:
+        tuple[float, float]: p50 and p99 latency in milliseconds.
+    """
+    latencies = []
+    async with engine.connect() as conn:
+        for _ in range(lookups):
+            started = time.perf_counter()
+            await conn.execute(text(f"SELECT id, user_id, coins, timestamp FROM {TABLE} WHERE user_id = :user_id"),
+                               {"user_id": random.randint(1, rows)})
+            latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+    return statistics.median(latencies), latencies[max(int(len(latencies) * 0.99) - 1, 0)]
+
+
+async def main(rows: int, lookups: int) -> None:
+    async with engine.begin() as conn:
+        await conn.execute(text(f"DROP TABLE IF EXISTS {TABLE}"))
+        await conn.execute(text(
+            f"CREATE UNLOGGED TABLE {TABLE} (id SERIAL PRIMARY KEY, user_id BIGINT, "
+            "coins INTEGER NOT NULL, timestamp TIMESTAMP WITH TIME ZONE)"))
+        await conn.execute(text(
+            f"INSERT INTO {TABLE} (user_id, coins, timestamp) "
+            "SELECT n, 1000, now() FROM generate_series(1, :rows) AS n ORDER BY random()"), {"rows": rows})
+        await conn.execute(text(f"ANALYZE {TABLE}"))
+    try:
+        p50, p99 = await measure(lookups, rows)
+        print(f"{rows} rows, no index:     p50 {p50:.2f} ms, p99 {p99:.2f} ms")
+        async with engine.begin() as conn:
+            await conn.execute(text(f"CREATE UNIQUE INDEX ix_{TABLE}_user_id ON {TABLE} (user_id)"))
+            await conn.execute(text(f"ANALYZE {TABLE}"))
+        p50, p99 = await measure(lookups, rows)
+        print(f"{rows} rows, unique index: p50 {p50:.2f} ms, p99 {p99:.2f} ms")
+    finally:
+        async with engine.begin() as conn:
+            await conn.execute(text(f"DROP TABLE IF EXISTS {TABLE}"))
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--lookups", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.lookups))
@@ -0,0 +1,218 @@
+"""
+Offline load test of the bot's update processing.
+
+Simulated users concurrently go through a scenario of synthetic updates
+(/start, captcha answer, bid, top-up, profile) which are fed through
+Dispatcher.feed_update with the real router, RateLimiter and FSM storage.
+Telegram is replaced by a stub session answering instantly (or after --telegram-latency),
+Redis and PostgreSQL are the ones configured in .env.
+
+Reports:
+- Throughput in updates per second
+- Latency of update processing, p50 and p99
+- Redis round trips, SQL statements and Telegram calls per update
+- Hit ratio of the in-process session cache with --session-cache
+
+Synthetic users have negative IDs which never collide with Telegram IDs, their
+sessions, rate limiting keys, leaderboard entries, scheduled replies, ledger entries
+and rows are removed afterwards.
+
+Usage:
+    python -m benchmarks.load_test --users 200 --rounds 5
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+from collections import Counter
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import SendDice, SendMessage, EditMessageText
+from aiogram.types import Update, Message, Chat, Dice
+from sqlalchemy import delete, event
+
+from app.handlers import router
+from app.cache.redis_logic import (redis_client, redis_pool_stats, session_cache, DIRTY_SESSIONS_KEY, SYNCING_SESSIONS_KEY,
+                                   SESSION_DEADLINES_KEY, LEDGER_STREAM_KEY, LEADERBOARD_KEY, load_scripts)
+from app.cache.rate_limiting import rate_limit_key
+from app.cache.fsm_storage import SessionStorage
+from app.cache.blacklist import blacklist
+from app.cache.leaderboard import LEADERBOARD_NAMES_KEY
+from app.log import LogContext
+from app.database.models import engine, async_session, AuthorizedUser, BlacklistedUser, LedgerEntry
+from app.scheduler import SCHEDULED_REPLIES_KEY
+from app.ledger import LEDGER_GROUP
+
+# Synthetic user IDs never collide with Telegram IDs
+FIRST_USER_ID = -1_000_000_000
+BID = 10
+TOP_UP = 50
+# Only equality of the chosen and the correct emoji is checked
+CAPTCHA_EMOJI = "⭐"
+
+
+class StubSession(BaseSession):
+    '''Bot session answering API calls locally and counting them by method.'''
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls = Counter()
+        self.message_id = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[method.__api_method__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(method, (SendMessage, SendDice, EditMessageText)):
+            self.message_id += 1
+            return Message(
+                message_id=self.message_id, date=int(time.time()),
+                chat=Chat(id=method.chat_id, type="private"),
+                dice=Dice(emoji="🎰", value=random.randint(1, 64)) if isinstance(method, SendDice) else None,
+            ).as_(bot)
+        return True
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+
+def message_update(update_id: int, user_id: int, text: str) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": "Load"}
+    message = {"message_id": update_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+               "from": user, "text": text}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return {"update_id": update_id, "message": message}
+
+
+def callback_update(update_id: int, user_id: int, data: str) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": "Load"}
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "chat_instance": "1", "data": data, "from": user,
+        "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+                    "text": "menu"}}}
+
+
+def scenario(user_id: int, rounds: int) -> list:
+    '''Build updates of one user: /start and captcha once, then bid, top-up and profile every round.'''
+    updates = [("message", "/start"), ("callback", f"captcha:{CAPTCHA_EMOJI}:{CAPTCHA_EMOJI}:{user_id}")]
+    for _ in range(rounds):
+        updates += [("callback", "main:spin"), ("callback", f"bid_amount:{BID}"),
+                    ("callback", f"add_coins:{TOP_UP}"), ("callback", "main:profile")]
+    return updates
+
+
+async def cleanup(user_ids: range) -> None:
+    '''Remove everything the synthetic users left in Redis and PostgreSQL.'''
+    ids = list(user_ids)
+    # Users blacklisted for flooding are also removed from other running bot processes
+    for user_id in blacklist.user_ids.intersection(ids):
+        await blacklist.remove(user_id)
+    for start in range(0, len(ids), 1000):
+        chunk = ids[start:start + 1000]
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.delete(*(f"user_session:{user_id}" for user_id in chunk))
+        pipe.delete(*(rate_limit_key(user_id) for user_id in chunk))
+        pipe.srem(DIRTY_SESSIONS_KEY, *chunk)
+        pipe.srem(SYNCING_SESSIONS_KEY, *chunk)
+        pipe.zrem(SESSION_DEADLINES_KEY, *chunk)
+        pipe.zrem(LEADERBOARD_KEY, *chunk)
+        pipe.hdel(LEADERBOARD_NAMES_KEY, *chunk)
+        await pipe.execute()
+    # Spin results scheduled for synthetic chats must not be picked up by a running bot
+    async for payload, _ in redis_client.zscan_iter(SCHEDULED_REPLIES_KEY):
+        if json.loads(payload)["chat_id"] in user_ids:
+            await redis_client.zrem(SCHEDULED_REPLIES_KEY, payload)
+    # Ledger entries not yet written by a running bot
+    last_id = "-"
+    while entries := await redis_client.xrange(LEDGER_STREAM_KEY, min=last_id, count=1000):
+        synthetic = [entry_id for entry_id, fields in entries if int(fields["user_id"]) in user_ids]
+        if synthetic:
+            await redis_client.xack(LEDGER_STREAM_KEY, LEDGER_GROUP, *synthetic)
+            await redis_client.xdel(LEDGER_STREAM_KEY, *synthetic)
+        last_id = "(" + entries[-1][0]
+    async with async_session() as session:
+        for model in (AuthorizedUser, BlacklistedUser, LedgerEntry):
+            await session.execute(delete(model).where(model.user_id >= user_ids.start, model.user_id < user_ids.stop))
+        await session.commit()
+
+
+async def main(users: int, rounds: int, telegram_latency: float, use_session_cache: bool = False) -> None:
+    await load_scripts()
+    if use_session_cache:
+        await session_cache.start(redis_client)
+        while not session_cache.ready:
+            await asyncio.sleep(0.01)
+    stub = StubSession(telegram_latency / 1000)
+    bot = Bot(token="42:LOAD-TEST", session=stub)
+    dispatcher = Dispatcher(storage=SessionStorage())
+    dispatcher.update.outer_middleware(LogContext())
+    dispatcher.include_router(router)
+
+    sql_statements = 0
+
+    def count_statement(*args):
+        nonlocal sql_statements
+        sql_statements += 1
+
+    event.listen(engine.sync_engine, "before_cursor_execute", count_statement)
+
+    user_ids = range(FIRST_USER_ID, FIRST_USER_ID + users)
+    await cleanup(user_ids)
+    latencies = []
+    update_ids = iter(range(1, 1 << 62))
+
+    async def simulate(user_id: int) -> None:
+        for kind, payload in scenario(user_id, rounds):
+            update_id = next(update_ids)
+            raw = message_update(update_id, user_id, payload) if kind == "message" else callback_update(update_id, user_id, payload)
+            update = Update.model_validate(raw, context={"bot": bot})
+            started = time.perf_counter()
+            await dispatcher.feed_update(bot, update)
+            latencies.append(time.perf_counter() - started)
+
+    redis_round_trips = redis_pool_stats.checkouts
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(simulate(user_id) for user_id in user_ids))
+        elapsed = time.perf_counter() - started
+        redis_round_trips = redis_pool_stats.checkouts - redis_round_trips
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", count_statement)
+        await cleanup(user_ids)
+
+    count = len(latencies)
+    latencies.sort()
+    print(f"{users} users x {len(scenario(0, rounds))} updates, Telegram latency {telegram_latency:.0f}ms")
+    print(f"throughput:          {count / elapsed:.0f} updates/s ({count} in {elapsed:.2f}s)")
+    print(f"latency p50:         {statistics.median(latencies) * 1000:.2f}ms")
+    print(f"latency p99:         {latencies[int(count * 0.99) - 1] * 1000:.2f}ms")
+    print(f"Redis round trips:   {redis_round_trips / count:.2f} per update")
+    print(f"SQL statements:      {sql_statements / count:.2f} per update")
+    print(f"Telegram calls:      {sum(stub.calls.values()) / count:.2f} per update")
+    for method, calls in stub.calls.most_common():
+        print(f"    {method:<20}{calls / count:.2f}")
+    if use_session_cache:
+        print(session_cache)
+        await session_cache.stop()
+
+    await redis_client.aclose()
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="simulated Telegram API latency, ms")
+    parser.add_argument("--session-cache", action="store_true", help="serve FSM reads from the in-process session cache")
+    args = parser.parse_args()
+    asyncio.run(main(args.users, args.rounds, args.telegram_latency, args.session_cache))
@@ -0,0 +1,75 @@
+"""
+Micro-benchmark of rate limiting algorithms.
+
+For every algorithm from app.cache.rate_limiting this script measures:
+- Latency of a single check (one EVAL round trip), p50 and p99
+- Redis memory used by the limiter key of one user
+
+Runs against the Redis server configured in .env and only touches keys of
+synthetic users under a separate prefix.
+
+Usage:
+    python -m benchmarks.rate_limiting --users 1000 --hits 20
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+from app.cache.redis_logic import redis_client, RATE_LIMITING_PERIOD, MESSAGES_PER_PERIOD
+from app.cache.rate_limiting import ALGORITHMS, rate_limit_key
+
+# Synthetic user IDs never collide with Telegram IDs
+FIRST_USER_ID = -1_000_000_000
+
+
+async def run_algorithm(name: str, users: int, hits: int) -> dict:
+    """
+    Benchmark one algorithm.
+
+    Args:
+        name (str): Algorithm name.
+        users (int): Number of simulated users.
+        hits (int): Checks per user.
+
+    Returns:
+        dict: Latency percentiles in microseconds and average memory per user in bytes.
+    """
+    algorithm = ALGORITHMS[name]()
+    user_ids = range(FIRST_USER_ID, FIRST_USER_ID + users)
+    await redis_client.delete(*(rate_limit_key(user_id) for user_id in user_ids))
+
+    latencies = []
+    for _ in range(hits):
+        for user_id in user_ids:
+            started = time.perf_counter()
+            await algorithm.hit(redis_client, user_id, RATE_LIMITING_PERIOD, MESSAGES_PER_PERIOD)
+            latencies.append((time.perf_counter() - started) * 1_000_000)
+
+    memory = [await redis_client.memory_usage(rate_limit_key(user_id)) or 0 for user_id in user_ids]
+    await redis_client.delete(*(rate_limit_key(user_id) for user_id in user_ids))
+
+    latencies.sort()
+    return {
+        "p50": statistics.median(latencies),
+        "p99": latencies[int(len(latencies) * 0.99) - 1],
+        "memory": sum(memory) / len(memory),
+    }
+
+
+async def main(users: int, hits: int) -> None:
+    print(f"{users} users x {hits} checks, limit {MESSAGES_PER_PERIOD} per {RATE_LIMITING_PERIOD}s")
+    print(f"{'algorithm':<16}{'p50, us':>10}{'p99, us':>10}{'bytes/user':>12}")
+    for name in ALGORITHMS:
+        result = await run_algorithm(name, users, hits)
+        print(f"{name:<16}{result['p50']:>10.1f}{result['p99']:>10.1f}{result['memory']:>12.0f}")
+    await redis_client.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--hits", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.users, args.hits))
@@ -0,0 +1,65 @@
+"""
+Replay recorded Telegram updates against a running webhook server.
+
+Reads one JSON update per line and POSTs it to the webhook with the secret token
+from WEBHOOK_SECRET, then reports response statuses and latency. Start the bot with
+BOT_MODE=webhook and without WEBHOOK_URL to test locally.
+
+Usage:
+    python -m benchmarks.replay_updates benchmarks/updates.example.jsonl --repeat 100 --concurrency 20
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+from collections import Counter
+
+import aiohttp
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+async def replay(path: str, url: str, repeat: int, concurrency: int) -> None:
+    with open(path, encoding="utf-8") as file:
+        updates = [json.loads(line) for line in file if line.strip()]
+
+    statuses = Counter()
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": os.getenv("WEBHOOK_SECRET") or ""}
+
+    async def post(session: aiohttp.ClientSession, update: dict, update_id: int) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            async with session.post(url, json={**update, "update_id": update_id}, headers=headers) as response:
+                await response.read()
+                statuses[response.status] += 1
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(
+            post(session, update, number * len(updates) + index)
+            for number in range(repeat)
+            for index, update in enumerate(updates)
+        ))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"{len(latencies)} updates in {elapsed:.2f}s, {len(latencies) / elapsed:.1f} updates/s")
+    print(f"latency p50 {statistics.median(latencies):.1f} ms, p99 {latencies[int(len(latencies) * 0.99) - 1]:.1f} ms")
+    print("statuses: " + ", ".join(f"{status} x{count}" for status, count in sorted(statuses.items())))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help="File with one JSON update per line")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{os.getenv('WEBHOOK_PORT') or 8080}{os.getenv('WEBHOOK_PATH') or '/webhook'}")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(replay(args.path, args.url, args.repeat, args.concurrency))
@@ -0,0 +1,138 @@
+"""
+Benchmark of the session hash layout, legacy vs compact.
+
+For --sessions synthetic sessions of each layout this script measures:
+- Redis memory per session (used_memory delta, the expiry deadline entry of compact
+  sessions included) and the hash encoding
+- Duration of writing all sessions
+- Duration of one update of every session refreshing its TTL, and how many TTL writes
+  it issued: legacy sessions run HEXPIRE on seven fields every time, compact ones
+  run EXPIRE only when less than SESSION_TTL_REFRESH_THRESHOLD seconds are left
+- Duration and resulting memory of migrating the legacy sessions online with migrate_sessions
+
+Runs against the Redis server configured in .env, legacy sessions need Redis 7.4+ for HEXPIRE.
+Synthetic users have negative IDs which never collide with Telegram IDs, their sessions
+are removed afterwards.
+
+Usage:
+    python -m benchmarks.session_layout --sessions 1000000
+"""
+
+import argparse
+import asyncio
+import time
+from datetime import datetime
+
+from app.cache.redis_logic import (redis_client, touch_script, migrate_sessions, SESSION_TTL,
+                                   SESSION_TTL_REFRESH_THRESHOLD, SESSION_DEADLINES_KEY)
+
+# Synthetic user IDs never collide with Telegram IDs
+FIRST_USER_ID = -1_000_000_000
+CHUNK_SIZE = 10_000
+LEGACY_FIELDS = ("id", "user_id", "authorized", "coins", "timestamp", "fsm_state", "fsm_data")
+STATE = "AuthorizationStatus:authorized"
+
+
+def chunks(user_ids: range):
+    for start in range(0, len(user_ids), CHUNK_SIZE):
+        yield user_ids[start:start + CHUNK_SIZE]
+
+
+async def used_memory() -> int:
+    return (await redis_client.info("memory"))["used_memory"]
+
+
+async def ttl_writes() -> int:
+    '''Number of HEXPIRE and EXPIRE calls so far, including the ones made by scripts.'''
+    stats = await redis_client.info("commandstats")
+    return sum(stats.get(f"cmdstat_{name}", {}).get("calls", 0) for name in ("hexpire", "expire"))
+
+
+async def fill(user_ids: range, layout: str) -> None:
+    '''Write sessions the way the session code of the given layout creates them.'''
+    for chunk in chunks(user_ids):
+        pipe = redis_client.pipeline(transaction=False)
+        for user_id in chunk:
+            name = f"user_session:{user_id}"
+            if layout == "legacy":
+                pipe.hset(name, mapping={"id": 1, "user_id": user_id, "authorized": 1, "coins": 1000,
+                                         "timestamp": str(datetime.now()), "fsm_state": STATE})
+                pipe.hexpire(name, SESSION_TTL, *LEGACY_FIELDS)
+            else:
+                pipe.hset(name, mapping={"a": 1, "c": 1000, "s": STATE})
+                pipe.expire(name, SESSION_TTL)
+                pipe.zadd(SESSION_DEADLINES_KEY, {user_id: int(time.time()) + SESSION_TTL})
+        await pipe.execute()
+
+
+async def touch(user_ids: range, layout: str) -> None:
+    '''Refresh TTL of every session once, as every update does.'''
+    for chunk in chunks(user_ids):
+        pipe = redis_client.pipeline(transaction=False)
+        for user_id in chunk:
+            if layout == "legacy":
+                pipe.hexpire(f"user_session:{user_id}", SESSION_TTL, *LEGACY_FIELDS)
+            else:
+                await touch_script(keys=[f"user_session:{user_id}", SESSION_DEADLINES_KEY],
+                                   args=[SESSION_TTL, SESSION_TTL_REFRESH_THRESHOLD, user_id], client=pipe)
+        await pipe.execute()
+
+
+async def delete(user_ids: range) -> None:
+    for chunk in chunks(user_ids):
+        await redis_client.delete(*(f"user_session:{user_id}" for user_id in chunk))
+        await redis_client.zrem(SESSION_DEADLINES_KEY, *chunk)
+
+
+async def run_layout(user_ids: range, layout: str) -> dict:
+    '''Benchmark one layout, the sessions are removed afterwards.'''
+    await delete(user_ids)
+    memory = await used_memory()
+    started = time.perf_counter()
+    await fill(user_ids, layout)
+    result = {
+        "fill": time.perf_counter() - started,
+        "memory": (await used_memory() - memory) / len(user_ids),
+        "encoding": await redis_client.object("encoding", f"user_session:{user_ids[0]}"),
+    }
+
+    writes = await ttl_writes()
+    started = time.perf_counter()
+    await touch(user_ids, layout)
+    result["touch"] = time.perf_counter() - started
+    result["ttl_writes"] = (await ttl_writes() - writes) / len(user_ids)
+
+    if layout == "legacy":
+        started = time.perf_counter()
+        for chunk in chunks(user_ids):
+            await migrate_sessions(list(chunk))
+        result["migrate"] = time.perf_counter() - started
+        result["migrated_memory"] = (await used_memory() - memory) / len(user_ids)
+        result["migrated_encoding"] = await redis_client.object("encoding", f"user_session:{user_ids[0]}")
+
+    await delete(user_ids)
+    return result
+
+
+async def main(sessions: int) -> None:
+    user_ids = range(FIRST_USER_ID, FIRST_USER_ID + sessions)
+    print(f"{sessions} sessions, TTL {SESSION_TTL}s, refreshed below {SESSION_TTL_REFRESH_THRESHOLD}s")
+    print(f"{'layout':<10}{'bytes/session':>15}{'encoding':>12}{'fill, s':>10}{'update, s':>11}{'TTL writes/update':>19}")
+    try:
+        for layout in ("legacy", "compact"):
+            result = await run_layout(user_ids, layout)
+            print(f"{layout:<10}{result['memory']:>15.0f}{result['encoding']:>12}{result['fill']:>10.2f}"
+                  f"{result['touch']:>11.2f}{result['ttl_writes']:>19.2f}")
+            if layout == "legacy":
+                print(f"migration of legacy sessions: {result['migrate']:.2f}s, "
+                      f"{result['migrated_memory']:.0f} bytes/session afterwards ({result['migrated_encoding']})")
+    finally:
+        await delete(user_ids)
+        await redis_client.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=1_000_000)
+    args = parser.parse_args()
+    asyncio.run(main(args.sessions))
@@ -5,33 +5,90 @@ from aiogram import Bot, Dispatcher
 from loguru import logger
 
 from app.handlers import router
-from app.database.models import async_main
-from app.worker import push_all_users_to_db
+from app.database.models import async_main, warm_db_pool, db_pool_stats
+from app.cache.blacklist import blacklist
+from app.cache.redis_logic import (load_scripts, warm_redis_pool, redis_pool_stats, redis_client, session_cache,
+                                   SESSION_CACHE_ENABLED)
+from app.cache.fsm_storage import SessionStorage
+from app.worker import push_all_users_to_db, replay_snapshot
+from app.webhook import run_webhook
+from app.outbound import outbound_limiter
+from app.scheduler import scheduler
+from app.leader import sync_leader
+from app.ledger import ledger_writer
+from app import metrics, profiling
+from app.log import setup_logging, LogContext
 
-logger.add("logs/log.log", rotation="1 day", level="INFO", enqueue=True)
+setup_logging()
 
 async def main():
     """
     Main function, does following:
-    - Creates all tables in the database if they do not exist.
+    - Creates or upgrades database schema with migrations.
+    - Warms Postgres and Redis connection pools, failing early if either is unreachable.
+    - Serves Prometheus metrics if METRICS_ENABLED=true.
+    - Logs a stage breakdown of slow updates if PROFILING_ENABLED=true.
+    - Loads the blacklist cache and Redis Lua scripts.
+    - Saves balances snapshotted by an incomplete shutdown flush of the previous run.
+    - Starts the in-process session cache if SESSION_CACHE_ENABLED=true.
+    - Starts the ledger writer moving spins and top-ups from a Redis Stream to the database.
     - Initializes bot and bot instance
-    - Includes router and starts polling
+    - Includes router and starts polling, or serves webhook requests if BOT_MODE=webhook
     """
     logger.info("Loading environment variables...")
     load_dotenv()
-    logger.info("Creating database tables...")
+    logger.info("Applying database migrations...")
     await async_main()
-    logger.info("Starting sync between cache and database...")
+    logger.info("Warming connection pools...")
+    await warm_db_pool()
+    await warm_redis_pool()
+    logger.info("Loading blacklist...")
+    await blacklist.load()
+    await load_scripts()
+    await replay_snapshot()
+    if SESSION_CACHE_ENABLED:
+        await session_cache.start(redis_client)
+    logger.info("Starting ledger writer...")
+    await ledger_writer.start()
+    logger.info("Starting sync between cache and database in the elected leader...")
     asyncio.create_task(push_all_users_to_db())
     logger.info("Initializing and starting bot")
     bot = Bot(token=os.getenv("BOT_API_KEY"))
-    dp = Dispatcher()
+    if profiling.PROFILING_ENABLED:
+        # Registered first so slow update breakdowns include outbound queueing
+        bot.session.middleware(profiling.TelegramCallProfiler())
+    # All outgoing API calls are shaped to Telegram's global and per-chat limits
+    bot.session.middleware(outbound_limiter)
+    if metrics.METRICS_ENABLED:
+        bot.session.middleware(metrics.TelegramRequestTimer())
+    metrics_runner = await metrics.start_metrics_server()
+    dp = Dispatcher(storage=SessionStorage())
+    # Every record logged while handling an update carries its update_id and user_id
+    dp.update.outer_middleware(LogContext())
     dp.include_router(router)
+    # Resumes delayed replies left from a previous run
+    await scheduler.start(bot)
     try:
         logger.info("Bot started")
-        await dp.start_polling(bot)
+        if os.getenv("BOT_MODE") == "webhook":
+            await run_webhook(dp, bot)
+        else:
+            # Polling does not work while a webhook from a previous run is set
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
     finally:
+        await scheduler.stop()
+        await ledger_writer.stop()
+        # Lets another replica take over syncing without waiting for the lease to expire
+        await sync_leader.stop()
         await bot.session.close()
+        await session_cache.stop()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        logger.info(db_pool_stats)
+        logger.info(redis_pool_stats)
+        if SESSION_CACHE_ENABLED:
+            logger.info(session_cache)
 
 if __name__ == "__main__":
     try: